@@ -65,12 +65,20 @@ class DP(Conf):
     max_host_fib_retry_count = None
     max_resolve_backoff_time = None
     packetin_pps = None
+    port_packetin_rate = None
+    port_packetin_burst = None
+    packetin_batch_size = None
+    packetin_batch_ms = None
     learn_jitter = None
+    learn_cache_size = None
+    learn_cache_timeout = None
     learn_ban_timeout = None
     advertise_interval = None
     proactive_learn = None
+    fib_compression = None
     pipeline_config_dir = None
     use_idle_timeout = None
+    shadow_flows = None
     tables = {}
     tables_by_id = {}
     meters = {}
@@ -129,18 +137,34 @@ class DP(Conf):
         # Max number of seconds to back off to when resolving nexthops.
         'packetin_pps': 0,
         # Ask switch to rate limit packet pps. TODO: Not supported by OVS in 2.7.0
+        'port_packetin_rate': 0,
+        # Default max packet ins per second admitted from each port (0 unlimited).
+        'port_packetin_burst': 0,
+        # Default max burst of packet ins admitted from each port (0 for port_packetin_rate).
+        'packetin_batch_size': 0,
+        # If non zero, process packet ins from this DP in batches of up to this many packets.
+        'packetin_batch_ms': 5,
+        # Max milliseconds to wait for a batch of packet ins to fill.
         'learn_jitter': 10,
         # Jitter learn timeouts by up to this many seconds
         'learn_ban_timeout': 10,
         # When banning/limiting learning, wait this many seconds before learning can be retried
+        'learn_cache_size': 1024,
+        # Max number of recently learned hosts to remember, to drop redundant packet ins (0 to disable)
+        'learn_cache_timeout': 2,
+        # How long to remember a recently learned host (seconds, should be less than timeout).
         'advertise_interval': 30,
         # How often to advertise (eg. IPv6 RAs)
         'proactive_learn': True,
         # whether proactive learning is enabled for IP nexthops
+        'fib_compression': False,
+        # Don't program routes covered by a less specific route with the same nexthop
         'pipeline_config_dir': '/etc/ryu/faucet',
         # where config files for pipeline are stored (if any).
         'use_idle_timeout': False,
         #Turn on/off the use of idle timeout for src_table, default OFF.
+        'shadow_flows': False,
+        # Track installed flows, and don't send flowmods that would not change them.
         }
 
     defaults_types = {
@@ -170,12 +194,20 @@ class DP(Conf):
         'max_host_fib_retry_count': int,
         'max_resolve_backoff_time': int,
         'packetin_pps': int,
+        'port_packetin_rate': int,
+        'port_packetin_burst': int,
+        'packetin_batch_size': int,
+        'packetin_batch_ms': int,
         'learn_jitter': int,
         'learn_ban_timeout': int,
+        'learn_cache_size': int,
+        'learn_cache_timeout': int,
         'advertise_interval': int,
         'proactive_learn': bool,
+        'fib_compression': bool,
         'pipeline_config_dir': str,
         'use_idle_timeout': bool,
+        'shadow_flows': bool,
     }
 
     wildcard_table = ValveTable(ofp.OFPTT_ALL, 'all', None, flow_cookie=0)
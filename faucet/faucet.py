@@ -41,6 +41,8 @@ try:
     import faucet_api
     import faucet_bgp
     import faucet_metrics
+    import faucet_state
+    import valve_host
     import valve_packet
     import valve_of
 except ImportError:
@@ -51,6 +53,8 @@ except ImportError:
     from faucet import faucet_api
     from faucet import faucet_bgp
     from faucet import faucet_metrics
+    from faucet import faucet_state
+    from faucet import valve_host
     from faucet import valve_packet
     from faucet import valve_of
 
@@ -80,6 +84,28 @@ class EventFaucetAdvertise(event.EventBase):
     pass
 
 
+class EventFaucetStateSave(event.EventBase):
+    """Event used to trigger saving of dynamic state."""
+    pass
+
+
+class EventFaucetPacketInBatch(event.EventBase):
+    """Event used to trigger processing of a batch of packet ins."""
+
+    def __init__(self, dp_id, batch):
+        super(EventFaucetPacketInBatch, self).__init__()
+        self.dp_id = dp_id
+        self.batch = batch
+
+
+class EventFaucetFlowRemovedBatch(event.EventBase):
+    """Event used to trigger processing of a batch of flow removeds."""
+
+    def __init__(self, dp_id):
+        super(EventFaucetFlowRemovedBatch, self).__init__()
+        self.dp_id = dp_id
+
+
 class EventFaucetAPIRegistered(event.EventBase):
     """Event used to notify that the API is registered with Faucet."""
     pass
@@ -128,24 +154,38 @@ class Faucet(app_manager.RyuApp):
             self.exc_logname, self.exc_logfile, logging.DEBUG, 1)
 
         self.valves = {}
+        # Hosts learned on edge ports, shared by all Valves.
+        self.edge_hosts = valve_host.EdgeHostIndex()
+        # Pending packet ins by DP ID, when batching packet ins.
+        self._packet_in_batches = {}
+        # Pending expired flows by DP ID.
+        self._flow_removed_batches = {}
 
         # Start Prometheus
         prom_port = int(os.getenv('FAUCET_PROMETHEUS_PORT', '9302'))
         prom_addr = os.getenv('FAUCET_PROMETHEUS_ADDR', '')
         self.metrics = faucet_metrics.FaucetMetrics()
+        self.metrics.valve_state.valves = self.valves
         self.metrics.start(prom_port, prom_addr)
 
         # Start BGP
         self._bgp = faucet_bgp.FaucetBgp(self.logger, self._send_flow_msgs)
 
+        # Load state saved by a previous instance, for a warm restart
+        self.state = faucet_state.FaucetState(
+            self.logger, os.getenv('FAUCET_STATE_FILE', ''))
+        self._restored_state = self.state.load()
+
         # Configure all Valves
         self._load_configs(self.config_file)
 
         # Start all threads
-        self._threads = [
-            hub.spawn(thread) for thread in (
-                self._gateway_resolve_request, self._host_expire_request,
-                self._metric_update_request, self._advertise_request)]
+        threads = [
+            self._gateway_resolve_request, self._host_expire_request,
+            self._metric_update_request, self._advertise_request]
+        if self.state.state_file:
+            threads.append(self._state_save_request)
+        self._threads = [hub.spawn(thread) for thread in threads]
 
         # Register to API
         api = kwargs['faucet_api']
@@ -155,10 +195,16 @@ class Faucet(app_manager.RyuApp):
         # Set the signal handler for reloading config file
         signal.signal(signal.SIGHUP, self._signal_handler)
         signal.signal(signal.SIGINT, self._signal_handler)
+        signal.signal(signal.SIGTERM, self._signal_handler)
 
     @kill_on_exception(exc_logname)
     def _load_configs(self, new_config_file):
         self.config_file = new_config_file
+        # Pending packet ins refer to the current config, so handle them now.
+        for dp_id in list(self._packet_in_batches.keys()):
+            self._packet_in_batch_flush(dp_id)
+        for dp_id in list(self._flow_removed_batches.keys()):
+            self._flow_removed_batch_flush(dp_id)
         self.config_hashes, new_dps = dp_parser(
             new_config_file, self.logname)
         if new_dps is None:
@@ -192,7 +238,9 @@ class Faucet(app_manager.RyuApp):
                         sorted(list(SUPPORTED_HARDWARE.keys())))
                     continue
                 else:
-                    valve = valve_cl(new_dp, self.logname)
+                    valve = valve_cl(new_dp, self.logname, self.edge_hosts)
+                    if dp_id in self._restored_state:
+                        valve.restore_state(self._restored_state.pop(dp_id))
                     self.valves[dp_id] = valve
                 self.logger.info('Add new datapath %s', dpid_log(dp_id))
             self.metrics.reset_dpid(dp_id)
@@ -225,6 +273,11 @@ class Faucet(app_manager.RyuApp):
                 return
 
         valve = self.valves[dp_id]
+        flow_msgs_count = len(flow_msgs)
+        flow_msgs = valve.prepare_send_flows(flow_msgs)
+        # pylint: disable=no-member
+        self.metrics.of_flowmsgs_suppressed.labels(
+            dp_id=hex(dp_id)).inc(flow_msgs_count - len(flow_msgs))
         reordered_flow_msgs = valve_of.valve_flowreorder(flow_msgs)
         valve.ofchannel_log(reordered_flow_msgs)
         for flow_msg in reordered_flow_msgs:
@@ -263,7 +316,8 @@ class Faucet(app_manager.RyuApp):
         """
         if sigid == signal.SIGHUP:
             self.send_event('Faucet', EventFaucetReconfigure())
-        elif sigid == signal.SIGINT:
+        elif sigid in (signal.SIGINT, signal.SIGTERM):
+            self.state.save(self.valves)
             self.close()
             sys.exit(0)
 
@@ -290,6 +344,9 @@ class Faucet(app_manager.RyuApp):
     def _advertise_request(self):
         self._thread_reschedule(EventFaucetAdvertise(), 5)
 
+    def _state_save_request(self):
+        self._thread_reschedule(EventFaucetStateSave(), 30)
+
     @set_ev_cls(EventFaucetResolveGateways, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
     def resolve_gateways(self, _):
@@ -305,7 +362,6 @@ class Faucet(app_manager.RyuApp):
         """Handle a request expire host state in the controller."""
         for valve in list(self.valves.values()):
             valve.host_expire()
-            valve.update_metrics(self.metrics)
 
     @set_ev_cls(EventFaucetMetricUpdate, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
@@ -322,6 +378,12 @@ class Faucet(app_manager.RyuApp):
             if flowmods:
                 self._send_flow_msgs(dp_id, flowmods)
 
+    @set_ev_cls(EventFaucetStateSave, MAIN_DISPATCHER)
+    @kill_on_exception(exc_logname)
+    def state_save(self, _):
+        """Handle a request to save dynamic state."""
+        self.state.save(self.valves)
+
     def get_config(self):
         """FAUCET API: return config for all Valves."""
         return get_config_for_api(self.valves)
@@ -361,21 +423,103 @@ class Faucet(app_manager.RyuApp):
 
         in_port = msg.match['in_port']
         # eth/VLAN header only
-        pkt, eth_pkt, vlan_vid, eth_type = valve_packet.parse_packet_in_pkt(
-            msg.data, max_len=valve_packet.ETH_VLAN_HEADER_SIZE)
-        if pkt is None or vlan_vid is None:
+        eth_src, eth_dst, vlan_vid, eth_type = valve_packet.parse_packet_in_header(
+            msg.data)
+        if eth_src is None or vlan_vid is None:
             self.logger.info(
                 'unparseable packet from %s port %s', dpid_log(dp_id), in_port)
             return
-        pkt_meta = valve.parse_rcv_packet(
-            in_port, vlan_vid, eth_type, msg.data, pkt, eth_pkt)
 
         # pylint: disable=no-member
         self.metrics.of_packet_ins.labels(
             dp_id=hex(dp_id)).inc()
-        flowmods = valve.rcv_packet(dp_id, self.valves, pkt_meta)
+        learn_cache_hit = valve.learn_cache_hit(
+            in_port, vlan_vid, eth_src, eth_dst)
+        if learn_cache_hit is not None:
+            if learn_cache_hit:
+                self.metrics.of_learn_cache_hits.labels(
+                    dp_id=hex(dp_id)).inc()
+                return
+            self.metrics.of_learn_cache_misses.labels(
+                dp_id=hex(dp_id)).inc()
+
+        pkt_meta = valve.parse_rcv_packet(
+            in_port, vlan_vid, eth_type, msg.data, eth_src, eth_dst)
+        if valve.dp.packetin_batch_size:
+            self._packet_in_batch_add(valve, pkt_meta)
+        else:
+            self._rcv_packets(dp_id, valve, [pkt_meta])
+
+    def _rcv_packets(self, dp_id, valve, pkt_metas):
+        """Handle one or more packet ins from a datapath.
+
+        All resulting OpenFlow messages are sent together.
+
+        Args:
+            dp_id (int): datapath ID.
+            valve (Valve): Valve instance for datapath.
+            pkt_metas (list): PacketMeta instances, in order received.
+        """
+        flowmods = []
+        for pkt_meta in pkt_metas:
+            flowmods.extend(valve.rcv_packet(dp_id, self.valves, pkt_meta))
         self._send_flow_msgs(dp_id, flowmods)
-        valve.update_metrics(self.metrics)
+        self._learn_stack_hosts()
+
+    def _learn_stack_hosts(self):
+        """Have all DPs in a stack learn hosts newly learned by an edge DP."""
+        for edge_dp_id, vlan_vid, eth_src in self.edge_hosts.pop_learned():
+            if edge_dp_id not in self.valves:
+                continue
+            edge_dp = self.valves[edge_dp_id].dp
+            for dp_id, valve in list(self.valves.items()):
+                if dp_id == edge_dp_id:
+                    continue
+                flowmods = valve.learn_host_from_stack(edge_dp, vlan_vid, eth_src)
+                if flowmods:
+                    self._send_flow_msgs(dp_id, flowmods)
+
+    def _packet_in_batch_add(self, valve, pkt_meta):
+        """Add a packet in to the pending batch for a datapath.
+
+        The batch is handled when full, or when packetin_batch_ms has elapsed
+        since the first packet in was added, whichever is first.
+
+        Args:
+            valve (Valve): Valve instance for datapath.
+            pkt_meta (PacketMeta): packet in.
+        """
+        dp_id = valve.dp.dp_id
+        if dp_id not in self._packet_in_batches:
+            self._packet_in_batches[dp_id] = []
+            hub.spawn_after(
+                valve.dp.packetin_batch_ms / 1e3,
+                self.send_event, 'Faucet',
+                EventFaucetPacketInBatch(dp_id, self._packet_in_batches[dp_id]))
+        batch = self._packet_in_batches[dp_id]
+        batch.append(pkt_meta)
+        if len(batch) >= valve.dp.packetin_batch_size:
+            self._packet_in_batch_flush(dp_id)
+
+    def _packet_in_batch_flush(self, dp_id, batch=None):
+        """Handle all pending packet ins for a datapath.
+
+        Args:
+            dp_id (int): datapath ID.
+            batch (list): if not None, only handle pending packet ins if still this batch.
+        """
+        if batch is not None and self._packet_in_batches.get(dp_id, None) is not batch:
+            # Batch already handled (e.g. when full), timer is for an old batch.
+            return
+        batch = self._packet_in_batches.pop(dp_id, None)
+        if batch and dp_id in self.valves:
+            self._rcv_packets(dp_id, self.valves[dp_id], batch)
+
+    @set_ev_cls(EventFaucetPacketInBatch, MAIN_DISPATCHER)
+    @kill_on_exception(exc_logname)
+    def packet_in_batch(self, ryu_event):
+        """Handle a request to process pending packet ins for a datapath."""
+        self._packet_in_batch_flush(ryu_event.dp_id, ryu_event.batch)
 
     @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
@@ -394,6 +538,8 @@ class Faucet(app_manager.RyuApp):
         # pylint: disable=no-member
         self.metrics.of_errors.labels(dp_id=hex(dp_id)).inc()
         self.logger.error('OFError %s from %s', msg, dpid_log(dp_id))
+        # A flowmod may have failed, so installed flows are no longer known.
+        valve.reset_shadow_flows()
 
     @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
@@ -443,6 +589,8 @@ class Faucet(app_manager.RyuApp):
         valve = self._get_valve(ryu_dp, '_datapath_disconnect')
         if valve is None:
             return
+        self._packet_in_batches.pop(dp_id, None)
+        self._flow_removed_batches.pop(dp_id, None)
         valve.datapath_disconnect(dp_id)
         # pylint: disable=no-member
         self.metrics.of_dp_disconnections.labels(dp_id=hex(dp_id)).inc()
@@ -513,14 +661,44 @@ class Faucet(app_manager.RyuApp):
     @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER) # pylint: disable=no-member
     @kill_on_exception(exc_logname)
     def flowremoved_handler(self, ryu_event):
+        """Handle a flow removed event.
+
+        Expired flows are handled in batches per datapath: a batch
+        includes all flow removeds already queued when the first one is
+        handled, so a burst of expiries results in one flow send.
+
+        Args:
+            ryu_event (ryu.controller.ofp_event.EventOFPFlowRemoved): trigger.
+        """
         msg = ryu_event.msg
         ryu_dp = msg.datapath
+        dp_id = ryu_dp.id
         valve = self._get_valve(ryu_dp, 'flowremoved_handler', msg)
         if valve is None:
             return
         ofp = msg.datapath.ofproto
         reason = msg.reason
         if reason == ofp.OFPRR_IDLE_TIMEOUT:
-            flowmods = valve.flow_timeout(msg.table_id, msg.match)
+            if dp_id not in self._flow_removed_batches:
+                self._flow_removed_batches[dp_id] = []
+                hub.spawn(
+                    self.send_event, 'Faucet', EventFaucetFlowRemovedBatch(dp_id))
+            self._flow_removed_batches[dp_id].append((msg.table_id, msg.match))
+
+    def _flow_removed_batch_flush(self, dp_id):
+        """Handle all pending expired flows for a datapath.
+
+        Args:
+            dp_id (int): datapath ID.
+        """
+        batch = self._flow_removed_batches.pop(dp_id, None)
+        if batch and dp_id in self.valves:
+            flowmods = self.valves[dp_id].flows_timeout(batch)
             if flowmods:
-                self._send_flow_msgs(ryu_dp.id, flowmods)
+                self._send_flow_msgs(dp_id, flowmods)
+
+    @set_ev_cls(EventFaucetFlowRemovedBatch, MAIN_DISPATCHER)
+    @kill_on_exception(exc_logname)
+    def flow_removed_batch(self, ryu_event):
+        """Handle a request to process pending expired flows for a datapath."""
+        self._flow_removed_batch_flush(ryu_event.dp_id)
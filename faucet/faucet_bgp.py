@@ -20,6 +20,10 @@
 
 import json
 import ipaddress
+import math
+import time
+
+from ryu.lib import hub
 from ryu.services.protocols.bgp.bgpspeaker import BGPSpeaker
 try:
     from valve_util import btos
@@ -27,6 +31,76 @@ except ImportError:
     from faucet.valve_util import btos
 
 
+class BgpRouteDampening(object):
+    """Route flap dampening (RFC 2439) for the prefixes learned on a VLAN.
+
+    Each withdraw, or change of nexthop, of a prefix adds a penalty that
+    decays exponentially. A prefix whose penalty exceeds the suppress
+    limit is withdrawn, and its latest state held back until the penalty
+    has decayed below the reuse limit.
+    """
+
+    PENALTY = 1000
+    SUPPRESS_LIMIT = 2000
+    REUSE_LIMIT = 750
+    HALF_LIFE = 900
+
+    def __init__(self):
+        # penalty and time penalty last updated, by prefix.
+        self._penalties = {}
+        # latest nexthop (None if withdrawn), by suppressed prefix.
+        self._suppressed = {}
+
+    def _penalty(self, prefix, now):
+        if prefix not in self._penalties:
+            return 0
+        penalty, penalty_time = self._penalties[prefix]
+        return penalty * 2 ** (-(now - penalty_time) / float(self.HALF_LIFE))
+
+    def is_suppressed(self, prefix):
+        """Return True if a prefix is suppressed."""
+        return prefix in self._suppressed
+
+    def update(self, prefix, nexthop, current_nexthop, now):
+        """Record a route change, and return True if it must be held back.
+
+        Args:
+            prefix (ipaddress.ip_network): prefix changed.
+            nexthop (ipaddress.ip_address): new nexthop (None if withdrawn).
+            current_nexthop (ipaddress.ip_address): installed nexthop (None if none).
+            now (float): current time, seconds since epoch.
+        Returns:
+            bool: True if prefix is suppressed.
+        """
+        if prefix in self._suppressed:
+            current_nexthop = self._suppressed[prefix]
+        penalty = self._penalty(prefix, now)
+        if current_nexthop is not None and nexthop != current_nexthop:
+            penalty += self.PENALTY
+            self._penalties[prefix] = (penalty, now)
+        elif prefix in self._penalties and penalty < self.REUSE_LIMIT / 2:
+            del self._penalties[prefix]
+        if prefix in self._suppressed or penalty > self.SUPPRESS_LIMIT:
+            self._suppressed[prefix] = nexthop
+            return True
+        return False
+
+    def reuse_time(self, prefix, now):
+        """Return seconds until a suppressed prefix may be reused."""
+        penalty = self._penalty(prefix, now)
+        if penalty <= self.REUSE_LIMIT:
+            return 0
+        return self.HALF_LIFE * math.log(penalty / float(self.REUSE_LIMIT), 2)
+
+    def reuse(self, prefix):
+        """Stop suppressing a prefix.
+
+        Returns:
+            ipaddress.ip_address: latest nexthop for prefix (None if withdrawn).
+        """
+        return self._suppressed.pop(prefix)
+
+
 class FaucetBgp(object):
 
     def __init__(self, logger, send_flow_msgs):
@@ -35,10 +109,15 @@ class FaucetBgp(object):
         self._valves = None
         self.logger = logger
         self._send_flow_msgs = send_flow_msgs
+        # pending nexthop (None if withdrawn) by prefix, by (DP ID, VID).
+        self._pending_route_changes = {}
+        self._route_dampening = {}
 
     def _bgp_route_handler(self, path_change, vlan):
         """Handle a BGP change event.
 
+        Changes are queued and applied in batches (see _queue_route_change()).
+
         Args:
             path_change (ryu.services.protocols.bgp.bgpspeaker.EventPrefix): path change
             vlan (vlan): Valve VLAN this path change was received for.
@@ -46,10 +125,8 @@ class FaucetBgp(object):
         prefix = ipaddress.ip_network(btos(path_change.prefix))
         nexthop = ipaddress.ip_address(btos(path_change.nexthop))
         withdraw = path_change.is_withdraw
-        flowmods = []
         if not self._valves or vlan.dp_id not in self._valves:
             return
-        valve = self._valves[vlan.dp_id]
         if vlan.is_faucet_vip(nexthop):
             self.logger.error(
                 'BGP nexthop %s for prefix %s cannot be us',
@@ -64,14 +141,105 @@ class FaucetBgp(object):
         if withdraw:
             self.logger.info(
                 'BGP withdraw %s nexthop %s', prefix, nexthop)
-            flowmods = valve.del_route(vlan, prefix)
+            nexthop = None
         else:
             self.logger.info(
                 'BGP add %s nexthop %s', prefix, nexthop)
-            flowmods = valve.add_route(vlan, nexthop, prefix)
+        self._queue_route_change(vlan, prefix, nexthop)
+
+    def _queue_route_change(self, vlan, prefix, nexthop):
+        """Queue a route change, to be applied with others in a batch.
+
+        A batch is applied when bgp_batch_size prefixes are pending, or
+        bgp_batch_ms after its first change, whichever is first. Changes
+        to the same prefix within a batch are coalesced, so only the last
+        is applied.
+
+        Args:
+            vlan (vlan): Valve VLAN this change was received for.
+            prefix (ipaddress.ip_network): prefix changed.
+            nexthop (ipaddress.ip_address): new nexthop (None if withdrawn).
+        """
+        vlan_key = (vlan.dp_id, vlan.vid)
+        if vlan_key not in self._pending_route_changes:
+            self._pending_route_changes[vlan_key] = {}
+            hub.spawn_after(
+                vlan.bgp_batch_ms / 1e3, self._apply_route_changes,
+                vlan, self._pending_route_changes[vlan_key])
+        pending = self._pending_route_changes[vlan_key]
+        pending[prefix] = nexthop
+        if len(pending) >= vlan.bgp_batch_size:
+            self._apply_route_changes(vlan)
+
+    def _apply_route_changes(self, vlan, batch=None):
+        """Apply all pending route changes for a VLAN, as one batch of flows.
+
+        Args:
+            vlan (vlan): Valve VLAN to apply changes for.
+            batch (dict): if not None, only apply pending changes if still this batch.
+        """
+        vlan_key = (vlan.dp_id, vlan.vid)
+        if batch is not None and self._pending_route_changes.get(vlan_key, None) is not batch:
+            # Batch already applied (e.g. when full), timer is for an old batch.
+            return
+        pending = self._pending_route_changes.pop(vlan_key, None)
+        if not pending or not self._valves or vlan.dp_id not in self._valves:
+            return
+        valve = self._valves[vlan.dp_id]
+        now = time.time()
+        flowmods = []
+        for prefix, nexthop in list(pending.items()):
+            if vlan.bgp_route_dampening and self._dampen(vlan, prefix, nexthop, now):
+                nexthop = None
+            if nexthop is None:
+                flowmods.extend(valve.del_route(vlan, prefix))
+            else:
+                flowmods.extend(valve.add_route(vlan, nexthop, prefix))
         if flowmods:
             self._send_flow_msgs(vlan.dp_id, flowmods)
 
+    def _dampen(self, vlan, prefix, nexthop, now):
+        """Return True if a route change is held back by dampening.
+
+        Args:
+            vlan (vlan): Valve VLAN this change was received for.
+            prefix (ipaddress.ip_network): prefix changed.
+            nexthop (ipaddress.ip_address): new nexthop (None if withdrawn).
+            now (float): current time, seconds since epoch.
+        Returns:
+            bool: True if prefix is suppressed (and so should be withdrawn).
+        """
+        vlan_key = (vlan.dp_id, vlan.vid)
+        if vlan_key not in self._route_dampening:
+            self._route_dampening[vlan_key] = BgpRouteDampening()
+        dampening = self._route_dampening[vlan_key]
+        was_suppressed = dampening.is_suppressed(prefix)
+        current_nexthop = vlan.routes_by_ipv(prefix.version).get(prefix)
+        if not dampening.update(prefix, nexthop, current_nexthop, now):
+            return False
+        if not was_suppressed:
+            self.logger.info('BGP suppressing flapping prefix %s', prefix)
+            hub.spawn_after(
+                dampening.reuse_time(prefix, now), self._reuse_route, vlan, prefix)
+        return True
+
+    def _reuse_route(self, vlan, prefix):
+        """Apply the latest state of a suppressed prefix, once it may be reused.
+
+        Args:
+            vlan (vlan): Valve VLAN the prefix was received for.
+            prefix (ipaddress.ip_network): suppressed prefix.
+        """
+        dampening = self._route_dampening.get((vlan.dp_id, vlan.vid), None)
+        if dampening is None or not dampening.is_suppressed(prefix):
+            return
+        reuse_time = dampening.reuse_time(prefix, time.time())
+        if reuse_time > 0:
+            hub.spawn_after(reuse_time, self._reuse_route, vlan, prefix)
+            return
+        self.logger.info('BGP reusing prefix %s', prefix)
+        self._queue_route_change(vlan, prefix, dampening.reuse(prefix))
+
     def _create_bgp_speaker_for_vlan(self, vlan):
         """Set up BGP speaker for an individual VLAN if required.
 
@@ -107,6 +275,9 @@ class FaucetBgp(object):
         """Set up a BGP speaker for every VLAN that requires it."""
         self._valves = valves
         self._metrics = metrics
+        # Speakers are recreated, so routes will be relearned.
+        self._pending_route_changes = {}
+        self._route_dampening = {}
         # TODO: port status changes should cause us to withdraw a route.
         for dp_id, valve in list(self._valves.items()):
             if dp_id not in self._dp_bgp_speakers:
@@ -18,7 +18,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+
 from prometheus_client import Counter, Gauge
+from prometheus_client.core import GaugeMetricFamily
 
 try:
     from prom_client import PromClient
@@ -29,16 +32,16 @@ except ImportError:
 class FaucetMetrics(PromClient):
     """Container class for objects that can be exported to Prometheus."""
 
-    _dpid_counters = {}
-    _dpid_gauges = {}
+    _dpid_counters = None
+    _dpid_gauges = None
 
     def _dpid_counter(self, var, var_help):
-        counter = Counter(var, var_help, ['dp_id'])
+        counter = Counter(var, var_help, ['dp_id'], registry=self._reg)
         self._dpid_counters[var] = counter
         return counter
 
     def _dpid_gauge(self, var, var_help):
-        gauge = Gauge(var, var_help, ['dp_id'])
+        gauge = Gauge(var, var_help, ['dp_id'], registry=self._reg)
         self._dpid_gauges[var] = gauge
         return gauge
 
@@ -49,14 +52,25 @@ class FaucetMetrics(PromClient):
         for gauge in list(self._dpid_gauges.values()):
             gauge.labels(dp_id=hex(dp_id)).set(0)
 
-    def __init__(self):
-        super(FaucetMetrics, self).__init__()
+    def __init__(self, reg=None):
+        super(FaucetMetrics, self).__init__(reg=reg)
+        self._dpid_counters = {}
+        self._dpid_gauges = {}
         self.of_packet_ins = self._dpid_counter(
             'of_packet_ins',
             'number of OF packet_ins received from DP')
+        self.of_learn_cache_hits = self._dpid_counter(
+            'of_learn_cache_hits',
+            'number of OF packet_ins dropped as host was recently learned')
+        self.of_learn_cache_misses = self._dpid_counter(
+            'of_learn_cache_misses',
+            'number of OF packet_ins for learning not recently learned')
         self.of_flowmsgs_sent = self._dpid_counter(
             'of_flowmsgs_sent',
             'number of OF flow messages (and packet outs) sent to DP')
+        self.of_flowmsgs_suppressed = self._dpid_counter(
+            'of_flowmsgs_suppressed',
+            'number of OF flow messages not sent as they would not change the DP')
         self.of_errors = self._dpid_counter(
             'of_errors',
             'number of OF errors received from DP')
@@ -68,47 +82,124 @@ class FaucetMetrics(PromClient):
             'number of OF connections from a DP')
         self.faucet_config_reload_requests = Counter(
             'faucet_config_reload_requests',
-            'number of config reload requests', [])
+            'number of config reload requests', [],
+            registry=self._reg)
         self.faucet_config_reload_warm = self._dpid_counter(
             'faucet_config_reload_warm',
             'number of warm, differences only config reloads executed')
         self.faucet_config_reload_cold = self._dpid_counter(
             'faucet_config_reload_cold',
             'number of cold, complete reprovision config reloads executed')
-        self.vlan_hosts_learned = Gauge(
-            'vlan_hosts_learned',
-            'number of hosts learned on a VLAN', ['dp_id', 'vlan'])
-        self.vlan_neighbors = Gauge(
-            'vlan_neighbors',
-            'number of neighbors on a VLAN', ['dp_id', 'vlan', 'ipv'])
-        self.vlan_learn_bans = Gauge(
-            'vlan_learn_bans',
-            'number of times learning was banned on a VLAN', ['dp_id', 'vlan'])
         self.faucet_config_table_names = Gauge(
             'faucet_config_table_names',
-            'number to names map of FAUCET pipeline tables', ['dp_id', 'name'])
+            'number to names map of FAUCET pipeline tables', ['dp_id', 'name'],
+            registry=self._reg)
         self.faucet_config_dp_name = Gauge(
             'faucet_config_dp_name',
-            'map of DP name to DP ID', ['dp_id', 'name'])
+            'map of DP name to DP ID', ['dp_id', 'name'],
+            registry=self._reg)
         self.bgp_neighbor_uptime_seconds = Gauge(
             'bgp_neighbor_uptime',
-            'BGP neighbor uptime in seconds', ['dp_id', 'vlan', 'neighbor'])
+            'BGP neighbor uptime in seconds', ['dp_id', 'vlan', 'neighbor'],
+            registry=self._reg)
         self.bgp_neighbor_routes = Gauge(
             'bgp_neighbor_routes',
-            'BGP neighbor route count', ['dp_id', 'vlan', 'neighbor', 'ipv'])
-        self.learned_macs = Gauge(
-            'learned_macs',
-            ('max address stored as 64bit number to DP ID, port, VLAN, '
-             'and n (maximum number of hosts on the port)'),
-            ['dp_id', 'port', 'vlan', 'n'])
+            'BGP neighbor route count', ['dp_id', 'vlan', 'neighbor', 'ipv'],
+            registry=self._reg)
         self.port_status = Gauge(
             'port_status',
             'status of switch ports',
-            ['dp_id', 'port'])
-        self.port_learn_bans = Gauge(
-            'port_learn_bans',
-            'number of times learning was banned on a port',
-            ['dp_id', 'port'])
+            ['dp_id', 'port'], registry=self._reg)
         self.dp_status = self._dpid_gauge(
             'dp_status',
             'status of datapaths')
+        self.valve_state = ValveStateCollector()
+        self._reg.register(self.valve_state)
+
+
+class ValveStateMetrics(object):
+    """Container for metrics of Valve host state, populated when scraped."""
+
+    FAMILIES = (
+        ('vlan_hosts_learned',
+         'number of hosts learned on a VLAN',
+         ['dp_id', 'vlan']),
+        ('vlan_neighbors',
+         'number of neighbors on a VLAN',
+         ['dp_id', 'vlan', 'ipv']),
+        ('vlan_learn_bans',
+         'number of times learning was banned on a VLAN',
+         ['dp_id', 'vlan']),
+        ('learned_macs',
+         ('max address stored as 64bit number to DP ID, port, VLAN, '
+          'and n (maximum number of hosts on the port)'),
+         ['dp_id', 'port', 'vlan', 'n']),
+        ('vlan_rib_routes',
+         'number of routes in a VLAN RIB',
+         ['dp_id', 'vlan', 'ipv']),
+        ('vlan_fib_routes',
+         'number of routes in a VLAN RIB programmed in the FIB',
+         ['dp_id', 'vlan', 'ipv']),
+        ('vlan_proactive_learn_negative_cache',
+         'number of hosts on a VLAN not proactively resolved as they recently failed',
+         ['dp_id', 'vlan']),
+        ('vlan_proactive_learn_drops',
+         'number of proactive resolutions on a VLAN dropped by negative cache or rate limit',
+         ['dp_id', 'vlan']),
+        ('port_learn_bans',
+         'number of times learning was banned on a port',
+         ['dp_id', 'port']),
+        ('vlan_packet_in_drops',
+         'number of packet ins from a VLAN dropped by rate limiting',
+         ['dp_id', 'vlan']),
+        ('port_packet_in_drops',
+         'number of packet ins from a port dropped by rate limiting',
+         ['dp_id', 'port']),
+        ('table_flows',
+         'number of permanent flows FAUCET has installed in a table (if shadow_flows)',
+         ['dp_id', 'table_id']),
+    )
+
+    def __init__(self):
+        self._families = collections.OrderedDict()
+        for name, documentation, labels in self.FAMILIES:
+            self._families[name] = GaugeMetricFamily(
+                name, documentation, labels=labels)
+
+    def add_metric(self, name, labels, value):
+        """Add a sample to a metric family.
+
+        Args:
+            name (str): metric family name.
+            labels (list): label values.
+            value (float): sample value.
+        """
+        self._families[name].add_metric(labels, value)
+
+    def families(self):
+        """Return all metric families."""
+        return list(self._families.values())
+
+
+class ValveStateCollector(object):
+    """Prometheus collector for Valve host state.
+
+    Host state changes with every packet in, so rather than updating
+    gauges as it changes, metrics are computed from Valves only when
+    Prometheus scrapes them.
+    """
+
+    def __init__(self):
+        self.valves = {}
+
+    @staticmethod
+    def describe():
+        """Return metric families without samples, to register without collecting."""
+        return ValveStateMetrics().families()
+
+    def collect(self):
+        """Return metric families for current state of all Valves."""
+        metrics = ValveStateMetrics()
+        for valve in list(self.valves.values()):
+            valve.update_metrics(metrics)
+        return metrics.families()
@@ -0,0 +1,82 @@
+"""Persist dynamic FAUCET state across controller restarts."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+
+
+class FaucetState(object):
+    """Snapshot of learned hosts, neighbors and learn bans for all Valves.
+
+    Snapshots are written atomically (to a temporary file that then
+    replaces the state file), so a controller killed while saving
+    leaves the previous snapshot intact.
+    """
+
+    VERSION = 1
+
+    def __init__(self, logger, state_file):
+        self.logger = logger
+        self.state_file = state_file
+
+    def save(self, valves):
+        """Save state of all Valves.
+
+        Args:
+            valves (dict): Valve instances by DP ID.
+        """
+        if not self.state_file:
+            return
+        state = {
+            'version': self.VERSION,
+            'dps': dict(
+                (str(dp_id), valve.get_state())
+                for dp_id, valve in list(valves.items()))}
+        tmp_state_file = self.state_file + '.tmp'
+        try:
+            with open(tmp_state_file, 'w') as state_file:
+                json.dump(state, state_file, separators=(',', ':'))
+            os.rename(tmp_state_file, self.state_file)
+        except (IOError, OSError, TypeError, ValueError) as err:
+            self.logger.error(
+                'could not save state to %s: %s', self.state_file, err)
+
+    def load(self):
+        """Load previously saved state.
+
+        Returns:
+            dict: Valve state by DP ID (empty if no usable state saved).
+        """
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        try:
+            with open(self.state_file) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError) as err:
+            self.logger.error(
+                'could not load state from %s: %s', self.state_file, err)
+            return {}
+        if not isinstance(state, dict) or state.get('version') != self.VERSION:
+            self.logger.error(
+                'ignoring unsupported state in %s', self.state_file)
+            return {}
+        dps_state = {}
+        for dp_id, dp_state in list(state.get('dps', {}).items()):
+            dps_state[int(dp_id)] = dp_state
+        return dps_state
@@ -38,7 +38,11 @@ class Port(Conf):
     stack = {}
     max_hosts = None
     hairpin = None
+    packetin_rate = None
+    packetin_burst = None
     dyn_learn_ban_count = 0
+    dyn_packetin_bucket = None
+    dyn_packetin_drop_count = 0
     dyn_phys_up = False
 
     defaults = {
@@ -66,6 +70,10 @@ class Port(Conf):
         # if True, then switch between hosts on this port (eg WiFi radio).
         'lacp': False,
         # if True, experimental LACP support enabled on this port.
+        'packetin_rate': None,
+        # max packet ins per second admitted from this port (None for DP's port_packetin_rate)
+        'packetin_burst': None,
+        # max burst of packet ins admitted from this port (None for DP's port_packetin_burst)
     }
 
     defaults_types = {
@@ -83,6 +91,8 @@ class Port(Conf):
         'stack': dict,
         'max_hosts': int,
         'hairpin': bool,
+        'packetin_rate': int,
+        'packetin_burst': int,
     }
 
     def __init__(self, _id, conf=None):
@@ -102,7 +112,10 @@ class Port(Conf):
 
     @phys_up.setter
     def phys_up(self, status):
-        self.dyn_phys_up = status
+        if status != self.dyn_phys_up:
+            self.dyn_phys_up = status
+            for vlan in self.vlans():
+                vlan.reset_port_caches()
 
     def running(self):
         return self.enabled and self.phys_up
@@ -131,11 +144,15 @@ class Port(Conf):
         if vlans is None:
             vlans = self.vlans()
         for vlan in vlans:
-            for eth_src, host_cache_entry in list(vlan.host_cache.items()):
-                if host_cache_entry.port == self:
-                    hosts.append(eth_src)
+            hosts.extend(vlan.cached_hosts_on_port(self))
         return hosts
 
+    def hosts_count(self, vlans=None):
+        """Return number of hosts this port has learned (on all or specified VLANs)."""
+        if vlans is None:
+            vlans = self.vlans()
+        return sum([vlan.cached_hosts_count_on_port(self) for vlan in vlans])
+
     def __str__(self):
         return 'Port %u' % self.number
 
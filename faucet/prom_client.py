@@ -19,22 +19,27 @@
 # limitations under the License.
 
 from pbr.version import VersionInfo
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import start_http_server, Gauge, REGISTRY
 
 
 class PromClient(object):
     """Prometheus client."""
 
     running = False
+    _reg = None
 
-    def __init__(self):
+    def __init__(self, reg=None):
+        if reg is None:
+            reg = REGISTRY
+        self._reg = reg
         version = VersionInfo('faucet').semantic_version().release_string()
-        self.faucet_version = Gauge('faucet_pbr_version', 'Faucet PBR version', ['version'])
+        self.faucet_version = Gauge(
+            'faucet_pbr_version', 'Faucet PBR version', ['version'], registry=self._reg)
         # pylint: disable=no-member
         self.faucet_version.labels(version=version).set(1)
 
     def start(self, prom_port, prom_addr):
         """Start webserver if not already running."""
         if not self.running:
-            start_http_server(int(prom_port), prom_addr)
+            start_http_server(int(prom_port), prom_addr, registry=self._reg)
             self.running = True
@@ -22,6 +22,8 @@ import time
 
 from collections import namedtuple
 
+import ipaddress
+
 from ryu.lib import mac
 from ryu.ofproto import ether
 from ryu.ofproto import ofproto_v1_3 as ofp
@@ -35,6 +37,7 @@ try:
     import valve_of
     import valve_packet
     import valve_route
+    import valve_table
     import valve_util
 except ImportError:
     from faucet import tfm_pipeline
@@ -44,6 +47,7 @@ except ImportError:
     from faucet import valve_of
     from faucet import valve_packet
     from faucet import valve_route
+    from faucet import valve_table
     from faucet import valve_util
 
 
@@ -80,7 +84,7 @@ class Valve(object):
     DEC_TTL = True
     L3 = False
 
-    def __init__(self, dp, logname):
+    def __init__(self, dp, logname, edge_hosts=None):
         self.dp = dp
         self.logger = ValveLogger(
             logging.getLogger(logname + '.valve'), self.dp.dp_id)
@@ -101,17 +105,49 @@ class Valve(object):
                 fib_table, self.dp.tables['vip'], self.dp.tables['eth_src'],
                 self.dp.tables['eth_dst'], self.dp.tables['flood'],
                 self.dp.highest_priority, self.dp.routers,
-                self.dp.group_table_routing, self.dp.groups)
+                self.dp.group_table_routing, self.dp.groups,
+                self.dp.fib_compression)
             self.route_manager_by_ipv[route_manager.IPV] = route_manager
         self.flood_manager = valve_flood.ValveFloodManager(
             self.dp.tables['flood'], self.dp.low_priority,
             self.dp.stack, self.dp.ports, self.dp.shortest_path_to_root,
             self.dp.group_table, self.dp.groups)
+        if edge_hosts is None:
+            edge_hosts = valve_host.EdgeHostIndex()
+        self.edge_hosts = edge_hosts
         self.host_manager = valve_host.ValveHostManager(
             self.logger, self.dp.tables['eth_src'], self.dp.tables['eth_dst'],
             self.dp.timeout, self.dp.learn_jitter, self.dp.learn_ban_timeout,
             self.dp.low_priority, self.dp.highest_priority,
-            self.dp.use_idle_timeout)
+            self.dp.use_idle_timeout, self.edge_hosts)
+        self.learn_cache = valve_host.LearnCache(
+            self.dp.learn_cache_size, self.dp.learn_cache_timeout)
+        # State persisted by a previous controller, to reprogram on connect.
+        self._restored_state = None
+        self.shadow_flows = None
+        self.reset_shadow_flows()
+
+    def reset_shadow_flows(self):
+        """Forget flows known installed, as datapath state is now unknown."""
+        self.shadow_flows = None
+        if self.dp.shadow_flows:
+            self.shadow_flows = valve_table.ValveShadowFlowTable(
+                list(self.dp.tables_by_id.keys()))
+
+    def prepare_send_flows(self, flow_msgs):
+        """Return OpenFlow messages to send, less any that would not change the datapath.
+
+        Args:
+            flow_msgs (list): OpenFlow messages, in order generated.
+        Returns:
+            list: OpenFlow messages to send.
+        """
+        if not self.dp.shadow_flows:
+            self.shadow_flows = None
+            return flow_msgs
+        if self.shadow_flows is None:
+            self.reset_shadow_flows()
+        return self.shadow_flows.filter_ofmsgs(flow_msgs)
 
     def switch_features(self, dp_id, msg):
         """Send configuration flows necessary for the switch implementation.
@@ -159,7 +195,7 @@ class Valve(object):
         ofmsgs.extend(self.dp.wildcard_table.flowdel())
         if self.dp.meters:
             ofmsgs.append(valve_of.meterdel())
-        if self.dp.group_table:
+        if self.dp.group_table or self.dp.group_table_routing:
             ofmsgs.append(self.dp.groups.delete_all())
         return ofmsgs
 
@@ -350,11 +386,14 @@ class Valve(object):
         if self._ignore_dpid(dp_id):
             return []
         self.logger.info('Cold start configuring DP')
+        self.learn_cache.clear()
+        self.reset_shadow_flows()
         ofmsgs = []
         ofmsgs.extend(self._add_default_flows())
         ofmsgs.extend(self._add_ports_and_vlans(discovered_up_port_nums))
         ofmsgs.extend(self._add_controller_learn_flow())
         self.dp.running = True
+        ofmsgs.extend(self._restore_state_flows(time.time()))
         return ofmsgs
 
     def datapath_disconnect(self, dp_id):
@@ -365,6 +404,7 @@ class Valve(object):
         """
         if not self._ignore_dpid(dp_id):
             self.dp.running = False
+            self.reset_shadow_flows()
             self.logger.warning('datapath down')
 
     def _port_add_acl(self, port, cold_start=False):
@@ -515,7 +555,8 @@ class Valve(object):
         # Only update flooding rules if not cold starting.
         if not cold_start:
             for vlan in vlans_with_ports_added:
-                ofmsgs.extend(self.flood_manager.build_flood_rules(vlan))
+                ofmsgs.extend(self.flood_manager.build_flood_rules(
+                    vlan, modify=True))
 
         return ofmsgs
 
@@ -544,6 +585,8 @@ class Valve(object):
 
         ofmsgs = []
         vlans_with_deleted_ports = set()
+        # Hosts on deleted ports must be relearned.
+        self.learn_cache.clear()
 
         for port_num in port_nums:
             if valve_of.ignore_port(port_num):
@@ -561,12 +604,21 @@ class Valve(object):
             # hard timeout anyway, but it would be good to "relearn them".
             if not port.mirror_destination:
                 ofmsgs.extend(self._port_delete_flows(port, port.hosts()))
+            # Flows for hosts on this port were deleted, so they must be relearned.
+            for vlan in list(self.dp.vlans.values()):
+                for eth_src in vlan.clear_cache_hosts_on_port(port):
+                    self.edge_hosts.expire(self.dp.dp_id, vlan.vid, eth_src)
             for vlan in port.vlans():
                 vlans_with_deleted_ports.add(vlan)
 
         for vlan in vlans_with_deleted_ports:
             ofmsgs.extend(self.flood_manager.build_flood_rules(
                 vlan, modify=True))
+        # Flood flows from deleted ports were deleted, so re-add them when ports return.
+        for port_num in port_nums:
+            if port_num in self.dp.ports:
+                ofmsgs.extend(self.flood_manager.invalidate_port(
+                    self.dp.ports[port_num]))
 
         return ofmsgs
 
@@ -653,6 +705,58 @@ class Valve(object):
                 return True
         return False
 
+    @staticmethod
+    def _packet_in_bucket(conf, rate, burst, now):
+        """Return token bucket limiting packet ins from a port/VLAN.
+
+        Args:
+            conf (Port or VLAN): port or VLAN packets received on.
+            rate (int): max packet ins per second (0 or None for no limit).
+            burst (int): max burst of packet ins (0 or None for rate).
+            now (float): current time.
+        Returns:
+            TokenBucket: bucket for packet ins, or None if no limit.
+        """
+        if not rate:
+            return None
+        if conf.dyn_packetin_bucket is None:
+            conf.dyn_packetin_bucket = valve_util.TokenBucket(
+                rate, max(burst or rate, 1), now)
+        return conf.dyn_packetin_bucket
+
+    def _admit_packet_in(self, pkt_meta):
+        """Return True if packet in within configured port/VLAN rate limits.
+
+        Args:
+            pkt_meta (PacketMeta): packet in.
+        Returns:
+            bool: True if packet in should be processed.
+        """
+        now = time.time()
+        port = pkt_meta.port
+        vlan = pkt_meta.vlan
+        port_rate = port.packetin_rate
+        port_burst = port.packetin_burst
+        if port_rate is None:
+            port_rate = self.dp.port_packetin_rate
+        if port_burst is None:
+            port_burst = self.dp.port_packetin_burst
+        buckets = []
+        for conf, rate, burst in (
+                (port, port_rate, port_burst),
+                (vlan, vlan.packetin_rate, vlan.packetin_burst)):
+            bucket = self._packet_in_bucket(conf, rate, burst, now)
+            if bucket is None:
+                continue
+            # Only charge any limit if all admit the packet in.
+            if not bucket.available(now):
+                conf.dyn_packetin_drop_count += 1
+                return False
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.consume(now)
+        return True
+
     def _edge_dp_for_host(self, valves, dp_id, pkt_meta):
         """Simple distributed unicast learning.
 
@@ -667,24 +771,25 @@ class Valve(object):
         # We find just one port that is the shortest unicast path to
         # the destination. We could use other factors (eg we could
         # load balance over multiple ports based on destination MAC).
-        # TODO: each DP learns independently. An edge DP could
-        # call other valves so they learn immediately without waiting
-        # for packet in.
         # TODO: edge DPs could use a different forwarding algorithm
         # (for example, just default switch to a neighbor).
         # Find port that forwards closer to destination DP that
         # has already learned this host (if any).
         eth_src = pkt_meta.eth_src
         vlan_vid = pkt_meta.vlan.vid
-        for other_dpid, other_valve in list(valves.items()):
-            if other_dpid == dp_id:
-                continue
-            other_dp = other_valve.dp
-            other_dp_host_cache = other_dp.vlans[vlan_vid].host_cache
-            if eth_src in other_dp_host_cache:
-                host = other_dp_host_cache[eth_src]
-                if host.edge:
-                    return other_dp
+        edge_host = self.edge_hosts.edge_host(vlan_vid, eth_src)
+        if edge_host is None:
+            return None
+        edge_dp_id, _ = edge_host
+        if edge_dp_id == dp_id or edge_dp_id not in valves:
+            return None
+        edge_dp = valves[edge_dp_id].dp
+        if vlan_vid in edge_dp.vlans:
+            host = edge_dp.vlans[vlan_vid].host_cache.get(eth_src, None)
+            if host is not None and host.edge:
+                return edge_dp
+        # Edge DP no longer has this host (eg. its port went down).
+        self.edge_hosts.expire(edge_dp_id, vlan_vid, eth_src)
         return None
 
     def _learn_host(self, valves, dp_id, pkt_meta):
@@ -710,12 +815,77 @@ class Valve(object):
             self.logger.info(
                 'host learned via stack port to %s' % edge_dp.name)
 
-        ofmsgs.extend(self.host_manager.learn_host_on_vlan_port(
-            learn_port, pkt_meta.vlan, pkt_meta.eth_src))
+        learn_ofmsgs = self.host_manager.learn_host_on_vlan_port(
+            learn_port, pkt_meta.vlan, pkt_meta.eth_src)
+        if learn_ofmsgs:
+            self.learn_cache.add(
+                (pkt_meta.vlan.vid, pkt_meta.port.number, pkt_meta.eth_src),
+                time.time())
+        # Other DPs in the stack can learn a new edge host now,
+        # rather than waiting for a packet in from it.
+        if learn_ofmsgs and learn_port.stack is None and self.dp.stack:
+            self.edge_hosts.add_learned(
+                self.dp.dp_id, pkt_meta.vlan.vid, pkt_meta.eth_src)
+        ofmsgs.extend(learn_ofmsgs)
 
         return ofmsgs
 
-    def parse_rcv_packet(self, in_port, vlan_vid, eth_type, data, pkt, eth_pkt):
+    def learn_host_from_stack(self, edge_dp, vlan_vid, eth_src):
+        """Learn a host learned on an edge port of another DP in the stack.
+
+        Args:
+            edge_dp (DP): datapath that learned the host.
+            vlan_vid (int): VLAN VID host learned on.
+            eth_src (str): MAC address of host.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        if (not self.dp.running or
+                not self.dp.stack or
+                'graph' not in self.dp.stack or
+                edge_dp.name == self.dp.name or
+                edge_dp.name not in self.dp.stack['graph'] or
+                vlan_vid not in self.dp.vlans):
+            return []
+        learn_port = self.dp.shortest_path_port(edge_dp.name)
+        if learn_port is None:
+            return []
+        self.logger.info(
+            'host %s learned proactively via stack port to %s' % (
+                eth_src, edge_dp.name))
+        return self.host_manager.learn_host_on_vlan_port(
+            learn_port, self.dp.vlans[vlan_vid], eth_src)
+
+    def learn_cache_hit(self, in_port, vlan_vid, eth_src, eth_dst):
+        """Check if a packet in would only relearn a recently learned host.
+
+        Only packets that would be processed purely for learning (not
+        control plane packets) are checked, so that these can be
+        dropped before being fully parsed. Packets on VLANs with
+        faucet_vips are never checked, as they may also be needed
+        to learn host FIB routes.
+
+        Args:
+            in_port (int): port packet was received on.
+            vlan_vid (int): VLAN VID of port packet was received on.
+            eth_src (str): source Ethernet MAC address.
+            eth_dst (str): destination Ethernet MAC address.
+        Returns:
+            bool: True if host recently learned, or None if packet is not only for learning.
+        """
+        if not self.dp.learn_cache_size or vlan_vid not in self.dp.vlans:
+            return None
+        vlan = self.dp.vlans[vlan_vid]
+        if vlan.faucet_vips:
+            return None
+        if (eth_dst == vlan.faucet_mac or
+                not valve_packet.mac_addr_is_unicast(eth_dst) or
+                not valve_packet.mac_addr_is_unicast(eth_src)):
+            return None
+        return self.learn_cache.hit((vlan_vid, in_port, eth_src), time.time())
+
+    def parse_rcv_packet(self, in_port, vlan_vid, eth_type, data,
+                         eth_src, eth_dst, pkt=None):
         """Parse a received packet into a PacketMeta instance.
 
         Args:
@@ -723,17 +893,16 @@ class Valve(object):
             vlan_vid (int): VLAN VID of port packet was received on.
             eth_type (int): Ethernet type of packet.
             data (bytes): Raw packet data.
-            pkt (ryu.lib.packet.packet): parsed packet received.
-            ekt_pkt (ryu.lib.packet.ethernet): parsed Ethernet header.
+            eth_src (str): source Ethernet MAC address.
+            eth_dst (str): destination Ethernet MAC address.
+            pkt (ryu.lib.packet.packet): parsed packet received (or None, to parse on demand).
         Returns:
             PacketMeta instance.
         """
-        eth_src = eth_pkt.src
-        eth_dst = eth_pkt.dst
         vlan = self.dp.vlans[vlan_vid]
         port = self.dp.ports[in_port]
         return valve_packet.PacketMeta(
-            data, pkt, eth_pkt, port, vlan, eth_src, eth_dst, eth_type)
+            data, port, vlan, eth_src, eth_dst, eth_type, pkt=pkt)
 
     def _port_learn_ban_rules(self, pkt_meta):
         """Limit learning to a maximum configured on this port.
@@ -747,9 +916,8 @@ class Valve(object):
 
         port = pkt_meta.port
         eth_src = pkt_meta.eth_src
-        hosts = port.hosts()
 
-        if len(hosts) == port.max_hosts:
+        if port.hosts_count() == port.max_hosts:
             ofmsgs.append(self.host_manager.temp_ban_host_learning_on_port(
                 port))
             port.dyn_learn_ban_count += 1
@@ -799,36 +967,51 @@ class Valve(object):
                 dp_id=hex(self.dp.dp_id), name=table.name).set(table_id)
 
     def update_metrics(self, metrics):
-        """Update Gauge/metrics.
+        """Add samples for host state to metrics.
 
-        metrics (FaucetMetrics or None): container of Prometheus metrics.
+        metrics (ValveStateMetrics): container of Prometheus metric families.
         """
-        # Clear the exported MAC learning.
         dp_id = hex(self.dp.dp_id)
-        for _, label_dict, _ in metrics.learned_macs.collect()[0].samples:
-            if label_dict['dp_id'] == dp_id:
-                metrics.learned_macs.labels(
-                    dp_id=label_dict['dp_id'], vlan=label_dict['vlan'],
-                    port=label_dict['port'], n=label_dict['n']).set(0)
-
         for vlan in list(self.dp.vlans.values()):
-            hosts_count = vlan.hosts_count()
-            metrics.vlan_hosts_learned.labels(
-                dp_id=dp_id, vlan=vlan.vid).set(hosts_count)
-            metrics.vlan_learn_bans.labels(
-                dp_id=dp_id, vlan=vlan.vid).set(vlan.dyn_learn_ban_count)
+            vid = str(vlan.vid)
+            metrics.add_metric(
+                'vlan_hosts_learned', [dp_id, vid], vlan.hosts_count())
+            metrics.add_metric(
+                'vlan_learn_bans', [dp_id, vid], vlan.dyn_learn_ban_count)
+            metrics.add_metric(
+                'vlan_proactive_learn_negative_cache', [dp_id, vid],
+                len(vlan.dyn_proactive_learn_negative_cache))
+            metrics.add_metric(
+                'vlan_proactive_learn_drops', [dp_id, vid],
+                vlan.dyn_proactive_learn_drop_count)
+            metrics.add_metric(
+                'vlan_packet_in_drops', [dp_id, vid], vlan.dyn_packetin_drop_count)
             for ipv in vlan.ipvs():
                 neigh_cache_size = len(vlan.neigh_cache_by_ipv(ipv))
-                metrics.vlan_neighbors.labels(
-                    dp_id=dp_id, vlan=vlan.vid, ipv=ipv).set(neigh_cache_size)
+                metrics.add_metric(
+                    'vlan_neighbors', [dp_id, vid, str(ipv)], neigh_cache_size)
+                routes = vlan.routes_by_ipv(ipv)
+                metrics.add_metric(
+                    'vlan_rib_routes', [dp_id, vid, str(ipv)], len(routes))
+                metrics.add_metric(
+                    'vlan_fib_routes', [dp_id, vid, str(ipv)], routes.fib_len())
             for port in vlan.get_ports():
+                port_no = str(port.number)
                 for i, host in enumerate(sorted(port.hosts(vlans=[vlan]))):
                     mac_int = int(host.replace(':', ''), 16)
-                    metrics.learned_macs.labels(
-                        dp_id=dp_id, vlan=vlan.vid,
-                        port=port.number, n=i).set(mac_int)
-                metrics.port_learn_bans.labels(
-                    dp_id=dp_id, port=port.number).set(port.dyn_learn_ban_count)
+                    metrics.add_metric(
+                        'learned_macs', [dp_id, port_no, vid, str(i)], mac_int)
+        for port in list(self.dp.ports.values()):
+            port_no = str(port.number)
+            metrics.add_metric(
+                'port_learn_bans', [dp_id, port_no], port.dyn_learn_ban_count)
+            metrics.add_metric(
+                'port_packet_in_drops', [dp_id, port_no], port.dyn_packetin_drop_count)
+        if self.shadow_flows is not None:
+            for table_id, flow_count in list(
+                    self.shadow_flows.table_flow_counts().items()):
+                metrics.add_metric(
+                    'table_flows', [dp_id, str(table_id)], flow_count)
 
     def rcv_packet(self, dp_id, valves, pkt_meta):
         """Handle a packet from the dataplane (eg to re/learn a host).
@@ -849,6 +1032,8 @@ class Valve(object):
         if not pkt_meta.vlan.vid in self.dp.vlans:
             self.logger.warning('Packet_in for unexpected VLAN %s' % pkt_meta.vlan.vid)
             return []
+        if not self._admit_packet_in(pkt_meta):
+            return []
 
         ofmsgs = []
         control_plane_handled = False
@@ -909,6 +1094,96 @@ class Valve(object):
         for vlan in list(self.dp.vlans.values()):
             self.host_manager.expire_hosts_from_vlan(vlan, now)
 
+    def get_state(self):
+        """Return dynamic state (learned hosts, neighbors, learn bans), for persisting.
+
+        Returns:
+            dict: state, suitable for serializing as JSON.
+        """
+        vlans_state = {}
+        for vlan in list(self.dp.vlans.values()):
+            neighbors = []
+            for route_manager in list(self.route_manager_by_ipv.values()):
+                neighbors.extend(route_manager.neighbor_state(vlan))
+            vlans_state[str(vlan.vid)] = {
+                'learn_ban_count': vlan.dyn_learn_ban_count,
+                'hosts': [
+                    [entry.eth_src, entry.port.number, entry.cache_time]
+                    for entry in list(vlan.host_cache.values())],
+                'neighbors': neighbors,
+            }
+        ports_state = {}
+        for port in list(self.dp.ports.values()):
+            ports_state[str(port.number)] = {
+                'learn_ban_count': port.dyn_learn_ban_count,
+            }
+        return {'vlans': vlans_state, 'ports': ports_state}
+
+    def restore_state(self, state):
+        """Seed dynamic state persisted by a previous controller.
+
+        Learn ban counters are restored now; hosts and neighbors are
+        reprogrammed when the datapath connects, so they need not be
+        relearned.
+
+        Args:
+            state (dict): state as returned by get_state().
+        """
+        for port_no, port_state in list(state.get('ports', {}).items()):
+            port_no = int(port_no)
+            if port_no in self.dp.ports:
+                self.dp.ports[port_no].dyn_learn_ban_count = port_state.get(
+                    'learn_ban_count', 0)
+        for vid, vlan_state in list(state.get('vlans', {}).items()):
+            vid = int(vid)
+            if vid in self.dp.vlans:
+                self.dp.vlans[vid].dyn_learn_ban_count = vlan_state.get(
+                    'learn_ban_count', 0)
+        self._restored_state = state
+
+    def _restore_state_flows(self, now):
+        """Reprogram hosts and neighbors from restored state, if any.
+
+        Hosts and neighbors that would since have expired are not restored.
+
+        Args:
+            now (float): seconds since epoch.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        state = self._restored_state
+        self._restored_state = None
+        ofmsgs = []
+        if not state:
+            return ofmsgs
+        for vid, vlan_state in list(state.get('vlans', {}).items()):
+            vid = int(vid)
+            if vid not in self.dp.vlans:
+                continue
+            vlan = self.dp.vlans[vid]
+            for eth_src, port_no, cache_time in vlan_state.get('hosts', []):
+                port = self.dp.ports.get(port_no, None)
+                if port is None or not port.running() or vlan not in port.vlans():
+                    continue
+                if not port.permanent_learn and now - cache_time > self.dp.timeout:
+                    continue
+                ofmsgs.extend(self.host_manager.learn_host_on_vlan_port(
+                    port, vlan, eth_src))
+            for ip_gw, eth_src, cache_time, host_route in vlan_state.get('neighbors', []):
+                ip_gw = ipaddress.ip_address(ip_gw)
+                host = vlan.host_cache.get(eth_src, None)
+                if (host is None or
+                        ip_gw.version not in self.route_manager_by_ipv or
+                        now - cache_time > self.dp.arp_neighbor_timeout):
+                    continue
+                route_manager = self.route_manager_by_ipv[ip_gw.version]
+                ofmsgs.extend(route_manager.restore_neighbor(
+                    vlan, host.port, eth_src, ip_gw, host_route))
+        self.logger.info(
+            'restored %u hosts' % sum(
+                [vlan.hosts_count() for vlan in list(self.dp.vlans.values())]))
+        return ofmsgs
+
     def _get_acl_config_changes(self, new_dp):
         """Detect any config changes to ACLs.
 
@@ -1072,7 +1347,7 @@ class Valve(object):
         ofmsgs = []
 
         if all_ports_changed:
-            self.dp = new_dp
+            self._update_dp(new_dp)
         else:
             cold_start = False
             if deleted_ports:
@@ -1085,7 +1360,9 @@ class Valve(object):
                     ofmsgs.extend(self._del_vlan(vlan))
             if changed_ports:
                 ofmsgs.extend(self.ports_delete(self.dp.dp_id, changed_ports))
-            self.dp = new_dp
+            # Groups on the datapath are kept, so keep tracking them.
+            new_dp.groups = self.dp.groups
+            self._update_dp(new_dp)
             if changed_vlans:
                 self.logger.info('VLANs changed/added: %s' % changed_vlans)
                 for vid in changed_vlans:
@@ -1103,6 +1380,17 @@ class Valve(object):
 
         return cold_start, ofmsgs
 
+    def _update_dp(self, new_dp):
+        """Replace dataplane configuration, and the group table managers use.
+
+        Args:
+            new_dp (DP): new dataplane configuration.
+        """
+        self.dp = new_dp
+        for route_manager in list(self.route_manager_by_ipv.values()):
+            route_manager.groups = self.dp.groups
+        self.flood_manager.groups = self.dp.groups
+
     def reload_config(self, new_dp):
         """Reload configuration new_dp.
 
@@ -1124,10 +1412,11 @@ class Valve(object):
         ofmsgs = []
         if self.dp.running:
             self.logger.info('reload configuration')
+            self.learn_cache.clear()
             cold_start, ofmsgs = self._apply_config_changes(
                 new_dp, self._get_config_changes(new_dp))
             if cold_start:
-                self.dp = new_dp
+                self._update_dp(new_dp)
                 ofmsgs = self.datapath_connect(
                     self.dp.dp_id, list(self.dp.ports.keys()))
         else:
@@ -1147,6 +1436,11 @@ class Valve(object):
         route_manager = self.route_manager_by_ipv[ip_dst.version]
         return route_manager.add_route(vlan, ip_gw, ip_dst)
 
+    def add_multipath_route(self, vlan, ip_gws, ip_dst, failover=False):
+        """Add route with one or more nexthops to VLAN routing table."""
+        route_manager = self.route_manager_by_ipv[ip_dst.version]
+        return route_manager.add_multipath_route(vlan, ip_gws, ip_dst, failover)
+
     def del_route(self, vlan, ip_dst):
         """Delete route from VLAN routing table."""
         route_manager = self.route_manager_by_ipv[ip_dst.version]
@@ -1189,31 +1483,54 @@ class Valve(object):
             }
 
     def flow_timeout(self, table_id, match):
+        """Handle an expired flow.
+
+        Args:
+            table_id (int): table ID of expired flow.
+            match (ryu.ofproto.ofproto_v1_3_parser.OFPMatch): match of expired flow.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        return self.flows_timeout([(table_id, match)])
+
+    def flows_timeout(self, flow_timeouts):
+        """Handle a batch of expired flows.
+
+        Source rule expiries are handled before destination rule expiries,
+        so a host whose source and destination rules both expired in the
+        same batch is not refreshed.
+
+        Args:
+            flow_timeouts (list): of table ID and OFPMatch of each expired flow.
+        Returns:
+            list: OpenFlow messages, if any.
+        """
+        host_table_ids = (
+            self.dp.tables['eth_src'].table_id, self.dp.tables['eth_dst'].table_id)
+        src_rule_expires = []
+        dst_rule_expires = []
+        dst_rule_expire_keys = set()
+        for table_id, match in flow_timeouts:
+            if table_id not in host_table_ids or 'vlan_vid' not in match:
+                continue
+            vid = match['vlan_vid'] & ~ofp.OFPVID_PRESENT
+            if vid not in self.dp.vlans:
+                continue
+            vlan = self.dp.vlans[vid]
+            if 'eth_src' in match and 'in_port' in match:
+                src_rule_expires.append(
+                    (vlan, match['in_port'], match['eth_src']))
+            elif 'eth_dst' in match:
+                eth_dst = match['eth_dst']
+                if (vid, eth_dst) not in dst_rule_expire_keys:
+                    dst_rule_expire_keys.add((vid, eth_dst))
+                    dst_rule_expires.append((vlan, eth_dst))
         ofmsgs = []
-        if table_id in (self.dp.tables['eth_src'].table_id, self.dp.tables['eth_dst'].table_id):
-            in_port = None
-            eth_src = None
-            eth_dst = None
-            vid = None
-            match_oxm_fields = match.to_jsondict()['OFPMatch']['oxm_fields']
-            for field in match_oxm_fields:
-                if isinstance(field, dict):
-                    value = field['OXMTlv']
-                    if value['field'] == 'eth_src':
-                        eth_src = value['value']
-                    if value['field'] == 'eth_dst':
-                        eth_dst = value['value']
-                    if value['field'] == 'vlan_vid':
-                        vid = value['value'] & ~ofp.OFPVID_PRESENT
-                    if value['field'] == 'in_port':
-                        in_port = value['value']
-            if eth_src and vid and in_port:
-                vlan = self.dp.vlans[vid]
-                ofmsgs.extend(
-                    self.host_manager.src_rule_expire(vlan, in_port, eth_src))
-            elif eth_dst and vid:
-                vlan = self.dp.vlans[vid]
-                ofmsgs.extend(self.host_manager.dst_rule_expire(vlan, eth_dst))
+        for vlan, in_port, eth_src in src_rule_expires:
+            ofmsgs.extend(
+                self.host_manager.src_rule_expire(vlan, in_port, eth_src))
+        for vlan, eth_dst in dst_rule_expires:
+            ofmsgs.extend(self.host_manager.dst_rule_expire(vlan, eth_dst))
         return ofmsgs
 
 
@@ -19,6 +19,7 @@
 
 from ryu.lib import mac
 from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
 
 try:
     import valve_of
@@ -50,6 +51,11 @@ class ValveFloodManager(object):
         self.stack = dp_stack
         self.use_group_table = use_group_table
         self.groups = groups
+        # Flood actions last built, by VID then input port number and
+        # exclude_unicast, with the flood ports they were built from.
+        self._flood_actions_cache = {}
+        # Flood ports that flood groups were last built from, by VID.
+        self._group_flood_ports_keys = {}
         self.stack_ports = [
             port for port in list(dp_ports.values()) if port.stack is not None]
         self.towards_root_stack_ports = []
@@ -73,12 +79,10 @@ class ValveFloodManager(object):
                 flood_acts.append(valve_of.output_port(port.number))
         return flood_acts
 
-    def _build_flood_local_rule_actions(self, vlan, exclude_unicast, in_port):
+    def _build_flood_local_rule_actions(self, tagged_ports, untagged_ports, in_port):
         flood_acts = []
-        tagged_ports = vlan.tagged_flood_ports(exclude_unicast)
         flood_acts.extend(self._build_flood_port_outputs(
             tagged_ports, in_port))
-        untagged_ports = vlan.untagged_flood_ports(exclude_unicast)
         if untagged_ports:
             flood_acts.append(valve_of.pop_vlan())
             flood_acts.extend(self._build_flood_port_outputs(
@@ -94,7 +98,7 @@ class ValveFloodManager(object):
     def _dp_is_root(self):
         return self.stack is not None and 'priority' in self.stack
 
-    def _build_flood_rule_actions(self, vlan, exclude_unicast, in_port):
+    def _build_flood_rule_actions(self, tagged_ports, untagged_ports, in_port):
         """Calculate flooding destinations based on this DP's position.
 
         If a standalone switch, then flood to local VLAN ports.
@@ -143,7 +147,7 @@ class ValveFloodManager(object):
         5: 1 2 3 4
         """
         local_flood_actions = self._build_flood_local_rule_actions(
-            vlan, exclude_unicast, in_port)
+            tagged_ports, untagged_ports, in_port)
         # If we're a standalone switch, then flood local VLAN
         if self.stack is None:
             return local_flood_actions
@@ -171,47 +175,115 @@ class ValveFloodManager(object):
         # towards the root.
         return toward_flood_actions
 
-    def _build_flood_rule_for_port(self, vlan, eth_dst, eth_dst_mask,
-                                   exclude_unicast, command, flood_priority,
-                                   port, preflood_acts):
+    @staticmethod
+    def _flood_ports_key(tagged_ports, untagged_ports):
+        return (
+            tuple([port.number for port in tagged_ports]),
+            tuple([port.number for port in untagged_ports]))
+
+    def _flood_rule_actions(self, vlan, exclude_unicast, ports, rebuild):
+        """Return flood actions for input ports, from cache if still current.
+
+        Actions depend on the VLAN's flood ports, so are rebuilt only for
+        input ports where those have changed since the actions were last
+        built (or have never been built).
+
+        Args:
+            vlan (vlan): VLAN to flood on.
+            exclude_unicast (bool): True if flooding to unknown unicast excluded.
+            ports (list): input ports.
+            rebuild (bool): True to rebuild actions for all input ports.
+        Returns:
+            dict: tuple of actions and command (None if unchanged), by input port number.
+        """
+        tagged_ports = vlan.tagged_flood_ports(exclude_unicast)
+        untagged_ports = vlan.untagged_flood_ports(exclude_unicast)
+        flood_ports_key = self._flood_ports_key(tagged_ports, untagged_ports)
+        vlan_cache = self._flood_actions_cache.setdefault(vlan.vid, {})
+        flood_actions = {}
+        for port in ports:
+            if port.number in flood_actions:
+                continue
+            cache_key = (port.number, exclude_unicast)
+            cached = vlan_cache.get(cache_key, None)
+            if cached is not None and cached[0] == flood_ports_key and not rebuild:
+                flood_actions[port.number] = (cached[1], None)
+                continue
+            command = ofp.OFPFC_ADD
+            if cached is not None and not rebuild:
+                command = ofp.OFPFC_MODIFY_STRICT
+            actions = self._build_flood_rule_actions(
+                tagged_ports, untagged_ports, port)
+            vlan_cache[cache_key] = (flood_ports_key, actions)
+            flood_actions[port.number] = (actions, command)
+        return flood_actions
+
+    def _build_flood_rules_for_ports(self, vlan, eth_dst, eth_dst_mask,
+                                     flood_priority, ports, flood_actions,
+                                     mirror=False):
         ofmsgs = []
-        match = self.flood_table.match(
-            vlan=vlan, in_port=port.number,
-            eth_dst=eth_dst, eth_dst_mask=eth_dst_mask)
-        flood_acts = self._build_flood_rule_actions(
-            vlan, exclude_unicast, port)
-        ofmsgs.append(self.flood_table.flowmod(
-            match=match,
-            command=command,
-            inst=[valve_of.apply_actions(preflood_acts + flood_acts)],
-            priority=flood_priority))
+        for port in ports:
+            flood_acts, command = flood_actions[port.number]
+            if command is None:
+                continue
+            preflood_acts = []
+            if mirror:
+                preflood_acts = [valve_of.output_port(port.mirror)]
+            match = self.flood_table.match(
+                vlan=vlan, in_port=port.number,
+                eth_dst=eth_dst, eth_dst_mask=eth_dst_mask)
+            ofmsgs.append(self.flood_table.flowmod(
+                match=match,
+                command=command,
+                inst=[valve_of.apply_actions(preflood_acts + flood_acts)],
+                priority=flood_priority))
         return ofmsgs
 
-    def _build_unmirrored_flood_rules(self, vlan, eth_dst, eth_dst_mask,
-                                      exclude_unicast, command, flood_priority):
-        ofmsgs = []
-        vlan_all_ports = []
-        vlan_all_ports.extend(vlan.flood_ports(vlan.get_ports(), exclude_unicast))
-        vlan_all_ports.extend(self.away_from_root_stack_ports)
-        vlan_all_ports.extend(self.towards_root_stack_ports)
-        for port in vlan_all_ports:
-            ofmsgs.extend(self._build_flood_rule_for_port(
-                vlan, eth_dst, eth_dst_mask,
-                exclude_unicast, command, flood_priority,
-                port, []))
-        return ofmsgs
+    @staticmethod
+    def _flood_actions_to_buckets(flood_acts):
+        """Return group buckets equivalent to a list of flood actions.
 
-    def _build_mirrored_flood_rules(self, vlan, eth_dst, eth_dst_mask,
-                                    exclude_unicast, command, flood_priority):
+        Each output gets its own bucket, with any preceding actions
+        (e.g. pop VLAN before output to untagged ports).
+        """
+        buckets = []
+        pre_output_acts = []
+        for flood_act in flood_acts:
+            if isinstance(flood_act, parser.OFPActionOutput):
+                buckets.append(valve_of.bucket(
+                    actions=pre_output_acts + [flood_act]))
+            else:
+                pre_output_acts.append(flood_act)
+        return buckets
+
+    def _build_port_flood_groups(self, vlan, exclude_unicast, flood_actions):
+        """Add or modify a flood group per input port, for changed flood actions.
+
+        Args:
+            vlan (vlan): VLAN to flood on.
+            exclude_unicast (bool): True if flooding to unknown unicast excluded.
+            flood_actions (dict): tuple of actions and command, by input port number.
+        Returns:
+            tuple: OpenFlow messages, and dict of tuple of group action and flow
+                command (None if flows need not change), by input port number.
+        """
         ofmsgs = []
-        mirrored_ports = vlan.mirrored_ports()
-        for port in mirrored_ports:
-            mirror_acts = [valve_of.output_port(port.mirror)]
-            ofmsgs.extend(self._build_flood_rule_for_port(
-                vlan, eth_dst, eth_dst_mask,
-                exclude_unicast, command, flood_priority,
-                port, mirror_acts))
-        return ofmsgs
+        group_actions = {}
+        for port_number, (flood_acts, command) in list(flood_actions.items()):
+            group_id = self.groups.group_id_from_key(
+                ('flood', vlan.vid, port_number, exclude_unicast))
+            flow_command = None
+            if command is not None:
+                group = self.groups.get_entry(
+                    group_id, self._flood_actions_to_buckets(flood_acts))
+                if command == ofp.OFPFC_ADD:
+                    ofmsgs.extend(group.add())
+                    flow_command = ofp.OFPFC_ADD
+                else:
+                    ofmsgs.append(group.modify())
+            group_actions[port_number] = (
+                [valve_of.group_act(group_id)], flow_command)
+        return (ofmsgs, group_actions)
 
     def _build_group_buckets(self, vlan, unicast_flood):
         buckets = []
@@ -227,6 +299,14 @@ class ValveFloodManager(object):
 
     def _build_group_flood_rules(self, vlan, modify, command):
         flood_priority = self.flood_priority
+        group_key = tuple([
+            self._flood_ports_key(
+                vlan.tagged_flood_ports(unicast_flood),
+                vlan.untagged_flood_ports(unicast_flood))
+            for unicast_flood in (False, vlan.unicast_flood)])
+        if modify and self._group_flood_ports_keys.get(vlan.vid, None) == group_key:
+            return []
+        self._group_flood_ports_keys[vlan.vid] = group_key
         broadcast_group = self.groups.get_entry(
             vlan.vid,
             self._build_group_buckets(vlan, False))
@@ -256,32 +336,79 @@ class ValveFloodManager(object):
             flood_priority += 1
         return ofmsgs
 
-    def _build_multiout_flood_rules(self, vlan, command):
+    def _build_multiout_flood_rules(self, vlan, rebuild):
+        """Add flood flows per input port, outputting directly or via a group per input port."""
         flood_priority = self.flood_priority
         ofmsgs = []
+        if rebuild:
+            self._flood_actions_cache[vlan.vid] = {}
+        mirrored_ports = vlan.mirrored_ports()
+        # Actions are the same for all destinations with the same exclude_unicast.
+        flood_actions_by_exclude_unicast = {}
         for unicast_eth_dst, eth_dst, eth_dst_mask in self.FLOOD_DSTS:
             if unicast_eth_dst and not vlan.unicast_flood:
                 continue
-            ofmsgs.extend(self._build_unmirrored_flood_rules(
-                vlan, eth_dst, eth_dst_mask,
-                unicast_eth_dst, command, flood_priority))
+            exclude_unicast = unicast_eth_dst
+            vlan_all_ports = []
+            vlan_all_ports.extend(vlan.flood_ports(vlan.get_ports(), exclude_unicast))
+            vlan_all_ports.extend(self.away_from_root_stack_ports)
+            vlan_all_ports.extend(self.towards_root_stack_ports)
+            if exclude_unicast not in flood_actions_by_exclude_unicast:
+                flood_actions = self._flood_rule_actions(
+                    vlan, exclude_unicast, vlan_all_ports + mirrored_ports, rebuild)
+                if self.use_group_table:
+                    group_ofmsgs, flood_actions = self._build_port_flood_groups(
+                        vlan, exclude_unicast, flood_actions)
+                    ofmsgs.extend(group_ofmsgs)
+                flood_actions_by_exclude_unicast[exclude_unicast] = flood_actions
+            flood_actions = flood_actions_by_exclude_unicast[exclude_unicast]
+            ofmsgs.extend(self._build_flood_rules_for_ports(
+                vlan, eth_dst, eth_dst_mask, flood_priority,
+                vlan_all_ports, flood_actions))
             flood_priority += 1
-            ofmsgs.extend(self._build_mirrored_flood_rules(
-                vlan, eth_dst, eth_dst_mask,
-                unicast_eth_dst, command, flood_priority))
+            ofmsgs.extend(self._build_flood_rules_for_ports(
+                vlan, eth_dst, eth_dst_mask, flood_priority,
+                mirrored_ports, flood_actions, mirror=True))
             flood_priority += 1
         return ofmsgs
 
+    def invalidate_port(self, port):
+        """Forget flood actions for an input port, as its flows were deleted.
+
+        Any flood groups for the input port are deleted and their IDs freed.
+
+        Args:
+            port (port): input port.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        for vid, vlan_cache in list(self._flood_actions_cache.items()):
+            for exclude_unicast in (False, True):
+                vlan_cache.pop((port.number, exclude_unicast), None)
+                ofmsgs.extend(self.groups.release(
+                    ('flood', vid, port.number, exclude_unicast)))
+        return ofmsgs
+
     def build_flood_rules(self, vlan, modify=False):
-        """Add flows to flood packets to unknown destinations on a VLAN."""
+        """Add flows to flood packets to unknown destinations on a VLAN.
+
+        Args:
+            vlan (vlan): VLAN to flood on.
+            modify (bool): if True, only add or modify flows whose actions
+                have changed since last built, otherwise (re)add all flows.
+        Returns:
+            list: OpenFlow messages.
+        """
         # TODO: group table support is still fairly uncommon, so
         # group tables are currently optional.
-        command = ofp.OFPFC_ADD
-        if modify:
-            command = ofp.OFPFC_MODIFY_STRICT
         if self.use_group_table:
             hairpin_ports = [port for port in vlan.get_ports() if port.hairpin]
-            # TODO: group tables for stacking and hairpin flooding modes.
+            # Stacking and hairpin flooding depend on the input port, so
+            # need a group per input port (see _build_port_flood_groups()).
             if self.stack is None and not hairpin_ports:
+                command = ofp.OFPFC_ADD
+                if modify:
+                    command = ofp.OFPFC_MODIFY_STRICT
                 return self._build_group_flood_rules(vlan, modify, command)
-        return self._build_multiout_flood_rules(vlan, command)
+        return self._build_multiout_flood_rules(vlan, not modify)
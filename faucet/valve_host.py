@@ -17,9 +17,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import time
 import random
 
+from collections import OrderedDict
+
 try:
     import valve_of
 except ImportError:
@@ -27,21 +30,160 @@ except ImportError:
 
 
 class HostCacheEntry(object):
+    """A host learned on a VLAN.
+
+    Entries are slotted as there is one per learned host; attributes
+    that follow from the port the host was learned on are not stored.
+    """
+
+    __slots__ = [
+        'eth_src',
+        'port',
+        'cache_time',
+        'expired',
+    ]
 
-    def __init__(self, eth_src, port, edge, permanent, now, expired=False):
+    def __init__(self, eth_src, port, now, expired=False):
         self.eth_src = eth_src
         self.port = port
-        self.edge = edge
-        self.permanent = permanent
         self.cache_time = now
         self.expired = expired
 
+    @property
+    def edge(self):
+        """bool: True if host learned on a non-stack port."""
+        return self.port.stack is None
+
+    @property
+    def permanent(self):
+        """bool: True if host learned on a permanent_learn port."""
+        return self.port.permanent_learn
+
+
+class LearnCache(object):
+    """Bounded cache of recently learned hosts, that expire after a timeout.
+
+    Used to drop packet ins that would only relearn a host that was
+    just learned (eg. more packets from that host arrived before its
+    eth_src flow was installed), before they are fully processed.
+    """
+
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._expiry_by_key = OrderedDict()
+
+    def __len__(self):
+        return len(self._expiry_by_key)
+
+    def _expire(self, now):
+        # Entries all have the same timeout, so oldest are first.
+        while self._expiry_by_key:
+            key, expiry = next(iter(self._expiry_by_key.items()))
+            if expiry > now:
+                break
+            del self._expiry_by_key[key]
+
+    def hit(self, key, now):
+        """Return True if key was recently added.
+
+        Args:
+            key (tuple): cache key.
+            now (float): current time.
+        Returns:
+            bool: True if key was added and has not expired.
+        """
+        expiry = self._expiry_by_key.get(key, None)
+        if expiry is None:
+            return False
+        if expiry <= now:
+            self._expire(now)
+            return False
+        return True
+
+    def add(self, key, now):
+        """Add a key, evicting the oldest key if the cache is full.
+
+        Args:
+            key (tuple): cache key.
+            now (float): current time.
+        """
+        if not self.max_size:
+            return
+        self._expiry_by_key.pop(key, None)
+        self._expire(now)
+        if len(self._expiry_by_key) >= self.max_size:
+            self._expiry_by_key.popitem(last=False)
+        self._expiry_by_key[key] = now + self.timeout
+
+    def clear(self):
+        """Remove all keys."""
+        self._expiry_by_key.clear()
+
+
+class EdgeHostIndex(object):
+    """Controller wide index of hosts learned on edge (non stack) ports.
+
+    Shared by all Valves, so that a DP receiving a packet from a host via
+    a stack port can find the edge DP that learned that host without
+    examining other DPs' host caches, and so that other DPs in a stack
+    can learn a host as soon as an edge DP does.
+    """
+
+    def __init__(self):
+        self._edge_hosts = {}
+        self._learned = []
+
+    def learn(self, dp_id, vid, eth_src, port_number):
+        """Record a host learned on an edge port.
+
+        Args:
+            dp_id (int): DPID of edge datapath.
+            vid (int): VLAN VID host learned on.
+            eth_src (str): MAC address of host.
+            port_number (int): edge port host learned on.
+        """
+        self._edge_hosts[(vid, eth_src)] = (dp_id, port_number)
+
+    def expire(self, dp_id, vid, eth_src):
+        """Remove a host, if it was last learned by a datapath.
+
+        Args:
+            dp_id (int): DPID of datapath host expired on.
+            vid (int): VLAN VID host learned on.
+            eth_src (str): MAC address of host.
+        """
+        edge_host = self._edge_hosts.get((vid, eth_src), None)
+        if edge_host is not None and edge_host[0] == dp_id:
+            del self._edge_hosts[(vid, eth_src)]
+
+    def edge_host(self, vid, eth_src):
+        """Return where a host was last learned on an edge port.
+
+        Args:
+            vid (int): VLAN VID host learned on.
+            eth_src (str): MAC address of host.
+        Returns:
+            tuple: DPID and port number of edge port (or None).
+        """
+        return self._edge_hosts.get((vid, eth_src), None)
+
+    def add_learned(self, dp_id, vid, eth_src):
+        """Queue a newly learned edge host, for other datapaths in a stack to learn."""
+        self._learned.append((dp_id, vid, eth_src))
+
+    def pop_learned(self):
+        """Return and clear queue of newly learned edge hosts."""
+        learned = self._learned
+        self._learned = []
+        return learned
+
 
 class ValveHostManager(object):
 
     def __init__(self, logger, eth_src_table, eth_dst_table,
                  learn_timeout, learn_jitter, learn_ban_timeout, low_priority, host_priority,
-                 use_idle_timeout):
+                 use_idle_timeout, edge_hosts):
         self.logger = logger
         self.eth_src_table = eth_src_table
         self.eth_dst_table = eth_dst_table
@@ -51,6 +193,7 @@ class ValveHostManager(object):
         self.low_priority = low_priority
         self.host_priority = host_priority
         self.use_idle_timeout = use_idle_timeout
+        self.edge_hosts = edge_hosts
 
     def temp_ban_host_learning_on_port(self, port):
         return self.eth_src_table.flowdrop(
@@ -92,17 +235,40 @@ class ValveHostManager(object):
 
         return ofmsgs
 
+    def _schedule_host_expiry(self, vlan, host_cache_entry):
+        """Schedule a check for expiry of a host, when it reaches learn_timeout."""
+        heapq.heappush(vlan.dyn_host_cache_expiry, (
+            host_cache_entry.cache_time + self.learn_timeout,
+            host_cache_entry.eth_src,
+            host_cache_entry.cache_time))
+
     def expire_hosts_from_vlan(self, vlan, now):
+        """Expire hosts that have reached learn_timeout.
+
+        Only hosts due for expiry are examined. Host expiry checks are
+        scheduled in order of deadline when a host is learned (so when a
+        host is relearned, the check scheduled for the earlier entry is
+        ignored), and when a host's src rule expires when using idle
+        timeouts. Permanently learned hosts are never scheduled.
+
+        Args:
+            vlan (VLAN): VLAN to expire hosts on.
+            now (float): current time.
+        """
         expired_hosts = []
-        for eth_src, host_cache_entry in list(vlan.host_cache.items()):
-            if not host_cache_entry.permanent:
-                host_cache_entry_age = now - host_cache_entry.cache_time
-                if host_cache_entry_age > self.learn_timeout:
-                    if not self.use_idle_timeout or host_cache_entry.expired:
-                        expired_hosts.append(eth_src)
+        expiry = vlan.dyn_host_cache_expiry
+        while expiry and expiry[0][0] < now:
+            _, eth_src, cache_time = heapq.heappop(expiry)
+            host_cache_entry = vlan.host_cache.get(eth_src, None)
+            if (host_cache_entry is None or
+                    host_cache_entry.cache_time != cache_time):
+                continue
+            if not self.use_idle_timeout or host_cache_entry.expired:
+                expired_hosts.append(eth_src)
         if expired_hosts:
             for eth_src in expired_hosts:
-                del vlan.host_cache[eth_src]
+                vlan.expire_cache_host(eth_src)
+                self.edge_hosts.expire(vlan.dp_id, vlan.vid, eth_src)
                 self.logger.info(
                     'expiring host %s from VLAN %u' % (eth_src, vlan.vid))
             self.logger.info(
@@ -182,13 +348,14 @@ class ValveHostManager(object):
                 inst=self.build_port_out_inst(vlan, port, port_number=valve_of.OFP_IN_PORT),
                 idle_timeout=learn_timeout))
 
-        host_cache_entry = HostCacheEntry(
-            eth_src,
-            port,
-            port.stack is None,
-            port.permanent_learn,
-            now)
-        vlan.host_cache[eth_src] = host_cache_entry
+        host_cache_entry = HostCacheEntry(eth_src, port, now)
+        vlan.add_cache_host(host_cache_entry)
+        if not host_cache_entry.permanent:
+            self._schedule_host_expiry(vlan, host_cache_entry)
+        if host_cache_entry.edge:
+            self.edge_hosts.learn(vlan.dp_id, vlan.vid, eth_src, in_port)
+        else:
+            self.edge_hosts.expire(vlan.dp_id, vlan.vid, eth_src)
 
         self.logger.info(
             'learned %s on %s on VLAN %u (%u hosts total)' % (
@@ -204,7 +371,10 @@ class ValveHostManager(object):
         if eth_src in vlan.host_cache:
             host_cache_entry = vlan.host_cache[eth_src]
             if host_cache_entry.port.number == in_port:
-                host_cache_entry.expired = True
+                if not host_cache_entry.expired:
+                    host_cache_entry.expired = True
+                    if not host_cache_entry.permanent:
+                        self._schedule_host_expiry(vlan, host_cache_entry)
                 self.logger.info('expired src_rule for host %s' % eth_src)
         return ofmsgs
 
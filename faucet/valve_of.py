@@ -17,6 +17,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import ipaddress
 
 from ryu.lib import ofctl_v1_3 as ofctl
@@ -575,44 +576,99 @@ def controller_pps_meterdel(datapath=None):
         meter_id=ofp.OFPM_CONTROLLER)
 
 
+def _flowmod_key(ofmsg):
+    """Return a key identifying the flows a FlowMod applies to."""
+    priority = ofmsg.priority
+    if ofmsg.command == ofp.OFPFC_DELETE:
+        priority = None
+    return (ofmsg.command, ofmsg.table_id, priority,
+            tuple(sorted(ofmsg.match.items())),
+            ofmsg.out_port, ofmsg.out_group, ofmsg.cookie, ofmsg.cookie_mask)
+
+
+def _flow_key(ofmsg):
+    """Return a key identifying the flow a FlowMod adds or strictly modifies."""
+    return (ofmsg.table_id, ofmsg.priority, tuple(sorted(ofmsg.match.items())))
+
+
 def valve_flowreorder(input_ofmsgs):
-    """Reorder flows for better OFA performance."""
-    # Move all deletes to be first, and add one barrier,
-    # while preserving order. Platforms that do parallel delete
-    # will perform better and platforms that don't will have
-    # at most only one barrier to deal with.
-    # TODO: further optimizations may be possible - for example,
-    # reorder adds to be in priority order.
-    delete_ofmsgs = []
-    groupadd_ofmsgs = []
-    nondelete_ofmsgs = []
+    """Reorder flows for better OFA performance.
+
+    Messages are sent as:
+        - flow and group deletes (duplicates removed), then a barrier.
+        - group adds (last add per group ID), then a barrier.
+        - group modifies and other messages (e.g. meters), in original order.
+        - flow adds (last add per table, priority and match), per table
+          in descending priority order. Modifies of an added flow follow
+          in original order relative to its add.
+        - other flow modifies and messages to run after adds (e.g. packet outs),
+          in original order.
+
+    Platforms that do parallel delete will perform better and platforms that
+    don't will have at most two barriers to deal with. Adding flows in priority
+    order avoids some hardware pipelines having to move entries to make room.
+
+    Args:
+        input_ofmsgs (list): OpenFlow messages, in order generated.
+    Returns:
+        list: OpenFlow messages, in order to send.
+    """
+    delete_ofmsgs = collections.OrderedDict()
+    groupadd_ofmsgs = collections.OrderedDict()
+    other_ofmsgs = []
+    flow_ofmsgs = collections.OrderedDict()
+    flowadd_keys = set()
+    late_ofmsgs = []
     for ofmsg in input_ofmsgs:
-        if is_flowdel(ofmsg) or is_groupdel(ofmsg):
-            delete_ofmsgs.append(ofmsg)
+        if is_flowmod(ofmsg):
+            if is_flowdel(ofmsg):
+                delete_ofmsgs.setdefault(_flowmod_key(ofmsg), ofmsg)
+                continue
+            flow_key = _flow_key(ofmsg)
+            key_ofmsgs = flow_ofmsgs.setdefault(flow_key, [])
+            if ofmsg.command == ofp.OFPFC_ADD:
+                # A later add of the same flow replaces an earlier one.
+                key_ofmsgs[:] = [
+                    key_ofmsg for key_ofmsg in key_ofmsgs
+                    if key_ofmsg.command != ofp.OFPFC_ADD]
+                flowadd_keys.add(flow_key)
+            else:
+                late_ofmsgs.append(ofmsg)
+            key_ofmsgs.append(ofmsg)
+        elif is_groupdel(ofmsg):
+            delete_ofmsgs.setdefault(('group', ofmsg.group_id), ofmsg)
         elif is_groupadd(ofmsg):
-            # The same group_id may be deleted/added multiple times
-            # To avoid group_mod_failed/group_exists error, if the
-            # same group_id is already in groupadd_ofmsgs I replace
-            # it instead of appending it (the last groupadd in
-            # input_ofmsgs is the only one sent to the switch)
-            # TODO: optimize the provisioning to avoid having the
-            # same group_id multiple times in input_ofmsgs
-            new_group_id = True
-            for i, groupadd_ofmsg in enumerate(groupadd_ofmsgs):
-                if groupadd_ofmsg.group_id == ofmsg.group_id:
-                    groupadd_ofmsgs[i] = ofmsg
-                    new_group_id = False
-                    break
-            if new_group_id:
-                groupadd_ofmsgs.append(ofmsg)
+            # The same group_id may be deleted/added multiple times.
+            # To avoid group_mod_failed/group_exists error, only the
+            # last groupadd for a group_id is sent to the switch.
+            groupadd_ofmsgs[ofmsg.group_id] = ofmsg
+        elif isinstance(ofmsg, parser.OFPBarrierRequest):
+            continue
+        elif isinstance(ofmsg, parser.OFPPacketOut):
+            late_ofmsgs.append(ofmsg)
         else:
-            nondelete_ofmsgs.append(ofmsg)
+            other_ofmsgs.append(ofmsg)
+    flowadd_keys_by_table = collections.defaultdict(list)
+    for flow_key in flow_ofmsgs:
+        if flow_key in flowadd_keys:
+            flowadd_keys_by_table[flow_key[0]].append(flow_key)
+    sorted_flowadd_ofmsgs = []
+    for table_id in sorted(flowadd_keys_by_table.keys()):
+        for flow_key in sorted(
+                flowadd_keys_by_table[table_id], key=lambda flow_key: -flow_key[1]):
+            sorted_flowadd_ofmsgs.extend(flow_ofmsgs[flow_key])
+    late_ofmsgs = [
+        ofmsg for ofmsg in late_ofmsgs
+        if not is_flowmod(ofmsg) or _flow_key(ofmsg) not in flowadd_keys]
+    after_group_ofmsgs = other_ofmsgs + sorted_flowadd_ofmsgs + late_ofmsgs
     output_ofmsgs = []
     if delete_ofmsgs:
-        output_ofmsgs.extend(delete_ofmsgs)
-        output_ofmsgs.append(barrier())
+        output_ofmsgs.extend(list(delete_ofmsgs.values()))
+        if groupadd_ofmsgs or after_group_ofmsgs:
+            output_ofmsgs.append(barrier())
     if groupadd_ofmsgs:
-        output_ofmsgs.extend(groupadd_ofmsgs)
-        output_ofmsgs.append(barrier())
-    output_ofmsgs.extend(nondelete_ofmsgs)
+        output_ofmsgs.extend(list(groupadd_ofmsgs.values()))
+        if after_group_ofmsgs:
+            output_ofmsgs.append(barrier())
+    output_ofmsgs.extend(after_group_ofmsgs)
     return output_ofmsgs
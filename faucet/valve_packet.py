@@ -18,6 +18,7 @@
 # limitations under the License.
 
 import ipaddress
+import struct
 
 from ryu.lib import mac
 from ryu.lib.packet import arp, bpdu, ethernet, icmp, icmpv6, ipv4, ipv6, slow, stream_parser, packet, vlan
@@ -39,7 +40,9 @@ IPV6_ALL_ROUTERS_MCAST = '33:33:00:00:00:02'
 IPV6_LINK_LOCAL = ipaddress.IPv6Network(btos('fe80::/10'))
 IPV6_ALL_NODES = ipaddress.IPv6Address(btos('ff02::1'))
 IPV6_MAX_HOP_LIM = 255
-
+ETH_HEADER = struct.Struct('!6s6sH')
+VLAN_HEADER = struct.Struct('!HH')
+VLAN_VID_MASK = 0x0fff
 
 
 def mac_byte_mask(mask_bytes=0):
@@ -119,6 +122,47 @@ def parse_packet_in_pkt(data, max_len):
     return (pkt, eth_pkt, vlan_vid, eth_type)
 
 
+def mac_bytes_to_str(mac_bytes):
+    """Return a MAC address string from its packed form.
+
+    Args:
+        mac_bytes (bytes): 6 byte packed MAC address.
+    Returns:
+        str: MAC address (lower case, colon separated).
+    """
+    return '%02x:%02x:%02x:%02x:%02x:%02x' % struct.unpack('6B', mac_bytes)
+
+
+def parse_packet_in_header(data):
+    """Decode Ethernet/VLAN header of a packet in, without a full parse.
+
+    Header fields are unpacked directly from the packet in buffer, so
+    that the common case (learning) does not require building packet
+    objects.
+
+    Args:
+        data (bytearray): packet data from dataplane.
+    Returns:
+        str: source Ethernet MAC address (or None if unparseable).
+        str: destination Ethernet MAC address.
+        int: VLAN VID (or None if no VLAN header present).
+        int: Ethernet type of packet (inside VLAN)
+    """
+    if len(data) < ETH_HEADER.size:
+        return (None, None, None, None)
+    eth_dst, eth_src, eth_type = ETH_HEADER.unpack_from(data)
+    vlan_vid = None
+    # See parse_packet_in_pkt(); VLAN header expected to be present.
+    if eth_type == ether.ETH_TYPE_8021Q:
+        if len(data) < ETH_VLAN_HEADER_SIZE:
+            return (None, None, None, None)
+        tci, eth_type = VLAN_HEADER.unpack_from(data, ETH_HEADER.size)
+        vlan_vid = tci & VLAN_VID_MASK
+    return (
+        mac_bytes_to_str(eth_src), mac_bytes_to_str(eth_dst),
+        vlan_vid, eth_type)
+
+
 def mac_addr_is_unicast(mac_addr):
     """Returns True if mac_addr is a unicast Ethernet address.
 
@@ -464,33 +508,64 @@ def router_advert(_vlan, vid, eth_src, eth_dst, src_ip, dst_ip,
     return pkt
 
 
+_IP_HEADER_SIZES = {}
+
+
 def ip_header_size(eth_type):
-    ip_header = build_pkt_header(
-        1, mac.BROADCAST_STR, mac.BROADCAST_STR, eth_type)
-    ip_header.serialize()
-    return len(ip_header.data)
+    """Return size of a VLAN tagged header, for a given Ethernet type.
+
+    Args:
+        eth_type (int): Ethernet type.
+    Returns:
+        int: header size in bytes.
+    """
+    if eth_type not in _IP_HEADER_SIZES:
+        ip_header = build_pkt_header(
+            1, mac.BROADCAST_STR, mac.BROADCAST_STR, eth_type)
+        ip_header.serialize()
+        _IP_HEADER_SIZES[eth_type] = len(ip_header.data)
+    return _IP_HEADER_SIZES[eth_type]
 
 
 class PacketMeta(object):
-    """Original, and parsed Ethernet packet metadata."""
+    """Original, and parsed Ethernet packet metadata.
 
-    def __init__(self, data, pkt, eth_pkt, port, vlan, eth_src, eth_dst, eth_type):
+    The packet is only parsed with ryu when a handler asks for it
+    (via pkt, or one of the reparse methods).
+    """
+
+    __slots__ = [
+        'data',
+        '_pkt',
+        'port',
+        'vlan',
+        'eth_src',
+        'eth_dst',
+        'eth_type',
+    ]
+
+    def __init__(self, data, port, vlan, eth_src, eth_dst, eth_type, pkt=None):
         self.data = data
-        self.pkt = pkt
-        self.eth_pkt = eth_pkt
+        self._pkt = pkt
         self.port = port
         self.vlan = vlan
         self.eth_src = eth_src
         self.eth_dst = eth_dst
         self.eth_type = eth_type
 
+    @property
+    def pkt(self):
+        """ryu.lib.packet.packet: packet, parsed to at least Ethernet/VLAN header."""
+        if self._pkt is None:
+            self.reparse(ETH_VLAN_HEADER_SIZE)
+        return self._pkt
+
     def reparse(self, max_len):
-        pkt, eth_pkt, vlan_vid, eth_type = parse_packet_in_pkt(
+        pkt, _, vlan_vid, eth_type = parse_packet_in_pkt(
             self.data, max_len)
         if pkt is None or vlan_vid is None or eth_type is None:
             return
-        self.pkt = pkt
-        self.eth_pkt = eth_pkt
+        self._pkt = pkt
 
     def reparse_all(self):
         self.reparse(0)
@@ -0,0 +1,305 @@
+"""Valve routing information base (RIB)."""
+
+# Copyright (C) 2015 Brad Cowie, Christopher Lorier and Joe Stringer.
+# Copyright (C) 2015 Research and Education Advanced Network New Zealand Ltd.
+# Copyright (C) 2015--2017 The Contributors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+
+import ipaddress
+
+
+class ValveRIB(object):
+    """Routes for one IP version, with longest prefix match lookup.
+
+    Behaves as a dict of destination ipaddress network to nexthop ipaddress
+    address, but stores prefixes and nexthops as ints, in one dict per
+    prefix length. Insert and delete are O(1), and longest prefix match
+    is O(number of prefix lengths in use) - at most the address length.
+    Routes are also indexed by nexthop. A route may have more than one
+    nexthop (see set_multipath()), in which case dict access returns the
+    first.
+    """
+
+    def __init__(self, ipv):
+        self.ipv = ipv
+        if ipv == 4:
+            self._network = ipaddress.IPv4Network
+            self._address = ipaddress.IPv4Address
+            self.max_prefixlen = 32
+        else:
+            self._network = ipaddress.IPv6Network
+            self._address = ipaddress.IPv6Address
+            self.max_prefixlen = 128
+        # dict of network int to nexthop int, by prefix length.
+        self._routes_by_prefixlen = {}
+        # prefix lengths in use, longest last.
+        self._prefixlens = []
+        # set of (prefix length, network int), by nexthop int.
+        self._prefixes_by_ip_gw = {}
+        # (prefix length, network int) of routes not programmed in the FIB.
+        self._suppressed = set()
+        # tuple of all nexthop ints and whether failover, by (prefix length, network int),
+        # for routes with more than one nexthop.
+        self._multipath = {}
+        # number of single nexthop routes, by nexthop int.
+        self._nexthop_refs = {}
+        self._len = 0
+
+    @staticmethod
+    def _prefix(ip_dst):
+        return (ip_dst.prefixlen, int(ip_dst.network_address))
+
+    def _ip_dst(self, prefixlen, network):
+        return self._network((network, prefixlen))
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, ip_dst):
+        prefixlen, network = self._prefix(ip_dst)
+        routes = self._routes_by_prefixlen.get(prefixlen, None)
+        return routes is not None and network in routes
+
+    def __getitem__(self, ip_dst):
+        prefixlen, network = self._prefix(ip_dst)
+        try:
+            return self._address(self._routes_by_prefixlen[prefixlen][network])
+        except KeyError:
+            raise KeyError(ip_dst)
+
+    def __setitem__(self, ip_dst, ip_gw):
+        self._set_route(ip_dst, (int(ip_gw),), False)
+
+    def __delitem__(self, ip_dst):
+        prefix = self._prefix(ip_dst)
+        prefixlen, network = prefix
+        routes = self._routes_by_prefixlen.get(prefixlen, None)
+        if routes is None or network not in routes:
+            raise KeyError(ip_dst)
+        self._unindex_prefix(routes.pop(network), prefix)
+        self._suppressed.discard(prefix)
+        self._len -= 1
+        if not routes:
+            del self._routes_by_prefixlen[prefixlen]
+            self._prefixlens.remove(prefixlen)
+
+    def _set_route(self, ip_dst, ip_gw_ints, failover):
+        prefix = self._prefix(ip_dst)
+        prefixlen, network = prefix
+        if prefixlen not in self._routes_by_prefixlen:
+            self._routes_by_prefixlen[prefixlen] = {}
+            bisect.insort(self._prefixlens, prefixlen)
+        routes = self._routes_by_prefixlen[prefixlen]
+        if network in routes:
+            self._unindex_prefix(routes[network], prefix)
+        else:
+            self._len += 1
+        routes[network] = ip_gw_ints[0]
+        if len(ip_gw_ints) > 1:
+            self._multipath[prefix] = (ip_gw_ints, failover)
+        else:
+            ip_gw_int = ip_gw_ints[0]
+            self._nexthop_refs[ip_gw_int] = self._nexthop_refs.get(ip_gw_int, 0) + 1
+        for ip_gw_int in ip_gw_ints:
+            if ip_gw_int not in self._prefixes_by_ip_gw:
+                self._prefixes_by_ip_gw[ip_gw_int] = set()
+            self._prefixes_by_ip_gw[ip_gw_int].add(prefix)
+
+    def _unindex_prefix(self, ip_gw_int, prefix):
+        ip_gw_ints = (ip_gw_int,)
+        if prefix in self._multipath:
+            ip_gw_ints, _ = self._multipath.pop(prefix)
+        else:
+            self._nexthop_refs[ip_gw_int] -= 1
+            if not self._nexthop_refs[ip_gw_int]:
+                del self._nexthop_refs[ip_gw_int]
+        for ip_gw_int in ip_gw_ints:
+            prefixes = self._prefixes_by_ip_gw[ip_gw_int]
+            prefixes.discard(prefix)
+            if not prefixes:
+                del self._prefixes_by_ip_gw[ip_gw_int]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, ip_dst, default=None):
+        """Return nexthop for a destination, or default if no route."""
+        if ip_dst in self:
+            return self[ip_dst]
+        return default
+
+    def keys(self):
+        """Return list of destinations."""
+        return [ip_dst for ip_dst, _ in self.items()]
+
+    def values(self):
+        """Return list of nexthops (one per route)."""
+        return [ip_gw for _, ip_gw in self.items()]
+
+    def items(self):
+        """Return list of destination, nexthop tuples."""
+        items = []
+        for prefixlen in self._prefixlens:
+            for network, ip_gw_int in list(self._routes_by_prefixlen[prefixlen].items()):
+                items.append(
+                    (self._ip_dst(prefixlen, network), self._address(ip_gw_int)))
+        return items
+
+    def longest_match(self, ip_addr):
+        """Return the most specific route for an address.
+
+        Args:
+            ip_addr (ipaddress.ip_address): address to look up.
+        Returns:
+            tuple: destination and nexthop, or None if no route matches.
+        """
+        ip_int = int(ip_addr)
+        for prefixlen in reversed(self._prefixlens):
+            host_bits = self.max_prefixlen - prefixlen
+            network = (ip_int >> host_bits) << host_bits
+            ip_gw_int = self._routes_by_prefixlen[prefixlen].get(network, None)
+            if ip_gw_int is not None:
+                return (self._ip_dst(prefixlen, network), self._address(ip_gw_int))
+        return None
+
+    def set_multipath(self, ip_dst, ip_gws, failover=False):
+        """Add or replace a route with one or more nexthops.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination.
+            ip_gws (list): nexthops, in order of preference if failover.
+            failover (bool): True if nexthops are backups for the first,
+                rather than all used to share load.
+        """
+        self._set_route(ip_dst, tuple([int(ip_gw) for ip_gw in ip_gws]), failover)
+
+    def is_multipath(self, ip_dst):
+        """Return True if a route has more than one nexthop."""
+        return self._prefix(ip_dst) in self._multipath
+
+    def multipath(self, ip_dst):
+        """Return all nexthops of a route.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination.
+        Returns:
+            tuple: list of nexthops, and True if they are failover nexthops.
+        """
+        prefix = self._prefix(ip_dst)
+        if prefix in self._multipath:
+            ip_gw_ints, failover = self._multipath[prefix]
+            return ([self._address(ip_gw_int) for ip_gw_int in ip_gw_ints], failover)
+        return ([self[ip_dst]], False)
+
+    def covering_route(self, ip_dst):
+        """Return the most specific route that strictly contains a destination.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination.
+        Returns:
+            tuple: covering destination and nexthop, or None if not covered.
+        """
+        prefixlen, network = self._prefix(ip_dst)
+        for cover_prefixlen in reversed(self._prefixlens):
+            if cover_prefixlen >= prefixlen:
+                continue
+            host_bits = self.max_prefixlen - cover_prefixlen
+            cover_network = (network >> host_bits) << host_bits
+            ip_gw_int = self._routes_by_prefixlen[cover_prefixlen].get(cover_network, None)
+            if ip_gw_int is not None:
+                return (
+                    self._ip_dst(cover_prefixlen, cover_network), self._address(ip_gw_int))
+        return None
+
+    def covered_routes(self, ip_dst):
+        """Return routes strictly contained by a destination.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination.
+        Returns:
+            list: tuple, destination and nexthop of each covered route.
+        """
+        prefixlen, network = self._prefix(ip_dst)
+        covered = []
+        for covered_prefixlen in self._prefixlens:
+            if covered_prefixlen <= prefixlen:
+                continue
+            routes = self._routes_by_prefixlen[covered_prefixlen]
+            host_bits = self.max_prefixlen - covered_prefixlen
+            subnets = 1 << (covered_prefixlen - prefixlen)
+            if subnets < len(routes):
+                # Fewer possible subnets than routes, so look each up.
+                covered_networks = [
+                    network + (subnet << host_bits) for subnet in range(subnets)]
+                covered_networks = [
+                    covered_network for covered_network in covered_networks
+                    if covered_network in routes]
+            else:
+                cover_host_bits = self.max_prefixlen - prefixlen
+                covered_networks = [
+                    covered_network for covered_network in routes
+                    if covered_network >> cover_host_bits == network >> cover_host_bits]
+            for covered_network in covered_networks:
+                covered.append((
+                    self._ip_dst(covered_prefixlen, covered_network),
+                    self._address(routes[covered_network])))
+        return covered
+
+    def is_suppressed(self, ip_dst):
+        """Return True if a route is not programmed in the FIB."""
+        return self._prefix(ip_dst) in self._suppressed
+
+    def set_suppressed(self, ip_dst, suppressed):
+        """Set whether a route is not programmed in the FIB.
+
+        Args:
+            ip_dst (ipaddress.ip_network): destination of route.
+            suppressed (bool): True if route not programmed in the FIB.
+        """
+        if suppressed:
+            self._suppressed.add(self._prefix(ip_dst))
+        else:
+            self._suppressed.discard(self._prefix(ip_dst))
+
+    def fib_len(self):
+        """Return number of routes programmed in the FIB."""
+        return self._len - len(self._suppressed)
+
+    def ip_gws(self):
+        """Return list of all nexthops in use."""
+        return [self._address(ip_gw_int) for ip_gw_int in self._prefixes_by_ip_gw]
+
+    def ip_dsts_via(self, ip_gw):
+        """Return list of destinations routed via a nexthop.
+
+        Args:
+            ip_gw (ipaddress.ip_address): nexthop.
+        Returns:
+            list: destination networks.
+        """
+        prefixes = self._prefixes_by_ip_gw.get(int(ip_gw), ())
+        return [self._ip_dst(prefixlen, network) for prefixlen, network in prefixes]
+
+    def nexthop_refs(self, ip_gw):
+        """Return number of single nexthop routes via a nexthop.
+
+        These routes share the nexthop's group, if group tables are used.
+        """
+        return self._nexthop_refs.get(int(ip_gw), 0)
+
+    def has_ip_gw(self, ip_gw):
+        """Return True if any route uses a nexthop."""
+        return int(ip_gw) in self._prefixes_by_ip_gw
@@ -17,6 +17,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import time
 
 import ipaddress
@@ -25,25 +26,30 @@ from ryu.lib import mac
 from ryu.lib.packet import arp, icmp, icmpv6, ipv4, ipv6
 from ryu.ofproto import ether
 from ryu.ofproto import inet
+from ryu.ofproto import ofproto_v1_3 as ofp
 
 try:
     import valve_of
     import valve_packet
+    import valve_util
     from valve_util import btos
 except ImportError:
     from faucet import valve_of
     from faucet import valve_packet
+    from faucet import valve_util
     from faucet.valve_util import btos
 
 
 class NextHop(object):
     """Describes a directly connected (at layer 2) nexthop."""
 
-    def __init__(self, eth_src, now):
+    def __init__(self, eth_src, now, port=None):
         self.eth_src = eth_src
+        self.port = port
         self.cache_time = now
         self.last_retry_time = None
         self.resolve_retries = 0
+        self.next_resolve_time = None
 
 
 class ValveRouteManager(object):
@@ -59,7 +65,8 @@ class ValveRouteManager(object):
                  max_hosts_per_resolve_cycle, max_host_fib_retry_count,
                  max_resolve_backoff_time, proactive_learn, dec_ttl,
                  fib_table, vip_table, eth_src_table, eth_dst_table, flood_table,
-                 route_priority, routers, use_group_table, groups):
+                 route_priority, routers, use_group_table, groups,
+                 fib_compression=False):
         self.logger = logger
         self.arp_neighbor_timeout = arp_neighbor_timeout
         self.max_hosts_per_resolve_cycle = max_hosts_per_resolve_cycle
@@ -76,6 +83,7 @@ class ValveRouteManager(object):
         self.routers = routers
         self.use_group_table = use_group_table
         self.groups = groups
+        self.fib_compression = fib_compression
 
     @staticmethod
     def _vlan_vid(vlan, port):
@@ -90,15 +98,22 @@ class ValveRouteManager(object):
     def _vlan_nexthop_cache(self, vlan):
         return vlan.neigh_cache_by_ipv(self.IPV)
 
+    def _vlan_nexthop_resolve_queue(self, vlan):
+        return vlan.neigh_resolve_by_ipv(self.IPV)
+
     def _vlan_nexthop_cache_entry(self, vlan, ip_gw):
         nexthop_cache = self._vlan_nexthop_cache(vlan)
         if ip_gw in nexthop_cache:
             return nexthop_cache[ip_gw]
         return None
 
+    @staticmethod
+    def _nexthop_group_key(vlan, ip_gw):
+        return ('nexthop', vlan.vid, ip_gw)
+
     def _group_id_from_ip_gw(self, vlan, resolved_ip_gw):
-        return self.groups.group_id_from_str(
-            ''.join((str(vlan), str(resolved_ip_gw))))
+        return self.groups.group_id_from_key(
+            self._nexthop_group_key(vlan, resolved_ip_gw))
 
     def _neighbor_resolver_pkt(self, vlan, vid, faucet_vip, ip_gw):
         pass
@@ -122,7 +137,8 @@ class ValveRouteManager(object):
         return self.fib_table.match(vlan=vlan, eth_type=self.ETH_TYPE, nw_dst=ip_dst)
 
     def _route_priority(self, ip_dst):
-        prefixlen = ipaddress.ip_network(ip_dst).prefixlen
+        # An address (rather than a network) is a host route.
+        prefixlen = getattr(ip_dst, 'prefixlen', ip_dst.max_prefixlen)
         return self.route_priority + prefixlen
 
     def _routed_vlans(self, vlan):
@@ -166,6 +182,8 @@ class ValveRouteManager(object):
 
     def add_faucet_vip(self, vlan, faucet_vip):
         ofmsgs = []
+        # Configured routes may now have a resolvable gateway.
+        self._add_unresolved_nexthops(vlan, self._vlan_ip_gws(vlan))
         max_prefixlen = faucet_vip.ip.max_prefixlen
         faucet_vip_host = self._host_from_faucet_vip(faucet_vip)
         priority = self.route_priority + max_prefixlen
@@ -187,8 +205,14 @@ class ValveRouteManager(object):
                 'Adding new route %s via %s (%s) on VLAN %u' % (
                     ip_dst, ip_gw, eth_dst, vlan.vid))
         if self.use_group_table:
-            inst = [valve_of.apply_actions([valve_of.group_act(
-                group_id=self._group_id_from_ip_gw(vlan, ip_gw))])]
+            group_id = self._group_id_from_ip_gw(vlan, ip_gw)
+            if group_id not in self.groups.entries:
+                # Group may have been released while no routes used it.
+                nexthop_cache_entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
+                if nexthop_cache_entry is not None and nexthop_cache_entry.port is not None:
+                    ofmsgs.extend(self._update_nexthop_group(
+                        vlan, ip_gw, nexthop_cache_entry.port, eth_dst))
+            inst = [valve_of.apply_actions([valve_of.group_act(group_id=group_id)])]
         else:
             inst = [valve_of.apply_actions(self._nexthop_actions(eth_dst, vlan)),
                     valve_of.goto_table(self.eth_dst_table)]
@@ -198,27 +222,164 @@ class ValveRouteManager(object):
                 in_match, priority=self._route_priority(ip_dst), inst=inst))
         return ofmsgs
 
-    def _update_nexthop_cache(self, vlan, eth_src, ip_gw):
+    def _update_nexthop_cache(self, vlan, eth_src, ip_gw, port=None):
         now = time.time()
-        nexthop = NextHop(eth_src, now)
+        nexthop = NextHop(eth_src, now, port)
         nexthop_cache = self._vlan_nexthop_cache(vlan)
         nexthop_cache[ip_gw] = nexthop
+        if eth_src is None:
+            self._schedule_nexthop_resolve(vlan, ip_gw, nexthop, now)
+        else:
+            self._schedule_nexthop_resolve(
+                vlan, ip_gw, nexthop, now + self.arp_neighbor_timeout)
 
-    def _nexthop_group_buckets(self, vlan, port, eth_src):
+    def _schedule_nexthop_resolve(self, vlan, ip_gw, nexthop, resolve_time):
+        """Schedule a nexthop to be re/resolved.
+
+        Any earlier schedule for this nexthop is superseded.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            ip_gw (ipaddress.ip_address): IP address of nexthop.
+            nexthop (NextHop): nexthop cache entry.
+            resolve_time (float): when to resolve, seconds since epoch.
+        """
+        nexthop.next_resolve_time = resolve_time
+        heapq.heappush(
+            self._vlan_nexthop_resolve_queue(vlan), (resolve_time, ip_gw))
+
+    def _nexthop_port_actions(self, vlan, port, eth_src):
         actions = self._nexthop_actions(eth_src, vlan)
         if not vlan.port_is_tagged(port):
             actions.append(valve_of.pop_vlan())
         actions.append(valve_of.output_port(port.number))
-        buckets = [valve_of.bucket(actions=actions)]
+        return actions
+
+    def _nexthop_group_buckets(self, vlan, port, eth_src):
+        buckets = [valve_of.bucket(
+            actions=self._nexthop_port_actions(vlan, port, eth_src))]
         return buckets
 
-    def _update_nexthop_group(self, is_updated, resolved_ip_gw,
-                              vlan, port, eth_src):
+    @staticmethod
+    def _multipath_group_key(vlan, ip_dst):
+        return ('multipath', vlan.vid, ip_dst)
+
+    def _multipath_group_id(self, vlan, ip_dst):
+        return self.groups.group_id_from_key(
+            self._multipath_group_key(vlan, ip_dst))
+
+    def _multipath_group_buckets(self, vlan, ip_gws, failover):
+        """Return group buckets for resolved nexthops of a multipath route.
+
+        Each bucket watches the port of its nexthop, so the switch stops
+        using a nexthop as soon as its port goes down.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            ip_gws (list): nexthops of route.
+            failover (bool): True if nexthops are in order of preference.
+        Returns:
+            list: OpenFlow group buckets.
+        """
+        buckets = []
+        weight = 1
+        if failover:
+            weight = 0
+        for ip_gw in ip_gws:
+            nexthop_cache_entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
+            if (nexthop_cache_entry is None or
+                    nexthop_cache_entry.eth_src is None or
+                    nexthop_cache_entry.port is None):
+                continue
+            port = nexthop_cache_entry.port
+            buckets.append(valve_of.bucket(
+                weight=weight,
+                watch_port=port.number,
+                actions=self._nexthop_port_actions(
+                    vlan, port, nexthop_cache_entry.eth_src)))
+        return buckets
+
+    def _add_resolved_multipath_route(self, vlan, ip_dst):
+        """Program a route with more than one nexthop.
+
+        With group tables, ECMP routes use a select group and failover
+        routes a fast failover group, of all resolved nexthops. Without
+        group tables, only the first resolved nexthop is used.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            ip_dst (ipaddress.ip_network): destination of route.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        ip_gws, failover = self._vlan_routes(vlan).multipath(ip_dst)
+        if not self.use_group_table:
+            for ip_gw in ip_gws:
+                eth_dst = self._cached_nexthop_eth_dst(vlan, ip_gw)
+                if eth_dst is not None:
+                    ofmsgs.extend(self._add_resolved_route(
+                        vlan, ip_gw, ip_dst, eth_dst, False))
+                    break
+            return ofmsgs
+        buckets = self._multipath_group_buckets(vlan, ip_gws, failover)
+        if not buckets:
+            return ofmsgs
+        group_id = self._multipath_group_id(vlan, ip_dst)
+        group_type = ofp.OFPGT_SELECT
+        if failover:
+            group_type = ofp.OFPGT_FF
+        is_updated = group_id in self.groups.entries
+        multipath_group = self.groups.get_entry(group_id, buckets, group_type)
+        if is_updated:
+            ofmsgs.append(multipath_group.modify())
+        else:
+            self.logger.info(
+                'Adding new route %s via %s on VLAN %u' % (
+                    ip_dst, ', '.join([str(ip_gw) for ip_gw in ip_gws]), vlan.vid))
+            ofmsgs.extend(multipath_group.add())
+            inst = [valve_of.apply_actions([valve_of.group_act(group_id=group_id)])]
+            for routed_vlan in self._routed_vlans(vlan):
+                in_match = self._route_match(routed_vlan, ip_dst)
+                ofmsgs.append(self.fib_table.flowmod(
+                    in_match, priority=self._route_priority(ip_dst), inst=inst))
+        return ofmsgs
+
+    def _del_multipath_group(self, vlan, ip_dst):
+        return self.groups.release(self._multipath_group_key(vlan, ip_dst))
+
+    def _del_nexthop_group(self, vlan, ip_gw):
+        """Delete the group of a nexthop, if no longer used by any route.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            ip_gw (ipaddress.ip_address): IP address of nexthop.
+        Returns:
+            list: OpenFlow messages.
+        """
+        if self._vlan_routes(vlan).nexthop_refs(ip_gw):
+            return []
+        return self.groups.release(self._nexthop_group_key(vlan, ip_gw))
+
+    def _update_nexthop_group(self, vlan, resolved_ip_gw, port, eth_src):
+        """Add or update the group of a nexthop, if used by any route.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            resolved_ip_gw (ipaddress.ip_address): IP address of nexthop.
+            port (port): port for nexthop.
+            eth_src (str): MAC address for nexthop.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        if not self._vlan_routes(vlan).nexthop_refs(resolved_ip_gw):
+            return ofmsgs
         group_id = self._group_id_from_ip_gw(vlan, resolved_ip_gw)
+        is_updated = group_id in self.groups.entries
         buckets = self._nexthop_group_buckets(vlan, port, eth_src)
         nexthop_group = self.groups.get_entry(
             group_id, buckets)
-        ofmsgs = []
         if is_updated:
             ofmsgs.append(nexthop_group.modify())
         else:
@@ -238,6 +399,8 @@ class ValveRouteManager(object):
         """
         ofmsgs = []
         cached_eth_dst = self._cached_nexthop_eth_dst(vlan, resolved_ip_gw)
+        # Multipath routes are built from the cache, so update it first.
+        self._update_nexthop_cache(vlan, eth_src, resolved_ip_gw, port)
 
         if cached_eth_dst != eth_src:
             is_updated = cached_eth_dst is not None
@@ -245,15 +408,17 @@ class ValveRouteManager(object):
             if self.use_group_table:
                 ofmsgs.extend(
                     self._update_nexthop_group(
-                        is_updated, resolved_ip_gw,
-                        vlan, port, eth_src))
+                        vlan, resolved_ip_gw, port, eth_src))
             routes = self._vlan_routes(vlan)
-            for ip_dst, ip_gw in list(routes.items()):
-                if ip_gw == resolved_ip_gw:
+            for ip_dst in routes.ip_dsts_via(resolved_ip_gw):
+                if routes.is_suppressed(ip_dst):
+                    continue
+                if routes.is_multipath(ip_dst):
+                    ofmsgs.extend(self._add_resolved_multipath_route(vlan, ip_dst))
+                else:
                     ofmsgs.extend(self._add_resolved_route(
-                        vlan, ip_gw, ip_dst, eth_src, is_updated))
+                        vlan, resolved_ip_gw, ip_dst, eth_src, is_updated))
 
-        self._update_nexthop_cache(vlan, eth_src, resolved_ip_gw)
         return ofmsgs
 
     def _vlan_ip_gws(self, vlan):
@@ -266,57 +431,81 @@ class ValveRouteManager(object):
         """
         routes = self._vlan_routes(vlan)
         ip_gws = []
-        for ip_gw in set(routes.values()):
+        for ip_gw in routes.ip_gws():
             for faucet_vip in vlan.faucet_vips_by_ipv(self.IPV):
                 if ip_gw in faucet_vip.network:
                     ip_gws.append((ip_gw, faucet_vip))
         return ip_gws
 
+    def _schedule_new_ip_gw(self, vlan, ip_gw):
+        """Schedule resolution of a nexthop that is newly a gateway.
+
+        Args:
+           vlan (vlan): VLAN containing this RIB/FIB.
+           ip_gw (ipaddress.ip_address): IP address of nexthop.
+        """
+        nexthop_cache_entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
+        if nexthop_cache_entry is None:
+            self._update_nexthop_cache(vlan, None, ip_gw)
+        elif nexthop_cache_entry.next_resolve_time is None:
+            resolve_time = time.time()
+            if nexthop_cache_entry.eth_src is not None:
+                resolve_time = nexthop_cache_entry.cache_time + self.arp_neighbor_timeout
+            self._schedule_nexthop_resolve(
+                vlan, ip_gw, nexthop_cache_entry, resolve_time)
+
     def _add_unresolved_nexthops(self, vlan, ip_gws):
-        """Populates any missing nexthop cache entries.
+        """Populates any missing nexthop cache entries, and schedules resolution.
 
         Args:
            vlan (vlan): VLAN containing this RIB/FIB.
            ip_gws (list): tuple, IP gateway and controller IP in same subnet.
         """
         for ip_gw, _ in ip_gws:
-            if self._vlan_nexthop_cache_entry(vlan, ip_gw) is None:
-                self._update_nexthop_cache(vlan, None, ip_gw)
-
-    def _retry_backoff(self, now, resolve_retries, last_retry_time):
-        backoff_seconds = min(
-            2**resolve_retries, self.max_resolve_backoff_time)
-        if now - last_retry_time > backoff_seconds:
-            return True
-        return False
+            self._schedule_new_ip_gw(vlan, ip_gw)
+
+    def _retry_backoff(self, resolve_retries):
+        """Return seconds to wait before retrying resolution of a nexthop."""
+        return min(2**resolve_retries, self.max_resolve_backoff_time)
 
-    def _vlan_unresolved_nexthops(self, vlan, ip_gws, now):
-        """Return unresolved or expired IP gateways, never tried/oldest first.
+    def _vlan_unresolved_nexthops(self, vlan, now):
+        """Return unresolved or expired IP gateways due for resolution, oldest first.
+
+        Only nexthops scheduled to be resolved by now are examined, and
+        at most max_hosts_per_resolve_cycle are returned; the remainder
+        stay scheduled for the next cycle.
 
         Args:
            vlan (vlan): VLAN containing this RIB/FIB.
-           ip_gws (list): tuple, IP gateway and controller IP in same subnet.
            now (float): seconds since epoch.
         Returns:
            list: tuple, gateway, controller IP in same subnet, last retry time.
         """
-        ip_gws_never_tried = []
-        ip_gws_with_retry_time = []
-        for ip_gw, faucet_vip in ip_gws:
-            if self._nexthop_fresh(vlan, ip_gw, now):
-                continue
+        resolve_queue = self._vlan_nexthop_resolve_queue(vlan)
+        routes = self._vlan_routes(vlan)
+        unresolved_nexthops = []
+        while resolve_queue and resolve_queue[0][0] <= now:
+            if len(unresolved_nexthops) >= self.max_hosts_per_resolve_cycle:
+                self.logger.info(
+                    'deferring resolution of %u nexthops on VLAN %u' % (
+                        len([1 for resolve_time, _ in resolve_queue if resolve_time <= now]),
+                        vlan.vid))
+                break
+            resolve_time, ip_gw = heapq.heappop(resolve_queue)
             nexthop_cache_entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
-            last_retry_time = nexthop_cache_entry.last_retry_time
-            ip_gw_with_retry_time = (ip_gw, faucet_vip, last_retry_time)
-            if last_retry_time is None:
-                ip_gws_never_tried.append(ip_gw_with_retry_time)
-            else:
-                if self._retry_backoff(
-                        now, nexthop_cache_entry.resolve_retries, last_retry_time):
-                    ip_gws_with_retry_time.append(ip_gw_with_retry_time)
-        ip_gws_with_retry_time_sorted = list(
-            sorted(ip_gws_with_retry_time, key=lambda x: x[-1]))
-        return ip_gws_never_tried + ip_gws_with_retry_time_sorted
+            if (nexthop_cache_entry is None or
+                    nexthop_cache_entry.next_resolve_time != resolve_time):
+                continue
+            nexthop_cache_entry.next_resolve_time = None
+            # No longer a gateway (rescheduled if added back by add_route()).
+            if not routes.has_ip_gw(ip_gw):
+                continue
+            faucet_vip = vlan.ip_in_vip_subnet(ip_gw)
+            if faucet_vip is None:
+                continue
+            unresolved_nexthops.append(
+                (ip_gw, faucet_vip, nexthop_cache_entry.last_retry_time))
+        return unresolved_nexthops
 
     def _is_host_fib_route(self, vlan, host_ip):
         """Return True if IP destination is a host FIB route.
@@ -329,18 +518,17 @@ class ValveRouteManager(object):
         """
         routes = self._vlan_routes(vlan)
         in_fib = False
-        for ip_dst, ip_gw in list(routes.items()):
-            if ip_gw == host_ip:
-                in_fib = True
-                if ip_dst.prefixlen < ip_dst.max_prefixlen:
-                    return False
+        for ip_dst in routes.ip_dsts_via(host_ip):
+            in_fib = True
+            if ip_dst.prefixlen < ip_dst.max_prefixlen:
+                return False
         return in_fib
 
     def advertise(self, vlan):
         return []
 
     def resolve_gateways(self, vlan, now):
-        """Re/resolve all gateways.
+        """Re/resolve gateways due for resolution.
 
         Args:
             vlan (vlan): VLAN containing this RIB/FIB.
@@ -348,18 +536,7 @@ class ValveRouteManager(object):
         Returns:
             list: OpenFlow messages.
         """
-        ip_gws = self._vlan_ip_gws(vlan)
-        self._add_unresolved_nexthops(vlan, ip_gws)
-        all_unresolved_nexthops = self._vlan_unresolved_nexthops(
-            vlan, ip_gws, now)
-        cycle_unresolved_nexthops = all_unresolved_nexthops[
-            :self.max_hosts_per_resolve_cycle]
-        deferred_unresolved_nexthops = (len(all_unresolved_nexthops) -
-                                        len(cycle_unresolved_nexthops))
-        if deferred_unresolved_nexthops:
-            self.logger.info(
-                'deferring resolution of %u nexthops on VLAN %u' % (
-                    deferred_unresolved_nexthops, vlan.vid))
+        cycle_unresolved_nexthops = self._vlan_unresolved_nexthops(vlan, now)
         ofmsgs = []
         for ip_gw, faucet_vip, last_retry_time in cycle_unresolved_nexthops:
             nexthop_cache_entry = self._vlan_nexthop_cache_entry(vlan, ip_gw)
@@ -371,9 +548,13 @@ class ValveRouteManager(object):
                         now - nexthop_cache_entry.cache_time,
                         vlan.vid))
                 ofmsgs.extend(self._del_host_fib_route(vlan, ip_gw))
+                self._proactive_learn_failed(vlan, ip_gw, now)
             else:
                 nexthop_cache_entry.last_retry_time = now
                 nexthop_cache_entry.resolve_retries += 1
+                self._schedule_nexthop_resolve(
+                    vlan, ip_gw, nexthop_cache_entry,
+                    now + self._retry_backoff(nexthop_cache_entry.resolve_retries))
                 resolve_flows = self.resolve_gw_on_vlan(vlan, faucet_vip, ip_gw)
                 if last_retry_time is None:
                     self.logger.debug(
@@ -407,10 +588,73 @@ class ValveRouteManager(object):
     def _vlan_nexthop_cache_limit(self, vlan):
         pass
 
+    @staticmethod
+    def _expire_proactive_learn_negative_cache(vlan, now):
+        negative_cache = vlan.dyn_proactive_learn_negative_cache
+        # All entries have the same TTL, so expire in insertion order.
+        while negative_cache:
+            host_ip = next(iter(negative_cache))
+            if negative_cache[host_ip] > now:
+                break
+            del negative_cache[host_ip]
+
+    def _proactive_learn_failed(self, vlan, host_ip, now):
+        """Don't proactively resolve a host again for a while, as it failed to resolve.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            host_ip (ipaddress.ip_address): host that failed to resolve.
+            now (float): seconds since epoch.
+        """
+        if not vlan.proactive_learn_negative_ttl:
+            return
+        self._expire_proactive_learn_negative_cache(vlan, now)
+        negative_cache = vlan.dyn_proactive_learn_negative_cache
+        negative_cache.pop(host_ip, None)
+        negative_cache[host_ip] = now + vlan.proactive_learn_negative_ttl
+
+    def _admit_proactive_learn(self, vlan, faucet_vip, dst_ip, now):
+        """Return True if a host may be proactively resolved now.
+
+        Hosts that recently failed to resolve are not tried again until
+        their negative cache entry expires, and resolutions are rate
+        limited per FAUCET VIP subnet.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            faucet_vip (ipaddress.ip_interface): VIP whose subnet contains host.
+            dst_ip (ipaddress.ip_address): host to resolve.
+            now (float): seconds since epoch.
+        Returns:
+            bool: True if host may be resolved.
+        """
+        self._expire_proactive_learn_negative_cache(vlan, now)
+        if dst_ip in vlan.dyn_proactive_learn_negative_cache:
+            self.logger.debug(
+                'not proactively learning %s, recently failed on VLAN %u' % (
+                    dst_ip, vlan.vid))
+            vlan.dyn_proactive_learn_drop_count += 1
+            return False
+        if vlan.proactive_learn_rate:
+            buckets = vlan.dyn_proactive_learn_buckets
+            if faucet_vip not in buckets:
+                buckets[faucet_vip] = valve_util.TokenBucket(
+                    vlan.proactive_learn_rate,
+                    max(vlan.proactive_learn_burst or vlan.proactive_learn_rate, 1),
+                    now)
+            if not buckets[faucet_vip].consume(now):
+                self.logger.debug(
+                    'not proactively learning %s, rate limited on VLAN %u' % (
+                        dst_ip, vlan.vid))
+                vlan.dyn_proactive_learn_drop_count += 1
+                return False
+        return True
+
     def _proactive_resolve_neighbor(self, vlans, dst_ip):
         ofmsgs = []
         if not self.proactive_learn:
             return []
+        now = time.time()
         for vlan in vlans:
             limit = self._vlan_nexthop_cache_limit(vlan)
             faucet_vip = vlan.ip_in_vip_subnet(dst_ip)
@@ -426,6 +670,8 @@ class ValveRouteManager(object):
                         'not proactively learning %s, at limit %u on VLAN %u' % (
                             dst_ip, limit, vlan.vid))
                     break
+                if not self._admit_proactive_learn(vlan, faucet_vip, dst_ip, now):
+                    break
                 priority = self._route_priority(dst_ip)
                 dst_int = self._host_ip_to_host_int(dst_ip)
                 in_match = self._route_match(vlan, dst_int)
@@ -442,6 +688,45 @@ class ValveRouteManager(object):
                 break
         return ofmsgs
 
+    def neighbor_state(self, vlan):
+        """Return resolved neighbors, for persisting.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+        Returns:
+            list: of IP address, MAC address, cache time and whether a host FIB route.
+        """
+        neighbors = []
+        for ip_gw, nexthop in list(self._vlan_nexthop_cache(vlan).items()):
+            if nexthop.eth_src is None:
+                continue
+            neighbors.append([
+                str(ip_gw), nexthop.eth_src, nexthop.cache_time,
+                self._is_host_fib_route(vlan, ip_gw)])
+        return neighbors
+
+    def restore_neighbor(self, vlan, port, eth_src, ip_gw, host_route):
+        """Restore a previously resolved neighbor (and routes via it).
+
+        Args:
+            vlan (vlan): VLAN containing this RIB/FIB.
+            port (port): port neighbor was learned on.
+            eth_src (str): MAC address of neighbor.
+            ip_gw (ipaddress.ip_address): IP address of neighbor.
+            host_route (bool): True if neighbor had a host FIB route.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        if host_route:
+            if not vlan.ip_in_vip_subnet(ip_gw):
+                return ofmsgs
+            ofmsgs.extend(self._add_host_fib_route(vlan, ip_gw))
+        elif not self._vlan_routes(vlan).has_ip_gw(ip_gw):
+            return ofmsgs
+        ofmsgs.extend(self._update_nexthop(vlan, port, eth_src, ip_gw))
+        return ofmsgs
+
     def add_route(self, vlan, ip_gw, ip_dst):
         """Add a route to the RIB.
 
@@ -456,11 +741,32 @@ class ValveRouteManager(object):
         if vlan.is_faucet_vip(ip_dst):
             return ofmsgs
         routes = self._vlan_routes(vlan)
+        was_multipath = False
+        old_ip_gw = None
         if ip_dst in routes:
-            if routes[ip_dst] == ip_gw:
-                return ofmsgs
+            was_multipath = routes.is_multipath(ip_dst)
+            if not was_multipath:
+                old_ip_gw = routes[ip_dst]
+                if old_ip_gw == ip_gw:
+                    return ofmsgs
 
+        new_ip_gw = not routes.has_ip_gw(ip_gw)
         routes[ip_dst] = ip_gw
+        if new_ip_gw and vlan.ip_in_vip_subnet(ip_gw):
+            self._schedule_new_ip_gw(vlan, ip_gw)
+        if was_multipath:
+            ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
+            ofmsgs.extend(self._del_multipath_group(vlan, ip_dst))
+        elif old_ip_gw is not None:
+            ofmsgs.extend(self._del_nexthop_group(vlan, old_ip_gw))
+        if self.fib_compression:
+            was_suppressed = routes.is_suppressed(ip_dst)
+            routes.set_suppressed(ip_dst, self._route_covered(routes, ip_dst, ip_gw))
+            if routes.is_suppressed(ip_dst):
+                if not was_suppressed:
+                    ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
+                ofmsgs.extend(self._update_covered_routes(vlan, ip_dst))
+                return ofmsgs
         cached_eth_dst = self._cached_nexthop_eth_dst(vlan, ip_gw)
         if cached_eth_dst is not None:
             ofmsgs.extend(self._add_resolved_route(
@@ -469,6 +775,91 @@ class ValveRouteManager(object):
                 ip_dst=ip_dst,
                 eth_dst=cached_eth_dst,
                 is_updated=False))
+        if self.fib_compression:
+            ofmsgs.extend(self._update_covered_routes(vlan, ip_dst))
+        return ofmsgs
+
+    def add_multipath_route(self, vlan, ip_gws, ip_dst, failover=False):
+        """Add a route with one or more nexthops to the RIB.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB.
+            ip_gws (list): IP addresses of nexthops.
+            ip_dst (ipaddress.ip_network): destination IP network.
+            failover (bool): True if nexthops are backups, in order of
+                preference, rather than all used to share load (ECMP).
+        Returns:
+            list: OpenFlow messages.
+        """
+        if len(ip_gws) == 1:
+            return self.add_route(vlan, ip_gws[0], ip_dst)
+        ofmsgs = []
+        if vlan.is_faucet_vip(ip_dst):
+            return ofmsgs
+        routes = self._vlan_routes(vlan)
+        old_ip_gw = None
+        if ip_dst in routes:
+            if routes.multipath(ip_dst) == (list(ip_gws), failover):
+                return ofmsgs
+            if not routes.is_multipath(ip_dst):
+                old_ip_gw = routes[ip_dst]
+                ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
+        new_ip_gws = [ip_gw for ip_gw in ip_gws if not routes.has_ip_gw(ip_gw)]
+        routes.set_multipath(ip_dst, ip_gws, failover)
+        routes.set_suppressed(ip_dst, False)
+        if old_ip_gw is not None:
+            ofmsgs.extend(self._del_nexthop_group(vlan, old_ip_gw))
+        for ip_gw in new_ip_gws:
+            if vlan.ip_in_vip_subnet(ip_gw):
+                self._schedule_new_ip_gw(vlan, ip_gw)
+        ofmsgs.extend(self._add_resolved_multipath_route(vlan, ip_dst))
+        if self.fib_compression:
+            ofmsgs.extend(self._update_covered_routes(vlan, ip_dst))
+        return ofmsgs
+
+    @staticmethod
+    def _route_covered(routes, ip_dst, ip_gw):
+        """Return True if a route is redundant in the FIB.
+
+        A route is redundant if the most specific route covering it has
+        the same nexthop, as packets to it will match that route instead.
+        Multipath routes are never redundant, nor make other routes so.
+        """
+        if routes.is_multipath(ip_dst):
+            return False
+        covering_route = routes.covering_route(ip_dst)
+        return (covering_route is not None and
+                covering_route[1] == ip_gw and
+                not routes.is_multipath(covering_route[0]))
+
+    def _update_covered_routes(self, vlan, ip_dst):
+        """Update FIB for routes covered by a route that was added or deleted.
+
+        Args:
+            vlan (vlan): VLAN containing this RIB.
+            ip_dst (ipaddress.ip_network): destination of added/deleted route.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        routes = self._vlan_routes(vlan)
+        for covered_ip_dst, covered_ip_gw in routes.covered_routes(ip_dst):
+            was_suppressed = routes.is_suppressed(covered_ip_dst)
+            suppressed = self._route_covered(routes, covered_ip_dst, covered_ip_gw)
+            if suppressed == was_suppressed:
+                continue
+            routes.set_suppressed(covered_ip_dst, suppressed)
+            if suppressed:
+                ofmsgs.extend(self._del_route_flows(vlan, covered_ip_dst))
+            else:
+                cached_eth_dst = self._cached_nexthop_eth_dst(vlan, covered_ip_gw)
+                if cached_eth_dst is not None:
+                    ofmsgs.extend(self._add_resolved_route(
+                        vlan=vlan,
+                        ip_gw=covered_ip_gw,
+                        ip_dst=covered_ip_dst,
+                        eth_dst=cached_eth_dst,
+                        is_updated=False))
         return ofmsgs
 
     def _add_host_fib_route(self, vlan, host_ip):
@@ -563,9 +954,16 @@ class ValveRouteManager(object):
             return ofmsgs
         routes = self._vlan_routes(vlan)
         if ip_dst in routes:
+            was_multipath = routes.is_multipath(ip_dst)
+            ip_gw = routes[ip_dst]
             del routes[ip_dst]
             ofmsgs.extend(self._del_route_flows(vlan, ip_dst))
-            # TODO: need to delete nexthop group if groups are in use.
+            if was_multipath:
+                ofmsgs.extend(self._del_multipath_group(vlan, ip_dst))
+            else:
+                ofmsgs.extend(self._del_nexthop_group(vlan, ip_gw))
+            if self.fib_compression:
+                ofmsgs.extend(self._update_covered_routes(vlan, ip_dst))
         return ofmsgs
 
     def control_plane_handler(self, pkt_meta):
@@ -16,9 +16,6 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import hashlib
-import struct
-
 from ryu.ofproto import ofproto_v1_3 as ofp
 
 try:
@@ -117,9 +114,10 @@ class ValveTable(object):
 
 class ValveGroupEntry(object):
 
-    def __init__(self, table, group_id, buckets):
+    def __init__(self, table, group_id, buckets, group_type=ofp.OFPGT_ALL):
         self.table = table
         self.group_id = group_id
+        self.group_type = group_type
         self.update_buckets(buckets)
 
     def update_buckets(self, buckets):
@@ -129,14 +127,15 @@ class ValveGroupEntry(object):
         ofmsgs = []
         ofmsgs.append(self.delete())
         ofmsgs.append(valve_of.groupadd(
-            group_id=self.group_id, buckets=self.buckets))
+            type_=self.group_type, group_id=self.group_id, buckets=self.buckets))
         self.table.entries[self.group_id] = self
         return ofmsgs
 
     def modify(self):
         assert self.group_id in self.table.entries
         self.table.entries[self.group_id] = self
-        return valve_of.groupmod(group_id=self.group_id, buckets=self.buckets)
+        return valve_of.groupmod(
+            type_=self.group_type, group_id=self.group_id, buckets=self.buckets)
 
     def delete(self):
         if self.group_id in self.table.entries:
@@ -145,26 +144,271 @@ class ValveGroupEntry(object):
 
 
 class ValveGroupTable(object):
-    """Wrap access to group table."""
+    """Wrap access to group table.
 
-    entries = {}
+    Flood groups have fixed IDs, derived from the VLAN VID. Other groups
+    are allocated IDs by key, starting from ROUTE_GROUP_OFFSET. Released
+    IDs are reused before new ones are allocated, so IDs never collide
+    and stay within the range the switch has seen.
+    """
 
-    @staticmethod
-    def group_id_from_str(key_str):
-        """Return a group ID based on a string key."""
-        # TODO: does not handle collisions
-        digest = hashlib.sha256(key_str.encode('utf-8')).digest()
-        return struct.unpack('<L', digest[:4])[0]
+    entries = None
+    _group_id_by_key = None
+    _free_group_ids = None
+    _next_group_id = None
+
+    def __init__(self):
+        self.entries = {}
+        self._group_id_by_key = {}
+        self._free_group_ids = []
+        self._next_group_id = valve_of.ROUTE_GROUP_OFFSET
+
+    def group_id_from_key(self, key):
+        """Return the group ID for a key, allocating one if necessary.
+
+        Args:
+            key (tuple): hashable key identifying the group.
+        Returns:
+            int: group ID.
+        """
+        if key in self._group_id_by_key:
+            return self._group_id_by_key[key]
+        if self._free_group_ids:
+            group_id = self._free_group_ids.pop()
+        else:
+            assert self._next_group_id <= ofp.OFPG_MAX, 'group IDs exhausted'
+            group_id = self._next_group_id
+            self._next_group_id += 1
+        self._group_id_by_key[key] = group_id
+        return group_id
+
+    def has_key(self, key):
+        """Return True if a group ID is allocated for a key."""
+        return key in self._group_id_by_key
+
+    def release(self, key):
+        """Delete the group for a key if present, and free its group ID.
+
+        Args:
+            key (tuple): hashable key identifying the group.
+        Returns:
+            list: OpenFlow messages.
+        """
+        ofmsgs = []
+        group_id = self._group_id_by_key.pop(key, None)
+        if group_id is not None:
+            if group_id in self.entries:
+                ofmsgs.append(self.entries[group_id].delete())
+            self._free_group_ids.append(group_id)
+        return ofmsgs
 
-    def get_entry(self, group_id, buckets):
+    def get_entry(self, group_id, buckets, group_type=ofp.OFPGT_ALL):
         if group_id in self.entries:
             self.entries[group_id].update_buckets(buckets)
+            self.entries[group_id].group_type = group_type
         else:
             self.entries[group_id] = ValveGroupEntry(
-                self, group_id, buckets)
+                self, group_id, buckets, group_type)
         return self.entries[group_id]
 
     def delete_all(self):
-        """Delete all groups."""
+        """Delete all groups.
+
+        Allocated group IDs are kept, as the routes using them are.
+        """
         self.entries = {}
         return valve_of.groupdel()
+
+
+class ValveShadowFlowTable(object):
+    """Shadow of the permanent flows installed on a datapath.
+
+    Used to drop flowmods that would not change the datapath: adds of
+    a flow already installed with the same instructions, and strict
+    deletes of a flow known not to be installed. Flows are keyed by
+    table ID, priority and match.
+
+    Flows with timeouts expire on the datapath without notice, so they
+    are never suppressed. Once a table has had one, or a delete or
+    modify the shadow cannot follow exactly, the table is no longer
+    known completely and deletes in it are always sent.
+    """
+
+    flows_by_table = None
+    table_ids = None
+    _synced_tables = None
+
+    def __init__(self, table_ids):
+        self.table_ids = set(table_ids)
+        self.flows_by_table = {}
+        self._synced_tables = set()
+
+    @staticmethod
+    def _flow_key(ofmsg):
+        return (ofmsg.priority, tuple(sorted(ofmsg.match.items())))
+
+    @staticmethod
+    def _flow_content(ofmsg):
+        return (ofmsg.cookie, ofmsg.flags, str(ofmsg.instructions))
+
+    @staticmethod
+    def _filtered(ofmsg):
+        """Return True if a delete is restricted by output or cookie."""
+        return (ofmsg.out_port != ofp.OFPP_ANY or
+                ofmsg.out_group != ofp.OFPG_ANY or
+                ofmsg.cookie_mask)
+
+    @staticmethod
+    def _match_may_cover(match_items, flow_match_items):
+        """Return True if a non-strict match may cover a flow's match.
+
+        Args:
+            match_items (list): non-strict match fields and values.
+            flow_match_items (tuple): flow match fields and values.
+        Returns:
+            bool: False if the match certainly does not cover the flow.
+        """
+        flow_match = dict(flow_match_items)
+        for field, value in match_items:
+            if field not in flow_match:
+                return False
+            if isinstance(value, tuple):
+                continue
+            flow_value = flow_match[field]
+            if isinstance(flow_value, tuple) or flow_value != value:
+                return False
+        return True
+
+    @staticmethod
+    def _match_is_exact(match_items):
+        return not any(isinstance(value, tuple) for _, value in match_items)
+
+    def table_flow_counts(self):
+        """Return number of permanent flows installed, by table ID."""
+        return {
+            table_id: len(flows)
+            for table_id, flows in list(self.flows_by_table.items())}
+
+    def _collapse_deleted_adds(self, ofmsgs):
+        """Drop flow adds replaced or deleted later in the same batch.
+
+        Deletes are sent before adds, so an add followed by a delete
+        of the same flow would otherwise leave the flow installed.
+        """
+        dropped = set()
+        pending_adds = {}
+        for i, ofmsg in enumerate(ofmsgs):
+            if not valve_of.is_flowmod(ofmsg):
+                continue
+            if ofmsg.command == ofp.OFPFC_ADD:
+                flow_key = (ofmsg.table_id, self._flow_key(ofmsg))
+                if flow_key in pending_adds:
+                    dropped.add(pending_adds[flow_key])
+                pending_adds[flow_key] = i
+            elif valve_of.is_flowdel(ofmsg) and not self._filtered(ofmsg):
+                if ofmsg.command == ofp.OFPFC_DELETE_STRICT:
+                    flow_key = (ofmsg.table_id, self._flow_key(ofmsg))
+                    if flow_key in pending_adds:
+                        dropped.add(pending_adds.pop(flow_key))
+                    continue
+                match_items = list(ofmsg.match.items())
+                if not self._match_is_exact(match_items):
+                    continue
+                for flow_key, add_i in list(pending_adds.items()):
+                    table_id, (_, flow_match_items) = flow_key
+                    if ofmsg.table_id not in (ofp.OFPTT_ALL, table_id):
+                        continue
+                    if self._match_may_cover(match_items, flow_match_items):
+                        dropped.add(add_i)
+                        del pending_adds[flow_key]
+        if not dropped:
+            return ofmsgs
+        return [ofmsg for i, ofmsg in enumerate(ofmsgs) if i not in dropped]
+
+    def _apply_flowdel(self, ofmsg):
+        """Apply a flow delete to the shadow.
+
+        Returns:
+            bool: True if the delete must be sent to the datapath.
+        """
+        filtered = self._filtered(ofmsg)
+        if ofmsg.command == ofp.OFPFC_DELETE_STRICT:
+            table_id = ofmsg.table_id
+            flows = self.flows_by_table.get(table_id, {})
+            installed = flows.pop(self._flow_key(ofmsg), None) is not None
+            if filtered:
+                self._synced_tables.discard(table_id)
+                return True
+            return installed or table_id not in self._synced_tables
+        table_ids = [ofmsg.table_id]
+        if ofmsg.table_id == ofp.OFPTT_ALL:
+            table_ids = self.table_ids.union(self.flows_by_table.keys())
+        match_items = list(ofmsg.match.items())
+        exact = not filtered and self._match_is_exact(match_items)
+        for table_id in table_ids:
+            flows = self.flows_by_table.setdefault(table_id, {})
+            if exact and not match_items:
+                flows.clear()
+                self._synced_tables.add(table_id)
+                continue
+            for flow_key in list(flows.keys()):
+                if self._match_may_cover(match_items, flow_key[1]):
+                    del flows[flow_key]
+            if not exact:
+                self._synced_tables.discard(table_id)
+        return True
+
+    def _apply_flowmod(self, ofmsg):
+        """Apply a flow add or modify to the shadow.
+
+        Returns:
+            bool: True if the flowmod must be sent to the datapath.
+        """
+        table_id = ofmsg.table_id
+        flows = self.flows_by_table.setdefault(table_id, {})
+        flow_key = self._flow_key(ofmsg)
+        if ofmsg.command == ofp.OFPFC_ADD:
+            if ofmsg.hard_timeout or ofmsg.idle_timeout:
+                flows.pop(flow_key, None)
+                self._synced_tables.discard(table_id)
+                return True
+            flow_content = self._flow_content(ofmsg)
+            if flows.get(flow_key, None) == flow_content:
+                return False
+            flows[flow_key] = flow_content
+            return True
+        if ofmsg.command == ofp.OFPFC_MODIFY_STRICT:
+            if flow_key in flows:
+                flow_content = self._flow_content(ofmsg)
+                if flows[flow_key] == flow_content:
+                    return False
+                flows[flow_key] = flow_content
+            return True
+        # Non-strict modify, forget any flows it may have changed.
+        match_items = list(ofmsg.match.items())
+        for key in list(flows.keys()):
+            if self._match_may_cover(match_items, key[1]):
+                del flows[key]
+        self._synced_tables.discard(table_id)
+        return True
+
+    def filter_ofmsgs(self, ofmsgs):
+        """Return OpenFlow messages, without flowmods that would not change the datapath.
+
+        valve_flowreorder() sends all deletes before other messages, so
+        deletes are applied to the shadow first, then adds and modifies.
+
+        Args:
+            ofmsgs (list): OpenFlow messages, in order generated.
+        Returns:
+            list: OpenFlow messages to send.
+        """
+        ofmsgs = self._collapse_deleted_adds(ofmsgs)
+        send = [True] * len(ofmsgs)
+        for i, ofmsg in enumerate(ofmsgs):
+            if valve_of.is_flowdel(ofmsg):
+                send[i] = self._apply_flowdel(ofmsg)
+        for i, ofmsg in enumerate(ofmsgs):
+            if valve_of.is_flowmod(ofmsg) and not valve_of.is_flowdel(ofmsg):
+                send[i] = self._apply_flowmod(ofmsg)
+        return [ofmsg for ofmsg, send_ofmsg in zip(ofmsgs, send) if send_ofmsg]
@@ -76,3 +76,49 @@ def dpid_log(dpid):
 
 def btos(b_str):
     return b_str.encode('utf-8').decode('utf-8', 'strict')
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter."""
+
+    def __init__(self, rate, burst, now):
+        """Constructs a new full token bucket.
+
+        Args:
+            rate (float): tokens added per second.
+            burst (int): max tokens in bucket.
+            now (float): current time.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = now
+
+    def available(self, now, tokens=1):
+        """Return True if tokens are available, without consuming them.
+
+        Args:
+            now (float): current time.
+            tokens (int): tokens to check for.
+        Returns:
+            bool: True if tokens are available.
+        """
+        elapsed = now - self.last_time
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.last_time = now
+        return self.tokens >= tokens
+
+    def consume(self, now, tokens=1):
+        """Consume tokens if available.
+
+        Args:
+            now (float): current time.
+            tokens (int): tokens to consume.
+        Returns:
+            bool: True if tokens were available (and consumed).
+        """
+        if self.available(now, tokens):
+            self.tokens -= tokens
+            return True
+        return False
@@ -23,10 +23,12 @@ try:
     from conf import Conf
     from valve_util import btos
     import valve_of
+    import valve_rib
 except ImportError:
     from faucet.conf import Conf
     from faucet.valve_util import btos
     from faucet import valve_of
+    from faucet import valve_rib
 
 
 FAUCET_MAC = '0e:00:00:00:00:01'
@@ -48,19 +50,40 @@ class VLAN(Conf):
     bgp_neighbour_addresses = []
     bgp_neighbor_as = None
     bgp_neighbour_as = None
+    bgp_batch_ms = None
+    bgp_batch_size = None
+    bgp_route_dampening = None
     routes = None
     max_hosts = None
     unicast_flood = None
     acl_in = None
     proactive_arp_limit = None
     proactive_nd_limit = None
+    proactive_learn_negative_ttl = None
+    proactive_learn_rate = None
+    proactive_learn_burst = None
+    packetin_rate = None
+    packetin_burst = None
     # Define dynamic variables with prefix dyn_ to distinguish from variables set
     # configuration
     dyn_host_cache = None
+    dyn_host_cache_by_port = None
+    dyn_host_cache_expiry = None
     dyn_faucet_vips_by_ipv = None
+    dyn_faucet_vip_ints_by_ipv = None
+    dyn_faucet_vip_subnets_by_ipv = None
     dyn_routes_by_ipv = None
     dyn_neigh_cache_by_ipv = None
+    dyn_neigh_resolve_by_ipv = None
     dyn_learn_ban_count = 0
+    dyn_packetin_bucket = None
+    dyn_packetin_drop_count = 0
+    dyn_proactive_learn_negative_cache = None
+    dyn_proactive_learn_buckets = None
+    dyn_proactive_learn_drop_count = 0
+    dyn_tagged_port_nums = None
+    dyn_untagged_port_nums = None
+    dyn_port_lists = None
 
     defaults = {
         'name': None,
@@ -78,6 +101,12 @@ class VLAN(Conf):
         'bgp_neighbor_addresses': [],
         'bgp_neighbour_as': None,
         'bgp_neighbor_as': None,
+        'bgp_batch_ms': 100,
+        # apply BGP route changes in batches, at most this many ms apart
+        'bgp_batch_size': 1000,
+        # apply BGP route changes when this many prefixes are pending
+        'bgp_route_dampening': False,
+        # suppress BGP routes that flap (RFC 2439)
         'routes': None,
         'max_hosts': 255,
         # Limit number of hosts that can be learned on a VLAN.
@@ -86,6 +115,16 @@ class VLAN(Conf):
         # Don't proactively ARP for hosts if over this limit (None unlimited)
         'proactive_nd_limit': None,
         # Don't proactively ND for hosts if over this limit (None unlimited)
+        'proactive_learn_negative_ttl': 60,
+        # Don't proactively resolve a host for this many seconds after it failed to resolve
+        'proactive_learn_rate': None,
+        # max proactive resolutions per second per FAUCET VIP subnet (None unlimited)
+        'proactive_learn_burst': None,
+        # max burst of proactive resolutions per FAUCET VIP subnet (None for proactive_learn_rate)
+        'packetin_rate': None,
+        # max packet ins per second admitted from this VLAN (None unlimited)
+        'packetin_burst': None,
+        # max burst of packet ins admitted from this VLAN (None for packetin_rate)
         }
 
     defaults_types = {
@@ -103,11 +142,19 @@ class VLAN(Conf):
         'bgp_neighbor_addresses': list,
         'bgp_neighbour_as': int,
         'bgp_neighbor_as': int,
+        'bgp_batch_ms': int,
+        'bgp_batch_size': int,
+        'bgp_route_dampening': bool,
         'routes': list,
         'max_hosts': int,
         'vid': int,
         'proactive_arp_limit': int,
         'proactive_nd_limit': int,
+        'proactive_learn_negative_ttl': int,
+        'proactive_learn_rate': int,
+        'proactive_learn_burst': int,
+        'packetin_rate': int,
+        'packetin_burst': int,
     }
 
     def __init__(self, _id, dp_id, conf=None):
@@ -116,9 +163,22 @@ class VLAN(Conf):
         self.tagged = []
         self.untagged = []
         self.dyn_host_cache = {}
+        self.dyn_host_cache_by_port = {}
+        self.dyn_host_cache_expiry = []
         self.dyn_faucet_vips_by_ipv = collections.defaultdict(list)
-        self.dyn_routes_by_ipv = collections.defaultdict(dict)
+        # VIPs by address int, and VIP subnets as list of prefix length and
+        # VIP by network int (longest prefix length first), for fast lookup.
+        self.dyn_faucet_vip_ints_by_ipv = collections.defaultdict(dict)
+        self.dyn_faucet_vip_subnets_by_ipv = collections.defaultdict(list)
+        self.dyn_routes_by_ipv = {
+            ipv: valve_rib.ValveRIB(ipv) for ipv in (4, 6)}
         self.dyn_neigh_cache_by_ipv = collections.defaultdict(dict)
+        self.dyn_neigh_resolve_by_ipv = collections.defaultdict(list)
+        self.dyn_proactive_learn_negative_cache = collections.OrderedDict()
+        self.dyn_proactive_learn_buckets = {}
+        self.dyn_tagged_port_nums = set()
+        self.dyn_untagged_port_nums = set()
+        self.dyn_port_lists = {}
         self.dyn_ipvs = []
 
         if self.faucet_vips:
@@ -127,6 +187,7 @@ class VLAN(Conf):
             for faucet_vip in self.faucet_vips:
                 self.dyn_faucet_vips_by_ipv[faucet_vip.version].append(
                     faucet_vip)
+                self._index_faucet_vip(faucet_vip)
             self.dyn_ipvs = list(self.dyn_faucet_vips_by_ipv.keys())
 
         if self.bgp_as:
@@ -139,16 +200,50 @@ class VLAN(Conf):
         if self.routes:
             self.routes = [route['route'] for route in self.routes]
             for route in self.routes:
-                ip_gw = ipaddress.ip_address(btos(route['ip_gw']))
                 ip_dst = ipaddress.ip_network(btos(route['ip_dst']))
-                assert ip_gw.version == ip_dst.version
-                self.dyn_routes_by_ipv[ip_gw.version][ip_dst] = ip_gw
+                # ip_gw may be a list of gateways, for ECMP (or failover).
+                ip_gws = route['ip_gw']
+                if not isinstance(ip_gws, list):
+                    ip_gws = [ip_gws]
+                ip_gws = [ipaddress.ip_address(btos(ip_gw)) for ip_gw in ip_gws]
+                for ip_gw in ip_gws:
+                    assert ip_gw.version == ip_dst.version
+                self.dyn_routes_by_ipv[ip_dst.version].set_multipath(
+                    ip_dst, ip_gws, route.get('failover', False))
 
     def add_tagged(self, port):
         self.tagged.append(port)
+        self.dyn_tagged_port_nums.add(port.number)
+        self.reset_port_caches()
 
     def add_untagged(self, port):
         self.untagged.append(port)
+        self.dyn_untagged_port_nums.add(port.number)
+        self.reset_port_caches()
+
+    def merge_dyn(self, other_conf):
+        super(VLAN, self).merge_dyn(other_conf)
+        # Cached port lists refer to the other VLAN's port objects.
+        self.reset_port_caches()
+
+    def reset_port_caches(self):
+        """Invalidate cached port lists, on port state or config change."""
+        self.dyn_port_lists = {}
+
+    def _cached_port_list(self, key, build_list):
+        """Return a cached port list, building it if necessary.
+
+        Args:
+            key (tuple): cache key for the list.
+            build_list (function): returns the list of ports if not cached.
+        Returns:
+            list: ports (shared, must not be modified by the caller).
+        """
+        ports = self.dyn_port_lists.get(key, None)
+        if ports is None:
+            ports = build_list()
+            self.dyn_port_lists[key] = ports
+        return ports
 
     def ipvs(self):
         """Return list of IP versions configured on this VLAN."""
@@ -166,6 +261,10 @@ class VLAN(Conf):
         """Return neighbor cache for specified IP version on this VLAN."""
         return self.dyn_neigh_cache_by_ipv[ipv]
 
+    def neigh_resolve_by_ipv(self, ipv):
+        """Return neighbor resolution schedule for specified IP version on this VLAN."""
+        return self.dyn_neigh_resolve_by_ipv[ipv]
+
     @property
     def host_cache(self):
         """Return host (L2) cache for this VLAN."""
@@ -177,7 +276,62 @@ class VLAN(Conf):
 
     @host_cache.setter
     def host_cache(self, value):
-        self.dyn_host_cache = value
+        self.dyn_host_cache = {}
+        self.dyn_host_cache_by_port = {}
+        for host_cache_entry in list(value.values()):
+            self.add_cache_host(host_cache_entry)
+
+    def add_cache_host(self, host_cache_entry):
+        """Add a host to the host cache (replacing any existing entry).
+
+        Args:
+            host_cache_entry (HostCacheEntry): host to add.
+        """
+        eth_src = host_cache_entry.eth_src
+        self.expire_cache_host(eth_src)
+        self.dyn_host_cache[eth_src] = host_cache_entry
+        port_number = host_cache_entry.port.number
+        if port_number not in self.dyn_host_cache_by_port:
+            self.dyn_host_cache_by_port[port_number] = set()
+        self.dyn_host_cache_by_port[port_number].add(eth_src)
+
+    def expire_cache_host(self, eth_src):
+        """Remove a host from the host cache.
+
+        Args:
+            eth_src (str): MAC address of host.
+        Returns:
+            HostCacheEntry: entry removed (or None if host not cached).
+        """
+        host_cache_entry = self.dyn_host_cache.pop(eth_src, None)
+        if host_cache_entry is not None:
+            port_number = host_cache_entry.port.number
+            port_hosts = self.dyn_host_cache_by_port[port_number]
+            port_hosts.remove(eth_src)
+            if not port_hosts:
+                del self.dyn_host_cache_by_port[port_number]
+        return host_cache_entry
+
+    def clear_cache_hosts_on_port(self, port):
+        """Remove all hosts learned on a port from the host cache.
+
+        Args:
+            port (Port): port hosts learned on.
+        Returns:
+            list: MAC addresses of hosts removed.
+        """
+        eth_srcs = self.cached_hosts_on_port(port)
+        for eth_src in eth_srcs:
+            self.expire_cache_host(eth_src)
+        return eth_srcs
+
+    def cached_hosts_on_port(self, port):
+        """Return list of MAC addresses of hosts learned on a port."""
+        return list(self.dyn_host_cache_by_port.get(port.number, []))
+
+    def cached_hosts_count_on_port(self, port):
+        """Return number of hosts learned on a port."""
+        return len(self.dyn_host_cache_by_port.get(port.number, []))
 
     def set_defaults(self):
         super(VLAN, self).set_defaults()
@@ -198,15 +352,20 @@ class VLAN(Conf):
 
     def get_ports(self):
         """Return list of all ports on this VLAN."""
-        return list(self.tagged) + list(self.untagged)
+        return self._cached_port_list(
+            ('all',), lambda: list(self.tagged) + list(self.untagged))
 
     def mirrored_ports(self):
         """Return list of ports that are mirrored on this VLAN."""
-        return [port for port in self.get_ports() if port.mirror]
+        return self._cached_port_list(
+            ('mirrored',),
+            lambda: [port for port in self.get_ports() if port.mirror])
 
     def mirror_destination_ports(self):
         """Return list of ports that are mirrored to, on this VLAN."""
-        return [port for port in self.get_ports() if port.mirror_destination]
+        return self._cached_port_list(
+            ('mirror_destination',),
+            lambda: [port for port in self.get_ports() if port.mirror_destination])
 
     def flood_ports(self, configured_ports, exclude_unicast):
         ports = []
@@ -220,10 +379,14 @@ class VLAN(Conf):
         return ports
 
     def tagged_flood_ports(self, exclude_unicast):
-        return self.flood_ports(self.tagged, exclude_unicast)
+        return self._cached_port_list(
+            ('tagged_flood', exclude_unicast),
+            lambda: self.flood_ports(self.tagged, exclude_unicast))
 
     def untagged_flood_ports(self, exclude_unicast):
-        return self.flood_ports(self.untagged, exclude_unicast)
+        return self._cached_port_list(
+            ('untagged_flood', exclude_unicast),
+            lambda: self.flood_ports(self.untagged, exclude_unicast))
 
     def flood_pkt(self, packet_builder, *args):
         ofmsgs = []
@@ -239,27 +402,48 @@ class VLAN(Conf):
 
     def port_is_tagged(self, port):
         """Return True if port number is an tagged port on this VLAN."""
-        return port in self.tagged
+        return port.number in self.dyn_tagged_port_nums
 
     def port_is_untagged(self, port):
         """Return True if port number is an untagged port on this VLAN."""
-        return port in self.untagged
+        return port.number in self.dyn_untagged_port_nums
+
+    def _index_faucet_vip(self, faucet_vip):
+        ipv = faucet_vip.version
+        self.dyn_faucet_vip_ints_by_ipv[ipv].setdefault(int(faucet_vip.ip), faucet_vip)
+        network = faucet_vip.network
+        network_int = int(network.network_address)
+        subnets = self.dyn_faucet_vip_subnets_by_ipv[ipv]
+        for prefixlen, vips_by_network in subnets:
+            if prefixlen == network.prefixlen:
+                vips_by_network.setdefault(network_int, faucet_vip)
+                return
+        subnets.append((network.prefixlen, {network_int: faucet_vip}))
+        subnets.sort(key=lambda subnet: subnet[0], reverse=True)
 
     def is_faucet_vip(self, ipa):
         """Return True if IP is a VIP on this VLAN."""
-        for faucet_vip in self.faucet_vips_by_ipv(ipa.version):
-            if ipa == faucet_vip.ip:
-                return True
-        return False
+        try:
+            ip_int = int(ipa)
+        except TypeError:
+            # A network is never a VIP.
+            return False
+        return ip_int in self.dyn_faucet_vip_ints_by_ipv[ipa.version]
 
     def ip_in_vip_subnet(self, ipa):
-        """Return faucet_vip if IP in same IP network as a VIP on this VLAN."""
-        for faucet_vip in self.faucet_vips_by_ipv(ipa.version):
-            if ipa in faucet_vip.network:
-                if ipa not in (
-                        faucet_vip.network.network_address,
-                        faucet_vip.network.broadcast_address):
-                    return faucet_vip
+        """Return faucet_vip if IP in same IP network as a VIP on this VLAN.
+
+        If VIP subnets overlap, the VIP with the most specific subnet is returned.
+        """
+        ip_int = int(ipa)
+        for prefixlen, vips_by_network in self.dyn_faucet_vip_subnets_by_ipv[ipa.version]:
+            host_bits = ipa.max_prefixlen - prefixlen
+            network_int = (ip_int >> host_bits) << host_bits
+            if network_int in vips_by_network:
+                # Network and broadcast addresses are not hosts.
+                broadcast_int = network_int | ((1 << host_bits) - 1)
+                if ip_int not in (network_int, broadcast_int):
+                    return vips_by_network[network_int]
         return None
 
     def ips_in_vip_subnet(self, ips):
@@ -17,18 +17,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ipaddress
 import os
+import time
 import unittest
 import tempfile
 import shutil
+try:
+    import mock
+except ImportError:
+    from unittest import mock
 from fakeoftable import FakeOFTable
 
+from prometheus_client import CollectorRegistry
+
 from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
 from ryu.lib.packet import ethernet, arp, vlan, ipv4, ipv6, packet
 
+from faucet.faucet import Faucet
 from faucet.valve import valve_factory
 from faucet.config_parser import dp_parser
+from faucet import faucet_bgp
+from faucet import faucet_metrics
+from faucet import faucet_state
+from faucet import valve_of
 from faucet import valve_packet
+from faucet import valve_rib
+from faucet.valve_table import ValveTable
 
 
 def build_pkt(pkt):
@@ -166,7 +182,7 @@ vlans:
         pkt.serialize()
         eth_pkt = valve_packet.parse_eth_pkt(pkt)
         pkt_meta = self.valve.parse_rcv_packet(
-            port, vid, eth_type, pkt.data, pkt, eth_pkt)
+            port, vid, eth_type, pkt.data, eth_pkt.src, eth_pkt.dst, pkt=pkt)
         rcv_packet_ofmsgs = self.valve.rcv_packet(
             dp_id=self.DP_ID, valves={}, pkt_meta=pkt_meta)
         self.table.apply_ofmsgs(rcv_packet_ofmsgs)
@@ -440,6 +456,514 @@ class ValveTestCase(ValveTestBase):
             self.table.is_output(match, port=ofp.OFPP_CONTROLLER),
             msg='Packet not output to controller after port bounce')
 
+    def test_learn_cache(self):
+        """Test recently learned hosts are detected before full processing."""
+        # VLANs with routing always fully process packets, to learn host routes.
+        self.assertIsNone(self.valve.learn_cache_hit(
+            1, 0x100, self.P1_V100_MAC, self.UNKNOWN_MAC))
+        self.valve.dp.vlans[0x100].faucet_vips = []
+        self.assertTrue(self.valve.learn_cache_hit(
+            1, 0x100, self.P1_V100_MAC, self.UNKNOWN_MAC))
+        self.assertFalse(self.valve.learn_cache_hit(
+            3, 0x100, self.P1_V100_MAC, self.UNKNOWN_MAC))
+        self.assertIsNone(self.valve.learn_cache_hit(
+            1, 0x100, self.P1_V100_MAC,
+            self.valve.dp.vlans[0x100].faucet_mac))
+        self.assertIsNone(self.valve.learn_cache_hit(
+            1, 0x100, self.P1_V100_MAC, 'ff:ff:ff:ff:ff:ff'))
+        self.table.apply_ofmsgs(self.valve.port_delete(self.DP_ID, 1))
+        self.assertFalse(self.valve.learn_cache_hit(
+            1, 0x100, self.P1_V100_MAC, self.UNKNOWN_MAC))
+        # Not cached if nothing was learned (host was just learned).
+        self.rcv_packet(3, 0x200, {
+            'eth_src': self.P3_V200_MAC,
+            'eth_dst': self.P2_V200_MAC,
+            'vid': 0x200})
+        self.valve.learn_cache.clear()
+        self.rcv_packet(3, 0x200, {
+            'eth_src': self.P3_V200_MAC,
+            'eth_dst': self.P2_V200_MAC,
+            'vid': 0x200})
+        self.valve.dp.vlans[0x200].faucet_vips = []
+        self.assertFalse(self.valve.learn_cache_hit(
+            3, 0x200, self.P3_V200_MAC, self.P2_V200_MAC))
+
+    def test_port_packetin_rate_limit(self):
+        """Test packet ins from a port over its rate limit are dropped."""
+        port = self.valve.dp.ports[1]
+        port.packetin_rate = 1
+        port.packetin_burst = 1
+        for _ in range(2):
+            self.rcv_packet(1, 0x100, {
+                'eth_src': self.UNKNOWN_MAC,
+                'eth_dst': self.P1_V100_MAC})
+        self.assertEqual(1, port.dyn_packetin_drop_count)
+        self.assertEqual(0, self.valve.dp.ports[2].dyn_packetin_drop_count)
+
+    def test_vlan_packetin_rate_limit(self):
+        """Test packet ins dropped by a VLAN limit don't use port budget."""
+        port = self.valve.dp.ports[1]
+        port.packetin_rate = 1
+        port.packetin_burst = 2
+        vlan = self.valve.dp.vlans[0x100]
+        vlan.packetin_rate = 1
+        vlan.packetin_burst = 1
+        for _ in range(2):
+            self.rcv_packet(1, 0x100, {
+                'eth_src': self.UNKNOWN_MAC,
+                'eth_dst': self.P1_V100_MAC})
+        self.assertEqual(1, vlan.dyn_packetin_drop_count)
+        self.assertEqual(0, port.dyn_packetin_drop_count)
+        self.assertGreaterEqual(port.dyn_packetin_bucket.tokens, 1)
+
+    def test_host_metrics(self):
+        """Test host state metrics are computed from Valve state."""
+        collector = faucet_metrics.ValveStateCollector()
+        collector.valves = {self.DP_ID: self.valve}
+        samples = {}
+        for family in collector.collect():
+            samples[family.name] = [tuple(sample[:3]) for sample in family.samples]
+        self.assertIn(
+            ('learned_macs',
+             {'dp_id': '0x1', 'port': '1', 'vlan': str(0x100), 'n': '0'},
+             int(self.P1_V100_MAC.replace(':', ''), 16)),
+            samples['learned_macs'])
+        hosts_learned = dict(
+            (labels['vlan'], value)
+            for _, labels, value in samples['vlan_hosts_learned'])
+        self.assertEqual(
+            {str(0x100): 1, str(0x200): 2}, hosts_learned)
+        # Metrics may be instantiated more than once, with their own registry.
+        for _ in range(2):
+            metrics = faucet_metrics.FaucetMetrics(reg=CollectorRegistry())
+            metrics.valve_state.valves = {self.DP_ID: self.valve}
+
+    def test_port_delete_host_cache(self):
+        """Test hosts learned on a port are removed from the cache when it goes down."""
+        port = self.valve.dp.ports[3]
+        vlan = self.valve.dp.vlans[0x200]
+        self.assertEqual([self.P3_V200_MAC], port.hosts())
+        self.assertEqual(1, port.hosts_count())
+        self.table.apply_ofmsgs(self.valve.port_delete(self.DP_ID, 3))
+        self.assertEqual(0, port.hosts_count())
+        self.assertEqual(1, vlan.hosts_count())
+        self.assertEqual(
+            [self.P2_V200_MAC], self.valve.dp.ports[2].hosts(vlans=[vlan]))
+
+    def test_host_expire(self):
+        """Test hosts are expired only once they reach the learn timeout."""
+        vlan = self.valve.dp.vlans[0x100]
+        host_manager = self.valve.host_manager
+        cache_time = vlan.host_cache[self.P1_V100_MAC].cache_time
+        host_manager.expire_hosts_from_vlan(
+            vlan, cache_time + host_manager.learn_timeout)
+        self.assertIn(self.P1_V100_MAC, vlan.host_cache)
+        host_manager.expire_hosts_from_vlan(
+            vlan, cache_time + host_manager.learn_timeout + 1)
+        self.assertNotIn(self.P1_V100_MAC, vlan.host_cache)
+        self.assertEqual(0, self.valve.dp.ports[1].hosts_count())
+
+    def test_edge_host_index(self):
+        """Test hosts learned on edge ports are indexed until expired."""
+        edge_hosts = self.valve.edge_hosts
+        self.assertEqual(
+            (self.DP_ID, 1), edge_hosts.edge_host(0x100, self.P1_V100_MAC))
+        # Expiry by another DP does not remove the host.
+        edge_hosts.expire(self.DP_ID + 1, 0x100, self.P1_V100_MAC)
+        self.assertIsNotNone(edge_hosts.edge_host(0x100, self.P1_V100_MAC))
+        self.valve.port_delete(dp_id=self.DP_ID, port_num=1)
+        self.assertIsNone(edge_hosts.edge_host(0x100, self.P1_V100_MAC))
+        # Not stacked, so no other DPs need to learn hosts.
+        self.assertEqual([], edge_hosts.pop_learned())
+
+    def test_warm_restart(self):
+        """Test learned hosts are reprogrammed from saved state on restart."""
+        self.valve.dp.ports[1].dyn_learn_ban_count = 3
+        state = faucet_state.FaucetState(
+            None, os.path.join(self.tmpdir, 'faucet_state.json'))
+        state.save({self.DP_ID: self.valve})
+        dp = self.update_config(self.CONFIG)
+        self.valve = valve_factory(dp)(dp, 'test_valve')
+        self.valve.restore_state(state.load()[self.DP_ID])
+        self.assertEqual(3, self.valve.dp.ports[1].dyn_learn_ban_count)
+        self.table = FakeOFTable(self.NUM_TABLES)
+        self.connect_dp()
+        self.assertIn(self.P1_V100_MAC, self.valve.dp.vlans[0x100].host_cache)
+        match = {'in_port': 1, 'vlan_vid': 0, 'eth_src': self.P1_V100_MAC}
+        self.assertFalse(
+            self.table.is_output(match, port=ofp.OFPP_CONTROLLER),
+            msg='restored host sent to controller')
+
+    def test_flows_timeout(self):
+        """Test expired host flows are handled together."""
+        eth_src_table_id = self.valve.dp.tables['eth_src'].table_id
+        eth_dst_table_id = self.valve.dp.tables['eth_dst'].table_id
+        src_match = parser.OFPMatch(
+            in_port=1, vlan_vid=self.V100, eth_src=self.P1_V100_MAC)
+        dst_match = parser.OFPMatch(
+            vlan_vid=self.V100, eth_dst=self.P1_V100_MAC)
+        host = self.valve.dp.vlans[0x100].host_cache[self.P1_V100_MAC]
+        # Host still sending, so refreshed.
+        host.cache_time -= 60
+        self.assertTrue(self.valve.flows_timeout([
+            (eth_dst_table_id, dst_match), (eth_dst_table_id, dst_match)]))
+        # Host neither sending nor receiving, so not refreshed.
+        self.assertFalse(self.valve.flows_timeout([
+            (eth_dst_table_id, dst_match), (eth_src_table_id, src_match)]))
+        self.assertTrue(
+            self.valve.dp.vlans[0x100].host_cache[self.P1_V100_MAC].expired)
+
+    def test_nexthop_update(self):
+        """Test resolving a gateway updates only routes via that gateway."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        ip_gw = ipaddress.ip_address(u'10.0.0.2')
+        self.valve.add_route(
+            vlan, ip_gw, ipaddress.ip_network(u'10.88.88.0/24'))
+        self.valve.add_route(
+            vlan, ipaddress.ip_address(u'10.0.0.3'),
+            ipaddress.ip_network(u'10.77.77.0/24'))
+        self.assertFalse(route_manager._is_host_fib_route(vlan, ip_gw))
+        ofmsgs = route_manager._update_nexthop(
+            vlan, self.valve.dp.ports[1], self.P1_V100_MAC, ip_gw)
+        route_dsts = set([
+            ofmsg.match['ipv4_dst'] for ofmsg in ofmsgs if 'ipv4_dst' in ofmsg.match])
+        self.assertEqual(set([('10.88.88.0', '255.255.255.0')]), route_dsts)
+
+    def test_nexthop_resolve_schedule(self):
+        """Test gateways are resolved only when due, with backoff."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        self.valve.add_route(
+            vlan, ipaddress.ip_address(u'10.0.0.2'),
+            ipaddress.ip_network(u'10.88.88.0/24'))
+        now = time.time()
+        self.assertTrue(route_manager.resolve_gateways(vlan, now))
+        self.assertFalse(route_manager.resolve_gateways(vlan, now + 1))
+        self.assertTrue(route_manager.resolve_gateways(vlan, now + 2))
+        self.assertFalse(route_manager.resolve_gateways(vlan, now + 5))
+        self.assertTrue(route_manager.resolve_gateways(vlan, now + 6))
+
+    def test_fib_compression(self):
+        """Test routes covered by a route with the same nexthop are not programmed."""
+        vlan = self.valve.dp.vlans[0x100]
+        routes = vlan.routes_by_ipv(4)
+        route_manager = self.valve.route_manager_by_ipv[4]
+        route_manager.fib_compression = True
+        ip_gw = ipaddress.ip_address(u'10.0.0.1')
+        covered = ipaddress.ip_network(u'10.99.99.0/24')
+        cover = ipaddress.ip_network(u'10.99.0.0/16')
+        rib_routes = len(routes)
+        fib_routes = routes.fib_len()
+        ofmsgs = self.valve.add_route(vlan, ip_gw, cover)
+        self.assertTrue(routes.is_suppressed(covered))
+        self.assertEqual(rib_routes + 1, len(routes))
+        self.assertEqual(fib_routes, routes.fib_len())
+        self.assertTrue([
+            ofmsg for ofmsg in ofmsgs
+            if ofmsg.command == ofp.OFPFC_DELETE_STRICT and
+            ofmsg.match['ipv4_dst'] == ('10.99.99.0', '255.255.255.0')])
+        ofmsgs = self.valve.del_route(vlan, cover)
+        self.assertFalse(routes.is_suppressed(covered))
+        self.assertEqual(fib_routes, routes.fib_len())
+        self.assertTrue([
+            ofmsg for ofmsg in ofmsgs
+            if ofmsg.command == ofp.OFPFC_ADD and
+            ofmsg.match['ipv4_dst'] == ('10.99.99.0', '255.255.255.0')])
+
+    def test_multipath_route(self):
+        """Test routes with multiple nexthops use a group of all resolved nexthops."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        route_manager.use_group_table = True
+        ip_gws = [ipaddress.ip_address(u'10.0.0.1'), ipaddress.ip_address(u'10.0.0.2')]
+        ip_dst = ipaddress.ip_network(u'10.55.0.0/16')
+        ofmsgs = self.valve.add_multipath_route(vlan, ip_gws, ip_dst)
+        group_adds = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod) and ofmsg.command == ofp.OFPGC_ADD]
+        self.assertEqual(1, len(group_adds))
+        self.assertEqual(ofp.OFPGT_SELECT, group_adds[0].type)
+        self.assertEqual(1, len(group_adds[0].buckets))
+        ofmsgs = route_manager._update_nexthop(
+            vlan, self.valve.dp.ports[2], self.P2_V200_MAC, ip_gws[1])
+        group_mods = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod) and ofmsg.command == ofp.OFPGC_MODIFY]
+        self.assertEqual(1, len(group_mods))
+        self.assertEqual(
+            [1, 2], sorted([bucket.watch_port for bucket in group_mods[0].buckets]))
+        ofmsgs = self.valve.add_multipath_route(vlan, ip_gws, ip_dst, failover=True)
+        self.assertEqual(
+            [ofp.OFPGT_FF], [
+                ofmsg.type for ofmsg in ofmsgs if isinstance(ofmsg, parser.OFPGroupMod)])
+        self.assertEqual(
+            [ip_dst], vlan.routes_by_ipv(4).ip_dsts_via(ip_gws[1]))
+
+    def test_nexthop_group_release(self):
+        """Test nexthop groups are deleted, and IDs reused, when no route uses them."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        route_manager.use_group_table = True
+        groups = route_manager.groups
+        ip_gw = ipaddress.ip_address(u'10.0.0.2')
+        ip_dsts = [
+            ipaddress.ip_network(u'10.88.88.0/24'),
+            ipaddress.ip_network(u'10.77.77.0/24')]
+        for ip_dst in ip_dsts:
+            self.valve.add_route(vlan, ip_gw, ip_dst)
+        ofmsgs = route_manager._update_nexthop(
+            vlan, self.valve.dp.ports[1], self.P1_V100_MAC, ip_gw)
+        group_id = route_manager._group_id_from_ip_gw(vlan, ip_gw)
+        self.assertIn(group_id, groups.entries)
+        self.assertEqual(
+            1, len([ofmsg for ofmsg in ofmsgs if isinstance(ofmsg, parser.OFPGroupMod) and
+                    ofmsg.command == ofp.OFPGC_ADD]))
+        ofmsgs = self.valve.del_route(vlan, ip_dsts[0])
+        self.assertFalse([ofmsg for ofmsg in ofmsgs if isinstance(ofmsg, parser.OFPGroupMod)])
+        ofmsgs = self.valve.del_route(vlan, ip_dsts[1])
+        group_dels = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod) and ofmsg.command == ofp.OFPGC_DELETE]
+        self.assertEqual([group_id], [ofmsg.group_id for ofmsg in group_dels])
+        self.assertNotIn(group_id, groups.entries)
+        ofmsgs = self.valve.add_route(vlan, ip_gw, ip_dsts[0])
+        self.assertEqual(group_id, route_manager._group_id_from_ip_gw(vlan, ip_gw))
+        self.assertIn(group_id, groups.entries)
+
+    def test_vip_lookup(self):
+        """Test VIP and VIP subnet lookup."""
+        vlan = self.valve.dp.vlans[0x100]
+        faucet_vip = ipaddress.ip_interface(u'10.0.0.254/24')
+        self.assertEqual(faucet_vip, vlan.ip_in_vip_subnet(ipaddress.ip_address(u'10.0.0.1')))
+        for ip_addr in (u'10.0.0.0', u'10.0.0.255', u'10.0.1.1'):
+            self.assertIsNone(vlan.ip_in_vip_subnet(ipaddress.ip_address(ip_addr)))
+        self.assertTrue(vlan.is_faucet_vip(faucet_vip.ip))
+        self.assertFalse(vlan.is_faucet_vip(ipaddress.ip_address(u'10.0.0.1')))
+        self.assertFalse(vlan.is_faucet_vip(faucet_vip.network))
+
+    def test_vlan_port_caches(self):
+        """Test VLAN port membership and cached port lists."""
+        vlan = self.valve.dp.vlans[0x100]
+        port = self.valve.dp.ports[1]
+        self.assertTrue(vlan.port_is_untagged(port))
+        self.assertFalse(vlan.port_is_tagged(port))
+        self.assertTrue(vlan.port_is_tagged(self.valve.dp.ports[2]))
+        ports = vlan.get_ports()
+        self.assertIs(ports, vlan.get_ports())
+        flood_ports = vlan.untagged_flood_ports(False)
+        self.assertIn(port, flood_ports)
+        port.phys_up = not port.phys_up
+        self.assertIsNot(ports, vlan.get_ports())
+        self.assertEqual(ports, vlan.get_ports())
+        self.assertIsNot(flood_ports, vlan.untagged_flood_ports(False))
+
+    def test_proactive_learn_limits(self):
+        """Test proactive resolution is rate limited, and skips recently failed hosts."""
+        vlan = self.valve.dp.vlans[0x100]
+        route_manager = self.valve.route_manager_by_ipv[4]
+        route_manager.proactive_learn = True
+        vlan.proactive_learn_rate = 1
+        failed_ip = ipaddress.ip_address(u'10.0.0.99')
+        route_manager._proactive_learn_failed(vlan, failed_ip, time.time())
+        self.assertFalse(route_manager._proactive_resolve_neighbor([vlan], failed_ip))
+        self.assertTrue(route_manager._proactive_resolve_neighbor(
+            [vlan], ipaddress.ip_address(u'10.0.0.100')))
+        self.assertFalse(route_manager._proactive_resolve_neighbor(
+            [vlan], ipaddress.ip_address(u'10.0.0.101')))
+        self.assertEqual(2, vlan.dyn_proactive_learn_drop_count)
+
+    def test_bgp_route_batch(self):
+        """Test BGP route changes are coalesced and applied in one batch."""
+        vlan = self.valve.dp.vlans[0x100]
+        sent = []
+        bgp = faucet_bgp.FaucetBgp(
+            self.valve.logger, lambda dp_id, flowmods: sent.append(flowmods))
+        bgp.reset({self.DP_ID: self.valve}, None)
+        ip_gw = ipaddress.ip_address(u'10.0.0.2')
+        self.valve.route_manager_by_ipv[4]._update_nexthop(
+            vlan, self.valve.dp.ports[1], self.P1_V100_MAC, ip_gw)
+        flapped = ipaddress.ip_network(u'10.88.88.0/24')
+        added = ipaddress.ip_network(u'10.77.77.0/24')
+        bgp._queue_route_change(vlan, flapped, ip_gw)
+        bgp._queue_route_change(vlan, added, ip_gw)
+        bgp._queue_route_change(vlan, flapped, None)
+        routes = vlan.routes_by_ipv(4)
+        self.assertNotIn(added, routes)
+        bgp._apply_route_changes(vlan)
+        self.assertIn(added, routes)
+        self.assertNotIn(flapped, routes)
+        bgp._apply_route_changes(vlan)
+        self.assertEqual(1, len(sent))
+
+    def test_bgp_route_batch_flush(self):
+        """Test a BGP batch applied when full is not applied again by its timer."""
+        vlan = self.valve.dp.vlans[0x100]
+        vlan.bgp_batch_size = 2
+        sent = []
+        bgp = faucet_bgp.FaucetBgp(
+            self.valve.logger, lambda dp_id, flowmods: sent.append(flowmods))
+        bgp.reset({self.DP_ID: self.valve}, None)
+        ip_gw = ipaddress.ip_address(u'10.0.0.2')
+        self.valve.route_manager_by_ipv[4]._update_nexthop(
+            vlan, self.valve.dp.ports[1], self.P1_V100_MAC, ip_gw)
+        prefixes = [
+            ipaddress.ip_network(u'10.77.%u.0/24' % i) for i in range(3)]
+        bgp._queue_route_change(vlan, prefixes[0], ip_gw)
+        full_batch = bgp._pending_route_changes[(vlan.dp_id, vlan.vid)]
+        bgp._queue_route_change(vlan, prefixes[1], ip_gw)
+        self.assertEqual(1, len(sent))
+        bgp._queue_route_change(vlan, prefixes[2], ip_gw)
+        routes = vlan.routes_by_ipv(4)
+        bgp._apply_route_changes(vlan, full_batch)
+        self.assertNotIn(prefixes[2], routes)
+        bgp._apply_route_changes(
+            vlan, bgp._pending_route_changes[(vlan.dp_id, vlan.vid)])
+        self.assertIn(prefixes[2], routes)
+        self.assertEqual(2, len(sent))
+
+    def test_packet_in_batch(self):
+        """Test packet in batches are handled when full, or by their own timer."""
+        app = Faucet.__new__(Faucet)
+        app.valves = {self.DP_ID: self.valve}
+        app._packet_in_batches = {}
+        handled = []
+        events = []
+        app._rcv_packets = lambda dp_id, valve, pkt_metas: handled.append(list(pkt_metas))
+        app.send_event = lambda app_name, ryu_event: events.append(ryu_event)
+        self.valve.dp.packetin_batch_size = 2
+        self.valve.dp.packetin_batch_ms = 1
+        timers = []
+        with mock.patch(
+                'faucet.faucet.hub.spawn_after',
+                side_effect=lambda seconds, func, *args: timers.append((func, args))):
+            for pkt_meta in ('a', 'b', 'c'):
+                app._packet_in_batch_add(self.valve, pkt_meta)
+        self.assertEqual([['a', 'b']], handled)
+        self.assertEqual(2, len(timers))
+        for func, args in timers:
+            func(*args)
+        self.assertEqual(2, len(events))
+        # Timer for the batch handled when full doesn't handle the next batch.
+        app.packet_in_batch(events[0])
+        self.assertEqual([['a', 'b']], handled)
+        app.packet_in_batch(events[1])
+        self.assertEqual([['a', 'b'], ['c']], handled)
+
+    def test_group_id_allocation(self):
+        """Test group IDs are unique per key, and released IDs are reused."""
+        groups = self.valve.dp.groups
+        group_ids = [groups.group_id_from_key(('test', i)) for i in range(3)]
+        self.assertEqual(3, len(set(group_ids)))
+        self.assertEqual(group_ids[1], groups.group_id_from_key(('test', 1)))
+        groups.release(('test', 1))
+        self.assertFalse(groups.has_key(('test', 1)))
+        self.assertEqual(group_ids[1], groups.group_id_from_key(('test', 3)))
+
+    def test_shadow_flows(self):
+        """Test flowmods that would not change the datapath are suppressed."""
+        self.assertEqual(
+            ['x'], self.valve.prepare_send_flows(['x']))
+        self.valve.dp.shadow_flows = True
+        ofmsgs = self.valve.datapath_connect(self.DP_ID, [1, 2, 3])
+        self.assertTrue(self.valve.prepare_send_flows(ofmsgs))
+        self.assertTrue(self.valve.shadow_flows.table_flow_counts())
+        flowadds = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPFlowMod) and
+            ofmsg.command == ofp.OFPFC_ADD and not ofmsg.hard_timeout]
+        self.assertTrue(flowadds)
+        self.assertFalse(self.valve.prepare_send_flows(flowadds))
+        vlan = self.valve.dp.vlans[0x100]
+        self.valve.flood_manager.use_group_table = False
+        self.assertFalse([
+            ofmsg for ofmsg in self.valve.prepare_send_flows(
+                self.valve.flood_manager.build_flood_rules(vlan))
+            if isinstance(ofmsg, parser.OFPFlowMod)])
+        vlan_table = self.valve.dp.tables['vlan']
+        flowdrop = vlan_table.flowdrop(
+            vlan_table.match(in_port=99), priority=self.valve.dp.highest_priority)
+        flowdel = vlan_table.flowdel(
+            vlan_table.match(in_port=99), priority=self.valve.dp.highest_priority,
+            strict=True)
+        # Added and deleted in the same batch, or a delete of an absent flow.
+        self.assertFalse(self.valve.prepare_send_flows([flowdrop] + flowdel))
+        self.assertFalse(self.valve.prepare_send_flows(flowdel))
+        self.assertEqual([flowdrop], self.valve.prepare_send_flows([flowdrop]))
+        self.assertFalse(self.valve.prepare_send_flows([flowdrop]))
+        self.assertEqual(flowdel, self.valve.prepare_send_flows(flowdel))
+        timed_flowdrop = vlan_table.flowdrop(
+            vlan_table.match(in_port=99), hard_timeout=10)
+        for _ in range(2):
+            self.assertEqual(
+                [timed_flowdrop], self.valve.prepare_send_flows([timed_flowdrop]))
+        self.valve.datapath_disconnect(self.DP_ID)
+        self.assertFalse(self.valve.shadow_flows.table_flow_counts())
+
+    def test_flood_rules_incremental(self):
+        """Test a port flap only re-adds flood flows for that input port."""
+        flood_table_id = self.valve.dp.tables['flood'].table_id
+
+        def flood_flowmods(ofmsgs):
+            return [
+                ofmsg for ofmsg in ofmsgs
+                if isinstance(ofmsg, parser.OFPFlowMod) and
+                ofmsg.table_id == flood_table_id and
+                ofmsg.command != ofp.OFPFC_DELETE]
+
+        ofmsgs = self.valve.port_delete(dp_id=self.DP_ID, port_num=1)
+        self.table.apply_ofmsgs(ofmsgs)
+        self.assertFalse(flood_flowmods(ofmsgs))
+        ofmsgs = self.valve.port_add(dp_id=self.DP_ID, port_num=1)
+        self.table.apply_ofmsgs(ofmsgs)
+        flowmods = flood_flowmods(ofmsgs)
+        self.assertTrue(flowmods)
+        self.assertEqual(
+            set([(ofp.OFPFC_ADD, 1)]),
+            set([(ofmsg.command, ofmsg.match['in_port']) for ofmsg in flowmods]))
+
+    def test_hairpin_flood_groups(self):
+        """Test hairpin flooding uses a flood group per input port."""
+        vlan = self.valve.dp.vlans[0x100]
+        flood_manager = self.valve.flood_manager
+        flood_manager.use_group_table = True
+        self.valve.dp.ports[1].hairpin = True
+        ofmsgs = flood_manager.build_flood_rules(vlan)
+        group_adds = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod) and ofmsg.command == ofp.OFPGC_ADD]
+        # One group per input port, with and without unknown unicast.
+        self.assertEqual(2 * len(vlan.get_ports()), len(group_adds))
+        in_port_outputs = [
+            ofmsg for ofmsg in group_adds
+            if ofp.OFPP_IN_PORT in [
+                bucket.actions[-1].port for bucket in ofmsg.buckets]]
+        self.assertEqual(2, len(in_port_outputs))
+        for ofmsg in ofmsgs:
+            if isinstance(ofmsg, parser.OFPFlowMod):
+                self.assertIsInstance(
+                    ofmsg.instructions[0].actions[-1], parser.OFPActionGroup)
+        self.assertFalse(flood_manager.build_flood_rules(vlan, modify=True))
+
+    def test_hairpin_flood_groups_port_delete(self):
+        """Test per input port flood groups are deleted with their port."""
+        vlan = self.valve.dp.vlans[0x100]
+        flood_manager = self.valve.flood_manager
+        flood_manager.use_group_table = True
+        self.valve.dp.ports[1].hairpin = True
+        flood_manager.build_flood_rules(vlan)
+        groups = self.valve.dp.groups
+        group_ids = set([
+            groups.group_id_from_key(('flood', vlan.vid, 1, exclude_unicast))
+            for exclude_unicast in (False, True)])
+        ofmsgs = self.valve.port_delete(dp_id=self.DP_ID, port_num=1)
+        group_dels = [
+            ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod) and ofmsg.command == ofp.OFPGC_DELETE]
+        self.assertEqual(group_ids, set([ofmsg.group_id for ofmsg in group_dels]))
+        for group_id in group_ids:
+            self.assertNotIn(group_id, groups.entries)
+
     def test_port_add_input(self):
         """Test that when a port is enabled packets are input correctly."""
 
@@ -524,6 +1048,56 @@ acls:
             msg='packet not allowed by acl')
 
 
+class ValveGroupRoutingReloadTestCase(ValveTestBase):
+    """Test routing groups are re-added after a cold start config reload."""
+
+    CONFIG = ValveTestBase.CONFIG.replace(
+        "hardware: 'Open vSwitch'",
+        "hardware: 'Open vSwitch'\n        group_table_routing: True")
+    # Changing every port causes a cold start.
+    NEW_CONFIG = CONFIG.replace(
+        '                number:', '                max_hosts: 10\n                number:')
+
+    def cold_reload(self):
+        cold_start, ofmsgs = self.valve.reload_config(self.update_config(self.NEW_CONFIG))
+        self.assertTrue(cold_start)
+        self.table.apply_ofmsgs(ofmsgs)
+        for route_manager in list(self.valve.route_manager_by_ipv.values()):
+            self.assertIs(self.valve.dp.groups, route_manager.groups)
+        self.assertIs(self.valve.dp.groups, self.valve.flood_manager.groups)
+
+    @staticmethod
+    def group_commands(ofmsgs):
+        return [
+            ofmsg.command for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPGroupMod) and ofmsg.command != ofp.OFPGC_DELETE]
+
+    def test_nexthop_group_readded(self):
+        """Test a nexthop group is added, not modified, after a cold start."""
+        ip_gw = ipaddress.ip_address(u'10.0.0.1')
+        route_manager = self.valve.route_manager_by_ipv[4]
+        group_id = route_manager._group_id_from_ip_gw(self.valve.dp.vlans[0x100], ip_gw)
+        self.assertIn(group_id, route_manager.groups.entries)
+        self.cold_reload()
+        ofmsgs = route_manager._update_nexthop(
+            self.valve.dp.vlans[0x100], self.valve.dp.ports[1], self.UNKNOWN_MAC, ip_gw)
+        self.assertEqual([ofp.OFPGC_ADD], self.group_commands(ofmsgs))
+
+    def test_multipath_group_readded(self):
+        """Test a multipath group is added, not modified, after a cold start."""
+        ip_gws = [ipaddress.ip_address(u'10.0.0.1'), ipaddress.ip_address(u'10.0.0.2')]
+        ip_dst = ipaddress.ip_network(u'10.55.0.0/16')
+        route_manager = self.valve.route_manager_by_ipv[4]
+        self.valve.add_multipath_route(self.valve.dp.vlans[0x100], ip_gws, ip_dst)
+        self.cold_reload()
+        vlan = self.valve.dp.vlans[0x100]
+        self.valve.add_multipath_route(vlan, ip_gws, ip_dst)
+        ofmsgs = route_manager._update_nexthop(
+            vlan, self.valve.dp.ports[1], self.UNKNOWN_MAC, ip_gws[0])
+        self.assertIn(ofp.OFPGC_ADD, self.group_commands(ofmsgs))
+        self.assertNotIn(ofp.OFPGC_MODIFY, self.group_commands(ofmsgs))
+
+
 class ValveACLTestCase(ValveTestBase):
 
     def test_vlan_acl_deny(self):
@@ -595,6 +1169,129 @@ acls:
             msg='Packet not allowed by ACL')
 
 
+class ValvePacketTestCase(unittest.TestCase):
+
+    def test_parse_packet_in_header(self):
+        """Test header fast path decodes the same fields as a full parse."""
+        pkt = valve_packet.arp_request(
+            0x100, '0e:00:00:00:00:01', '10.0.0.1', '10.0.0.254')
+        self.assertEqual(
+            ('0e:00:00:00:00:01', 'ff:ff:ff:ff:ff:ff', 0x100, 0x806),
+            valve_packet.parse_packet_in_header(pkt.data))
+        eth_pkt = valve_packet.parse_eth_pkt(packet.Packet(pkt.data))
+        self.assertEqual(
+            (eth_pkt.src, eth_pkt.dst),
+            valve_packet.parse_packet_in_header(pkt.data)[:2])
+        self.assertEqual(
+            (None, None, None, None),
+            valve_packet.parse_packet_in_header(pkt.data[:16]))
+
+
+class ValveFlowReorderTestCase(unittest.TestCase):
+
+    def test_flowreorder(self):
+        """Test deletes and groups go first, and adds are ordered by priority."""
+        table0 = ValveTable(0, 'table0', None, flow_cookie=0)
+        table1 = ValveTable(1, 'table1', None, flow_cookie=0)
+        low_add = table1.flowdrop(table1.match(in_port=1), priority=1)
+        high_add = table1.flowdrop(table1.match(in_port=1), priority=2)
+        replaced_add = table0.flowdrop(table0.match(in_port=1), priority=1)
+        table0_add = table0.flowdrop(table0.match(in_port=1), priority=1)
+        flowdel = table1.flowdel(table1.match(in_port=2))[0]
+        dup_flowdel = table1.flowdel(table1.match(in_port=2))[0]
+        replaced_groupadd = valve_of.groupadd(group_id=1, buckets=[])
+        groupadd = valve_of.groupadd(
+            group_id=1, buckets=[valve_of.bucket(actions=[valve_of.output_port(1)])])
+        pkt_out = valve_of.packetout(1, b'')
+        reordered = valve_of.valve_flowreorder([
+            low_add, pkt_out, replaced_groupadd, high_add, flowdel,
+            replaced_add, valve_of.barrier(), groupadd, dup_flowdel, table0_add])
+        self.assertEqual(
+            [flowdel, None, groupadd, None, table0_add, high_add, low_add, pkt_out],
+            [None if isinstance(ofmsg, parser.OFPBarrierRequest) else ofmsg
+             for ofmsg in reordered])
+        self.assertEqual([low_add], valve_of.valve_flowreorder([low_add]))
+        # Group modifies follow the barrier after group adds.
+        groupmod = valve_of.groupmod(group_id=1, buckets=[])
+        reordered = valve_of.valve_flowreorder([groupmod, groupadd])
+        self.assertEqual(groupadd, reordered[0])
+        self.assertIsInstance(reordered[1], parser.OFPBarrierRequest)
+        self.assertEqual(groupmod, reordered[2])
+
+    def test_flowreorder_modify_add(self):
+        """Test modifies of an added flow keep their order relative to the add."""
+        table = ValveTable(1, 'table1', None, flow_cookie=0)
+        match = table.match(in_port=1)
+        flowmod = table.flowmod(
+            match, priority=1, command=ofp.OFPFC_MODIFY_STRICT,
+            inst=[valve_of.apply_actions([valve_of.output_port(2)])])
+        flowadd = table.flowdrop(match, priority=1)
+        other_flowmod = table.flowmod(
+            table.match(in_port=2), priority=1, command=ofp.OFPFC_MODIFY_STRICT)
+        high_add = table.flowdrop(match, priority=2)
+        self.assertEqual(
+            [high_add, flowmod, flowadd, other_flowmod],
+            valve_of.valve_flowreorder([flowmod, other_flowmod, flowadd, high_add]))
+        self.assertEqual(
+            [high_add, flowadd, flowmod],
+            valve_of.valve_flowreorder([flowadd, flowmod, high_add]))
+
+
+class ValveRIBTestCase(unittest.TestCase):
+
+    def test_longest_match(self):
+        """Test RIB behaves as a route dict with longest prefix match."""
+        rib = valve_rib.ValveRIB(4)
+        gw1 = ipaddress.ip_address(u'10.0.0.1')
+        gw2 = ipaddress.ip_address(u'10.0.0.2')
+        default = ipaddress.ip_network(u'0.0.0.0/0')
+        net = ipaddress.ip_network(u'192.168.0.0/16')
+        subnet = ipaddress.ip_network(u'192.168.1.0/24')
+        rib[default] = gw1
+        rib[net] = gw2
+        rib[subnet] = gw2
+        self.assertEqual(3, len(rib))
+        self.assertEqual(gw2, rib[subnet])
+        self.assertEqual(
+            (subnet, gw2), rib.longest_match(ipaddress.ip_address(u'192.168.1.1')))
+        self.assertEqual(
+            (net, gw2), rib.longest_match(ipaddress.ip_address(u'192.168.2.1')))
+        self.assertEqual(
+            (default, gw1), rib.longest_match(ipaddress.ip_address(u'8.8.8.8')))
+        self.assertEqual(set([net, subnet]), set(rib.ip_dsts_via(gw2)))
+        rib[subnet] = gw1
+        self.assertEqual([net], rib.ip_dsts_via(gw2))
+        del rib[net]
+        del rib[default]
+        self.assertNotIn(net, rib)
+        self.assertFalse(rib.has_ip_gw(gw2))
+        self.assertEqual([(subnet, gw1)], rib.items())
+        self.assertIsNone(rib.longest_match(ipaddress.ip_address(u'192.168.2.1')))
+
+
+class BgpRouteDampeningTestCase(unittest.TestCase):
+
+    def test_dampening(self):
+        """Test a flapping prefix is suppressed, then reused after its penalty decays."""
+        dampening = faucet_bgp.BgpRouteDampening()
+        prefix = ipaddress.ip_network(u'10.88.88.0/24')
+        ip_gw = ipaddress.ip_address(u'10.0.0.2')
+        now = time.time()
+        self.assertFalse(dampening.update(prefix, ip_gw, None, now))
+        self.assertFalse(dampening.update(prefix, None, ip_gw, now))
+        self.assertFalse(dampening.update(prefix, ip_gw, None, now))
+        self.assertFalse(dampening.update(prefix, None, ip_gw, now))
+        self.assertFalse(dampening.update(prefix, ip_gw, None, now))
+        self.assertTrue(dampening.update(prefix, None, ip_gw, now))
+        self.assertTrue(dampening.is_suppressed(prefix))
+        self.assertTrue(dampening.update(prefix, ip_gw, None, now))
+        reuse_time = dampening.reuse_time(prefix, now)
+        self.assertGreater(reuse_time, 0)
+        self.assertEqual(0, dampening.reuse_time(prefix, now + reuse_time + 1))
+        self.assertEqual(ip_gw, dampening.reuse(prefix))
+        self.assertFalse(dampening.is_suppressed(prefix))
+
+
 class ValveReloadConfigTestCase(ValveTestCase):
     """Repeats the tests after a config reload."""
 